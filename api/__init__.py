@@ -1,9 +1,11 @@
 from .api_keys import router as api_keys_router
 from .prompts import router as prompts_router
 from .common import router as common_router
+from .batch import router as batch_router
 
 __all__ = [
     "api_keys_router",
     "prompts_router",
-    "common_router"
+    "common_router",
+    "batch_router"
 ]
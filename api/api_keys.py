@@ -9,23 +9,28 @@ from datetime import datetime
 
 from database import get_db
 from models.api_key import ApiKey
+from chat import client_pool, key_router, title_queue
+from chat.rate_limiter import rate_limits
 from schemas import (
     ApiKeyCreate,
     ApiKeyUpdate,
-    ApiKeyResponse,
     ApiKeyListQuery,
-    ApiKeyListResponse,
     ApiKeyBatchDelete,
     ApiKeyBatchStatus,
     ApiKeyTest,
     ApiKeyTestResponse,
     ApiKeyStats,
     BaseResponse,
-    SuccessResponse
+    SuccessResponse,
+    fast_response,
+    API_KEY_ROW
 )
 
 router = APIRouter(prefix="/chat/api-keys", tags=["API Key管理"])
 
+# 测试请求按"Hello"加max_tokens=10估算占用的Token
+TEST_REQUEST_TOKENS = 20
+
 
 @router.get("/list", response_model=BaseResponse)
 async def list_api_keys(
@@ -88,15 +93,13 @@ async def list_api_keys(
         result = await db.execute(query_stmt)
         items = result.scalars().all()
 
-        # 构造响应数据
-        response_data = ApiKeyListResponse(
-            total=total,
-            items=[ApiKeyResponse.from_orm(item) for item in items],
-            pageNum=pageNum,
-            pageSize=pageSize
-        )
-
-        return BaseResponse(data=response_data)
+        # 构造响应数据，字段与ApiKeyListResponse一致
+        return fast_response({
+            "total": total,
+            "items": API_KEY_ROW.many(items),
+            "pageNum": pageNum,
+            "pageSize": pageSize
+        })
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
@@ -112,7 +115,7 @@ async def get_api_key(api_key_id: int, db: AsyncSession = Depends(get_db)):
     if not api_key:
         raise HTTPException(status_code=404, detail="API Key不存在")
 
-    return BaseResponse(data=ApiKeyResponse.from_orm(api_key))
+    return fast_response(API_KEY_ROW(api_key))
 
 
 @router.post("", response_model=BaseResponse)
@@ -132,11 +135,10 @@ async def create_api_key(api_key_data: ApiKeyCreate, db: AsyncSession = Depends(
         db.add(db_api_key)
         await db.commit()
         await db.refresh(db_api_key)
+        key_router.invalidate()
+        title_queue.invalidate()
 
-        return BaseResponse(
-            message="API Key创建成功",
-            data=ApiKeyResponse.from_orm(db_api_key)
-        )
+        return fast_response(API_KEY_ROW(db_api_key), message="API Key创建成功")
 
     except HTTPException:
         raise
@@ -163,11 +165,11 @@ async def update_api_key(api_key_data: ApiKeyUpdate, db: AsyncSession = Depends(
 
         await db.commit()
         await db.refresh(api_key)
+        client_pool.invalidate(api_key.id)
+        key_router.invalidate()
+        title_queue.invalidate()
 
-        return BaseResponse(
-            message="API Key更新成功",
-            data=ApiKeyResponse.from_orm(api_key)
-        )
+        return fast_response(API_KEY_ROW(api_key), message="API Key更新成功")
 
     except HTTPException:
         raise
@@ -189,6 +191,9 @@ async def delete_api_key(api_key_id: int, db: AsyncSession = Depends(get_db)):
 
         await db.delete(api_key)
         await db.commit()
+        client_pool.invalidate(api_key_id)
+        key_router.invalidate()
+        title_queue.invalidate()
 
         return SuccessResponse(message="API Key删除成功")
 
@@ -207,6 +212,9 @@ async def batch_delete_api_keys(batch_data: ApiKeyBatchDelete, db: AsyncSession
         result = await db.execute(stmt)
         deleted_count = result.rowcount
         await db.commit()
+        client_pool.invalidate(*batch_data.ids)
+        key_router.invalidate()
+        title_queue.invalidate()
 
         return SuccessResponse(message=f"成功删除 {deleted_count} 个API Key")
 
@@ -227,6 +235,9 @@ async def batch_update_api_key_status(batch_data: ApiKeyBatchStatus, db: AsyncSe
         result = await db.execute(stmt)
         updated_count = result.rowcount
         await db.commit()
+        client_pool.invalidate(*batch_data.ids)
+        key_router.invalidate()
+        title_queue.invalidate()
 
         return SuccessResponse(message=f"成功更新 {updated_count} 个API Key状态")
 
@@ -240,6 +251,7 @@ async def test_api_key(test_data: ApiKeyTest, db: AsyncSession = Depends(get_db)
     """测试API Key连接"""
     try:
         api_key = None
+        rate_limiter = None
         model_url = None
         model_name = None
         key_value = None
@@ -256,6 +268,8 @@ async def test_api_key(test_data: ApiKeyTest, db: AsyncSession = Depends(get_db)
             key_value = api_key_obj.api_key
             model_url = api_key_obj.model_url
             model_name = api_key_obj.model_name
+            # 已保存的密钥与对话共享限速额度
+            rate_limiter = rate_limits.limiter(api_key_obj)
         else:
             # 使用提供的测试数据
             key_value = test_data.api_key
@@ -265,6 +279,10 @@ async def test_api_key(test_data: ApiKeyTest, db: AsyncSession = Depends(get_db)
         if not all([key_value, model_url, model_name]):
             raise HTTPException(status_code=400, detail="缺少必要的测试参数")
 
+        # 测试请求也占用额度，按配置的RPM/TPM排队后再发出
+        if rate_limiter:
+            await rate_limiter.acquire(TEST_REQUEST_TOKENS)
+
         # 测试API连接
         start_time = time.time()
 
@@ -282,6 +300,9 @@ async def test_api_key(test_data: ApiKeyTest, db: AsyncSession = Depends(get_db)
         async with httpx.AsyncClient(timeout=30.0) as client:
             response = await client.post(model_url, headers=headers, json=test_payload)
 
+        if rate_limiter:
+            rate_limiter.observe(response.status_code, response.headers)
+
         response_time = time.time() - start_time
 
         if response.status_code == 200:
@@ -0,0 +1,253 @@
+import uuid
+import json
+from typing import Optional, List, Dict, Any
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update, insert, func, desc
+
+from database import get_db, AsyncSessionLocal
+from chat.batch import batch_runner, DEFAULT_BATCH_CONCURRENCY, MAX_BATCH_CONCURRENCY
+from models import ApiKey, Prompt, BatchJob, BatchItem
+from models.batch_job import BATCH_RUNNING, BATCH_CANCELLED, ITEM_PENDING, ITEM_FAILED
+from schemas import BatchItemResult, BaseResponse, SuccessResponse, fast_response, BATCH_JOB_ROW
+
+router = APIRouter(prefix="/chat/batch", tags=["批量推理"])
+
+# 单次上传的条目上限
+MAX_BATCH_ITEMS = 50000
+# 写入条目和导出结果时每批处理的行数
+BATCH_WRITE_SIZE = 500
+
+
+def parse_batch_line(line_no: int, raw: str) -> Optional[Dict[str, Any]]:
+    """解析上传文件中的一行：{"content"或"input": ..., "custom_id": ...}，或直接是JSON字符串；空行返回None"""
+    raw = raw.strip()
+    if not raw:
+        return None
+    try:
+        value = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"第{line_no}行不是有效的JSON: {e.msg}")
+
+    if isinstance(value, str):
+        value = {"content": value}
+    if not isinstance(value, dict):
+        raise HTTPException(status_code=400, detail=f"第{line_no}行必须是对象或字符串")
+    content = value.get("content", value.get("input"))
+    if not isinstance(content, str) or not content.strip():
+        raise HTTPException(status_code=400, detail=f"第{line_no}行缺少content")
+    custom_id = value.get("custom_id")
+    return {
+        "line_no": line_no,
+        "custom_id": str(custom_id) if custom_id is not None else None,
+        "content": content,
+        "status": ITEM_PENDING,
+        "attempts": 0,
+    }
+
+
+async def iter_lines(request: Request):
+    """逐行读取请求体，不把整个文件读入内存"""
+    pending = b""
+    async for chunk in request.stream():
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+
+async def read_batch_items(request: Request) -> List[Dict[str, Any]]:
+    """读取并校验整个上传文件，返回待写入的条目"""
+    items: List[Dict[str, Any]] = []
+    line_no = 0
+    try:
+        async for line in iter_lines(request):
+            line_no += 1
+            item = parse_batch_line(line_no, line)
+            if item is None:
+                continue
+            if len(items) >= MAX_BATCH_ITEMS:
+                raise HTTPException(status_code=400, detail=f"单个任务最多{MAX_BATCH_ITEMS}条")
+            items.append(item)
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail=f"第{line_no + 1}行不是UTF-8编码")
+    if not items:
+        raise HTTPException(status_code=400, detail="上传内容中没有任务")
+    return items
+
+
+async def get_job(db: AsyncSession, job_uuid: str) -> BatchJob:
+    job = await db.scalar(select(BatchJob).where(BatchJob.uuid == job_uuid))
+    if not job:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return job
+
+
+@router.post("/jobs", response_model=BaseResponse)
+async def create_batch_job(
+    request: Request,
+    api_key_id: int = Query(..., description="使用的API密钥ID"),
+    prompt_id: int = Query(..., description="使用的提示词ID"),
+    concurrency: int = Query(DEFAULT_BATCH_CONCURRENCY, ge=1, le=MAX_BATCH_CONCURRENCY, description="并发数"),
+    name: Optional[str] = Query(None, max_length=200, description="任务名称"),
+    db: AsyncSession = Depends(get_db)
+):
+    """创建批量任务，请求体为JSONL（每行一条任务）"""
+    api_key = await db.scalar(select(ApiKey).where(ApiKey.id == api_key_id, ApiKey.status == "active"))
+    if not api_key:
+        raise HTTPException(status_code=404, detail="API密钥不存在或未启用")
+    prompt = await db.get(Prompt, prompt_id)
+    if not prompt:
+        raise HTTPException(status_code=404, detail="提示词不存在")
+
+    # 先读完上传内容再开启写事务，慢速或大文件上传期间不占用SQLite的写锁
+    items = await read_batch_items(request)
+
+    job = BatchJob(
+        uuid=str(uuid.uuid4()),
+        name=name,
+        api_key_id=api_key_id,
+        prompt_id=prompt_id,
+        concurrency=concurrency,
+        status=BATCH_RUNNING,
+        total_count=len(items)
+    )
+    db.add(job)
+    await db.flush()
+    for item in items:
+        item["job_id"] = job.id
+    for start in range(0, len(items), BATCH_WRITE_SIZE):
+        await db.execute(insert(BatchItem), items[start:start + BATCH_WRITE_SIZE])
+    await db.commit()
+    await db.refresh(job)
+
+    await batch_runner.submit(job.id)
+    return fast_response(BATCH_JOB_ROW(job))
+
+
+@router.get("/jobs", response_model=BaseResponse)
+async def list_batch_jobs(
+    pageNum: int = Query(1, ge=1, description="页码"),
+    pageSize: int = Query(10, ge=1, le=100, description="每页数量"),
+    status: Optional[str] = Query(None, description="状态筛选"),
+    db: AsyncSession = Depends(get_db)
+):
+    """获取批量任务列表"""
+    conditions = [BatchJob.status == status] if status else []
+    total = await db.scalar(select(func.count(BatchJob.id)).where(*conditions))
+    result = await db.execute(
+        select(BatchJob)
+        .where(*conditions)
+        .order_by(desc(BatchJob.created_at), desc(BatchJob.id))
+        .offset((pageNum - 1) * pageSize)
+        .limit(pageSize)
+    )
+    jobs = BATCH_JOB_ROW.many(result.scalars().all())
+    return fast_response({"total": total, "items": jobs, "pageNum": pageNum, "pageSize": pageSize})
+
+
+@router.get("/jobs/{job_uuid}", response_model=BaseResponse)
+async def get_batch_job(job_uuid: str, db: AsyncSession = Depends(get_db)):
+    """获取批量任务进度"""
+    job = await get_job(db, job_uuid)
+    result = await db.execute(
+        select(BatchItem.status, func.count(BatchItem.id))
+        .where(BatchItem.job_id == job.id)
+        .group_by(BatchItem.status)
+    )
+    data = BATCH_JOB_ROW(job)
+    data["items"] = dict(result.all())
+    return fast_response(data)
+
+
+@router.post("/jobs/{job_uuid}/cancel", response_model=BaseResponse)
+async def cancel_batch_job(job_uuid: str, db: AsyncSession = Depends(get_db)):
+    """取消批量任务，已完成的条目保留结果，未执行的条目保持pending"""
+    job = await get_job(db, job_uuid)
+    if job.status != BATCH_RUNNING:
+        raise HTTPException(status_code=409, detail="任务未在运行")
+
+    await db.execute(
+        update(BatchJob)
+        .where(BatchJob.id == job.id, BatchJob.status == BATCH_RUNNING)
+        .values(status=BATCH_CANCELLED, finished_at=func.now())
+    )
+    await db.commit()
+    # 任务在其他进程执行时由该进程在下次心跳时停止
+    batch_runner.cancel(job.id)
+    return SuccessResponse(message="任务已取消")
+
+
+@router.post("/jobs/{job_uuid}/retry", response_model=BaseResponse)
+async def retry_batch_job(job_uuid: str, db: AsyncSession = Depends(get_db)):
+    """重新执行失败的条目；已取消的任务从未执行的条目继续"""
+    job = await get_job(db, job_uuid)
+    if job.status == BATCH_RUNNING:
+        raise HTTPException(status_code=409, detail="任务正在运行")
+
+    result = await db.execute(
+        update(BatchItem)
+        .where(BatchItem.job_id == job.id, BatchItem.status == ITEM_FAILED)
+        .values(status=ITEM_PENDING, error=None)
+    )
+    retried = result.rowcount
+    await db.execute(
+        update(BatchJob)
+        .where(BatchJob.id == job.id)
+        .values(
+            status=BATCH_RUNNING,
+            error=None,
+            finished_at=None,
+            failed_count=BatchJob.failed_count - retried,
+            owner=None
+        )
+    )
+    await db.commit()
+
+    await batch_runner.submit(job.id)
+    return BaseResponse(data={"retried": retried})
+
+
+@router.get("/jobs/{job_uuid}/results")
+async def download_batch_results(
+    job_uuid: str,
+    status: Optional[str] = Query(None, description="只导出指定状态的条目"),
+    db: AsyncSession = Depends(get_db)
+):
+    """按行号顺序流式导出JSONL结果，任务运行中也可以导出已有的部分"""
+    job = await get_job(db, job_uuid)
+    job_id = job.id
+
+    async def generate():
+        last_line = 0
+        while True:
+            # 每页使用独立的会话，导出大文件时不长时间占用连接
+            async with AsyncSessionLocal() as session:
+                conditions = [BatchItem.job_id == job_id, BatchItem.line_no > last_line]
+                if status:
+                    conditions.append(BatchItem.status == status)
+                result = await session.execute(
+                    select(BatchItem)
+                    .where(*conditions)
+                    .order_by(BatchItem.line_no.asc())
+                    .limit(BATCH_WRITE_SIZE)
+                )
+                items = result.scalars().all()
+            if not items:
+                return
+            lines = [
+                BatchItemResult.model_validate(item).model_dump_json() + "\n"
+                for item in items
+            ]
+            yield "".join(lines)
+            last_line = items[-1].line_no
+
+    return StreamingResponse(
+        generate(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="batch-{job_uuid}.jsonl"'}
+    )
@@ -1,20 +1,45 @@
-import json
 import uuid
+import json
 import asyncio
-from typing import Dict
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
 from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, UploadFile, File
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, or_, func, desc
+from sqlalchemy import select, update, and_, or_, func, desc
+from sqlalchemy.orm import defer
 
 from autogen_agentchat.agents import AssistantAgent
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core.models import UserMessage, AssistantMessage, SystemMessage
 
 from database import get_db
+from metrics import StreamTimer, timed
+from chat import key_router, agent_cache, AgentLease, StreamCheckpointer, state_store
+from chat.context_window import WindowedChatCompletionContext, build_context, window_signature
+from chat.tokenizer import tokenizer
+from chat.sse import ContentBuffer, ChunkCoalescer, model_text_chunks
+from chat.generation import generation_jobs
+from chat.task_registry import task_registry
+from chat.admission import admission, AdmissionRejected
+from chat.response_cache import response_cache, cache_ttl, request_key, replay_chunks
+from chat.semantic_cache import semantic_cache, semantic_config, SemanticLookup
+from chat.title_queue import title_queue, is_default_title
+from chat.post_process import post_processor, TASK_MESSAGE_TOKENS, TASK_CONVERSATION_STATS, TASK_REPLY_CACHE
+from chat.structured import (
+    StructuredOutput, StructuredOutputError, output_model, structured_config, structured_signature
+)
 from models import ApiKey, Prompt, Conversation, Message, ChatGroup
+from models.conversation import (
+    MESSAGE_STATUS_ACTIVE, MESSAGE_STATUS_STREAMING, MESSAGE_STATUS_PARTIAL, MESSAGE_STATUS_ALTERNATE,
+    MESSAGE_VISIBLE_STATUSES
+)
 from schemas.common import BaseResponse
+from schemas.serializers import (
+    fast_response, CONVERSATION_ROW, CONVERSATION_DETAIL_ROW, CONVERSATION_SEARCH_ROW, CONVERSATION_BRIEF_ROW,
+    MESSAGE_ROW, MESSAGE_SEARCH_ROW, MESSAGE_VERSION_ROW
+)
 from schemas.conversation import (
     ConversationCreate, ConversationUpdate, ConversationResponse, ConversationListQuery,
     MessageCreate, MessageResponse, MessageListQuery, MessageEdit, MessageRegenerate,
@@ -28,8 +53,23 @@ from schemas.conversation import (
 # 创建路由器
 router = APIRouter(prefix="/chat", tags=["聊天"])
 
-# 全局变量存储SSE任务
-active_sse_tasks: Dict[str, asyncio.Task] = {}  # 存储SSE任务，key为任务ID
+# 非流式生成默认的截止时间（秒），包含排队等待
+REPLY_DEADLINE_SECONDS = 120
+
+
+def sse_response(frames, task_id: str) -> StreamingResponse:
+    """构造SSE响应，任务ID通过X-Task-ID返回给前端"""
+    return StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Headers": "*",
+            "X-Task-ID": task_id  # 返回任务ID给前端
+        }
+    )
 
 
 async def get_api_key_by_id(db: AsyncSession, api_key_id: int) -> ApiKey:
@@ -103,29 +143,28 @@ async def get_default_group(db: AsyncSession) -> ChatGroup:
     return group
 
 
-async def create_agent(api_key: ApiKey, prompt: Prompt, agent_state: Dict = None) -> AssistantAgent:
+async def create_agent(
+    api_key: ApiKey,
+    prompt: Prompt,
+    agent_state: Dict = None,
+    model_context: WindowedChatCompletionContext = None
+) -> AssistantAgent:
     """创建AutoGen代理"""
-    # 创建模型客户端
-    openai_model_client = OpenAIChatCompletionClient(
-        model=api_key.model_name,
-        api_key=api_key.api_key,
-        base_url=api_key.model_url,
-        model_info={
-            "vision": False,
-            "function_calling": True,
-            "json_output": True,
-            "family": "unknown",
-            "structured_output": True
-        }
-    )
+    # 同模型的密钥组成密钥池，每次调用挑选负载最低的密钥，首个分片前失败时自动切换
+    openai_model_client = await key_router.client(api_key)
 
-    # 创建代理
+    # 上下文按ApiKey的Token预算裁剪历史，传入model_context时直接沿用已加载的上下文
+    if model_context is None:
+        model_context = await build_model_context(api_key, prompt)
+
+    # 提示词声明了输出schema时，代理按结构化消息返回，由StructuredOutput校验和重试
     agent = AssistantAgent(
         name="assistant",
         model_client=openai_model_client,
         model_client_stream=True,
         system_message=prompt.content,
-
+        model_context=model_context,
+        output_content_type=output_model(structured_config(prompt))
     )
 
     # 如果有状态，加载它
@@ -138,6 +177,174 @@ async def create_agent(api_key: ApiKey, prompt: Prompt, agent_state: Dict = None
     return agent
 
 
+async def build_model_context(api_key: ApiKey, prompt: Prompt, initial_messages=None) -> WindowedChatCompletionContext:
+    """按ApiKey配置构造上下文窗口，使用模型对应的Token编码器计数
+
+    系统提示词和已有历史的Token数在线程池中批量计算后传入，之后加入的消息和load_state同样在线程池中计数。
+    """
+    model_name = api_key.model_name
+    await tokenizer.prepare(model_name)
+    batch_counter = tokenizer.message_batch_counter(model_name)
+    system_tokens = (await batch_counter([SystemMessage(content=prompt.content or "")]))[0]
+    initial_counts = await batch_counter(list(initial_messages)) if initial_messages else None
+    return build_context(
+        api_key, prompt, initial_messages, tokenizer.message_counter(model_name),
+        initial_counts, batch_counter, system_tokens
+    )
+
+
+async def get_conversation_model_name(db: AsyncSession, conversation: Conversation):
+    """对话所用模型名称，用于Token计数"""
+    return await db.scalar(select(ApiKey.model_name).where(ApiKey.id == conversation.api_key_id))
+
+
+async def agent_signature(api_key: ApiKey, prompt: Prompt):
+    """代理的构造签名，密钥池客户端、窗口配置、提示词或输出schema变化后缓存的代理需要重建"""
+    return (
+        await key_router.client(api_key), prompt.content, window_signature(api_key), structured_signature(prompt)
+    )
+
+
+async def acquire_agent(
+    db: AsyncSession,
+    lease: AgentLease,
+    conversation: Conversation,
+    api_key: ApiKey,
+    prompt: Prompt,
+    timer: Optional[StreamTimer] = None
+) -> AssistantAgent:
+    """获取对话代理：优先复用缓存中已加载状态的代理，未命中时从快照和增量加载"""
+    if lease.agent is not None:
+        if lease.signature == await agent_signature(api_key, prompt):
+            return lease.agent
+        # 配置已变化，沿用已加载的历史重建上下文和代理，无需回放状态
+        model_context = await build_model_context(api_key, prompt, lease.agent.model_context.all_messages())
+        with timed(timer, "create_agent"):
+            return await create_agent(api_key, prompt, model_context=model_context)
+
+    with timed(timer, "load_state"):
+        loaded = await state_store.load_state(db, conversation.id)
+    # 未合并的增量计入lease，由缓存择机写成快照
+    lease.pending_deltas = loaded.delta_count
+    lease.last_delta_id = loaded.last_delta_id
+    with timed(timer, "create_agent"):
+        return await create_agent(api_key, prompt, loaded.state)
+
+
+
+@dataclass
+class ReplyCacheLookup:
+    """本轮回复的缓存查询结果，content为命中的回复，info随完成结果返回"""
+    key: Optional[str] = None
+    ttl: Optional[int] = None
+    semantic: Optional[SemanticLookup] = None
+    content: Optional[str] = None
+    info: Optional[Dict] = None
+
+
+async def lookup_reply_cache(
+    agent: AssistantAgent,
+    api_key: ApiKey,
+    prompt: Prompt,
+    user_content: str,
+    base_offset: int
+) -> ReplyCacheLookup:
+    """按提示词配置查找本轮回复：先按完整请求精确匹配，未命中再按用户消息相似度匹配"""
+    cached = ReplyCacheLookup(ttl=cache_ttl(prompt))
+    if cached.ttl is not None:
+        cached.key = request_key(
+            api_key.model_name, prompt.content, await agent.model_context.get_messages(), user_content
+        )
+        cached.content = await response_cache.get(cached.key)
+        cached.info = {'type': 'exact', 'hit': cached.content is not None}
+
+    # 语义缓存默认只用于首轮对话
+    settings = semantic_config(prompt)
+    if (
+        cached.content is None
+        and settings.get("enabled")
+        and semantic_cache.available()
+        and (settings.get("any_turn") or base_offset == 0)
+    ):
+        cached.semantic = await semantic_cache.lookup(prompt, api_key.model_name, user_content)
+        cached.info = cached.semantic.info()
+        if cached.semantic.hit:
+            cached.content = cached.semantic.content
+    return cached
+
+
+async def apply_cached_reply(agent: AssistantAgent, user_content: str, content: str) -> None:
+    """命中缓存时不调用模型，本轮的用户消息和回复照常写入代理上下文"""
+    await agent.model_context.add_message(UserMessage(content=user_content, source="user"))
+    await agent.model_context.add_message(AssistantMessage(content=content, source="assistant"))
+
+
+async def store_reply_cache(
+    db: AsyncSession,
+    cached: ReplyCacheLookup,
+    api_key: ApiKey,
+    prompt: Prompt,
+    content: str
+) -> None:
+    """模型新生成的回复写入已启用的缓存：精确缓存随本轮事务加入后处理队列，语义索引直接写入内存"""
+    if cached.content is not None or not content:
+        return
+    if cached.key is not None:
+        await post_processor.enqueue(db, TASK_REPLY_CACHE, {
+            "key": cached.key, "model_name": api_key.model_name, "content": content, "ttl": cached.ttl
+        })
+    if cached.semantic is not None:
+        semantic_cache.store(prompt, api_key.model_name, cached.semantic, content)
+
+
+def reply_metadata(cached: Optional[ReplyCacheLookup], structured: Optional[Dict]) -> Optional[Dict]:
+    """助手消息的元数据：缓存命中情况和结构化输出的每次尝试记录"""
+    metadata = {}
+    if cached is not None and cached.info is not None:
+        metadata['cache'] = cached.info
+    if structured is not None:
+        metadata['structured'] = {'attempts': structured['attempts']}
+    return metadata or None
+
+
+async def structured_events(
+    engine: StructuredOutput,
+    agent: AssistantAgent,
+    task: str,
+    content: ContentBuffer,
+    checkpointer: StreamCheckpointer,
+    message_id: str
+):
+    """结构化输出的SSE事件：逐块推送每次尝试的内容，校验失败时推送attempt事件，客户端丢弃已收到的内容
+
+    最后产出engine的result事件，content替换为校验后的JSON。
+    """
+    async for event in engine.run(agent, task):
+        if event['type'] == 'chunk':
+            content.append(event['content'])
+            checkpointer.feed(content)
+        elif event['type'] == 'attempt' and not event['ok']:
+            content.clear()
+        elif event['type'] == 'result':
+            content.clear()
+            content.append(event['content'])
+            yield event
+            continue
+        yield {**event, 'message_id': message_id}
+
+
+def structured_payload(engine: Optional[StructuredOutput], structured: Optional[Dict], content: str) -> Optional[Dict]:
+    """返回给调用方的结构化结果，命中回复缓存时内容已在写入缓存前校验过"""
+    if engine is None:
+        return None
+    if structured is None:
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        return {'data': data, 'attempts': []}
+    return {'data': structured['data'], 'attempts': structured['attempts']}
+
 # ==================== 对话管理接口 ====================
 
 @router.get("/conversations/list", response_model=BaseResponse)
@@ -184,28 +391,14 @@ async def get_conversation_list(
         )
         conversations = result.scalars().all()
 
-        return BaseResponse(
-            code=200,
-            message="获取对话列表成功",
-            data={
-                "list": [
-                    {
-                        "id": conv.id,
-                        "uuid": conv.uuid,
-                        "title": conv.title,
-                        "description": conv.description,
-                        "group_id": conv.group_id,
-                        "message_count": conv.message_count,
-                        "status": conv.status,
-                        "created_at": conv.created_at.isoformat(),
-                        "updated_at": conv.updated_at.isoformat()
-                    }
-                    for conv in conversations
-                ],
+        return fast_response(
+            {
+                "list": CONVERSATION_ROW.many(conversations),
                 "total": total,
                 "pageNum": query.pageNum,
                 "pageSize": query.pageSize
-            }
+            },
+            message="获取对话列表成功"
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取对话列表失败: {str(e)}")
@@ -217,22 +410,7 @@ async def get_conversation_detail(chat_id: str, db: AsyncSession = Depends(get_d
     try:
         conversation = await get_conversation_by_uuid(db, chat_id)
 
-        return BaseResponse(
-            code=200,
-            message="获取对话详情成功",
-            data={
-                "id": conversation.id,
-                "uuid": conversation.uuid,
-                "title": conversation.title,
-                "description": conversation.description,
-                "group_id": conversation.group_id,
-                "config": conversation.config,
-                "message_count": conversation.message_count,
-                "status": conversation.status,
-                "created_at": conversation.created_at.isoformat(),
-                "updated_at": conversation.updated_at.isoformat()
-            }
-        )
+        return fast_response(CONVERSATION_DETAIL_ROW(conversation), message="获取对话详情成功")
     except HTTPException:
         raise
     except Exception as e:
@@ -332,27 +510,6 @@ async def update_conversation(
         raise HTTPException(status_code=500, detail=f"更新对话失败: {str(e)}")
 
 
-@router.delete("/conversations/{chat_id}", response_model=BaseResponse)
-async def delete_conversation(chat_id: str, db: AsyncSession = Depends(get_db)):
-    """删除对话"""
-    try:
-        conversation = await get_conversation_by_uuid(db, chat_id)
-        conversation.status = "deleted"
-
-        await db.commit()
-
-        return BaseResponse(
-            code=200,
-            message="对话删除成功",
-            data=None
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=f"删除对话失败: {str(e)}")
-
-
 @router.delete("/conversations/batch", response_model=BaseResponse)
 async def batch_delete_conversations(
     data: BatchDeleteChats,
@@ -362,13 +519,17 @@ async def batch_delete_conversations(
     try:
         # 更新状态为删除
         await db.execute(
-            select(Conversation)
+            update(Conversation)
             .where(Conversation.uuid.in_(data.ids))
-            .update({"status": "deleted"}, synchronize_session=False)
+            .values(status="deleted")
         )
 
         await db.commit()
 
+        # 删除提交后再丢弃缓存中的代理
+        for chat_id in data.ids:
+            await agent_cache.invalidate(chat_id)
+
         return BaseResponse(
             code=200,
             message=f"成功删除 {len(data.ids)} 个对话",
@@ -379,6 +540,29 @@ async def batch_delete_conversations(
         raise HTTPException(status_code=500, detail=f"批量删除对话失败: {str(e)}")
 
 
+@router.delete("/conversations/{chat_id}", response_model=BaseResponse)
+async def delete_conversation(chat_id: str, db: AsyncSession = Depends(get_db)):
+    """删除对话"""
+    try:
+        conversation = await get_conversation_by_uuid(db, chat_id)
+        conversation.status = "deleted"
+
+        await db.commit()
+        # 删除提交后再丢弃缓存中的代理
+        await agent_cache.invalidate(chat_id)
+
+        return BaseResponse(
+            code=200,
+            message="对话删除成功",
+            data=None
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"删除对话失败: {str(e)}")
+
+
 @router.delete("/conversations/{chat_id}/messages", response_model=BaseResponse)
 async def clear_conversation_messages(chat_id: str, db: AsyncSession = Depends(get_db)):
     """清空对话消息"""
@@ -387,16 +571,18 @@ async def clear_conversation_messages(chat_id: str, db: AsyncSession = Depends(g
 
         # 删除所有消息
         await db.execute(
-            select(Message)
+            update(Message)
             .where(Message.conversation_id == conversation.id)
-            .update({"status": "deleted"}, synchronize_session=False)
+            .values(status="deleted")
         )
 
-        # 重置消息计数和代理状态
+        # 重置消息计数和代理状态（快照与增量）
         conversation.message_count = 0
-        conversation.agent_state = None
+        await state_store.clear_state(db, conversation.id)
 
         await db.commit()
+        # 清空提交后再丢弃缓存中的代理；尚未写完的快照合并因增量已删除不会再写入
+        await agent_cache.invalidate(chat_id)
 
         return BaseResponse(
             code=200,
@@ -481,7 +667,7 @@ async def get_conversation_messages(
         # 构建查询条件
         conditions = [
             Message.conversation_id == conversation.id,
-            Message.status == "active"
+            Message.status.in_(MESSAGE_VISIBLE_STATUSES)
         ]
 
         if query.message_type:
@@ -504,29 +690,14 @@ async def get_conversation_messages(
         )
         messages = result.scalars().all()
 
-        return BaseResponse(
-            code=200,
-            message="获取消息列表成功",
-            data={
-                "list": [
-                    {
-                        "id": msg.id,
-                        "uuid": msg.uuid,
-                        "role": msg.role,
-                        "content": msg.content,
-                        "message_type": msg.message_type,
-                        "message_metadata": msg.message_metadata,
-                        "token_count": msg.token_count,
-                        "character_count": msg.character_count,
-                        "created_at": msg.created_at.isoformat(),
-                        "updated_at": msg.updated_at.isoformat()
-                    }
-                    for msg in messages
-                ],
+        return fast_response(
+            {
+                "list": MESSAGE_ROW.many(messages),
                 "total": total,
                 "pageNum": query.pageNum,
                 "pageSize": query.pageSize
-            }
+            },
+            message="获取消息列表成功"
         )
     except HTTPException:
         raise
@@ -534,53 +705,149 @@ async def get_conversation_messages(
         raise HTTPException(status_code=500, detail=f"获取消息列表失败: {str(e)}")
 
 
+async def generate_reply(db: AsyncSession, conversation: Conversation, data: MessageCreate) -> BaseResponse:
+    """非流式生成：与流式接口共用准入、代理缓存、回复缓存和状态增量
+
+    排队和生成都计入截止时间，超时返回504，代理上下文回滚到本轮开始前。
+    用户消息和回复在同一个事务中写入，失败时两者都不保存。
+    """
+    api_key = await get_api_key_by_id(db, conversation.api_key_id)
+    prompt = await get_prompt_by_id(db, conversation.prompt_id)
+    try:
+        ticket = admission.admit(api_key)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    deadline = data.timeout or REPLY_DEADLINE_SECONDS
+    lease = None
+    agent = None
+    signature = None
+    base_offset = None
+    completed = False
+    try:
+        async with asyncio.timeout(deadline):
+            async for _ in ticket.wait():
+                pass
+
+            lease = await agent_cache.checkout(conversation.uuid, conversation.id)
+            agent = await acquire_agent(db, lease, conversation, api_key, prompt)
+            signature = await agent_signature(api_key, prompt)
+            base_offset = state_store.context_size(agent)
+
+            cached = await lookup_reply_cache(agent, api_key, prompt, data.content, base_offset)
+            structured = None
+            engine = StructuredOutput.from_prompt(prompt)
+            if cached.content is not None:
+                await apply_cached_reply(agent, data.content, cached.content)
+                reply = cached.content
+            elif engine is not None:
+                # 结构化输出：校验失败或超时按退避重试，最终结果为通过校验的JSON
+                async for event in engine.run(agent, data.content):
+                    if event['type'] == 'result':
+                        structured = event
+                reply = structured['content']
+            else:
+                result = await agent.run(task=data.content)
+                reply = result.messages[-1].to_text()
+
+        user_tokens, reply_tokens = await tokenizer.acount_batch([data.content, reply], api_key.model_name)
+        user_message = Message(
+            uuid=str(uuid.uuid4()),
+            conversation_id=conversation.id,
+            role="user",
+            content=data.content,
+            message_type=data.message_type,
+            message_metadata=data.message_metadata,
+            token_count=user_tokens,
+            character_count=len(data.content)
+        )
+        assistant_message = Message(
+            uuid=str(uuid.uuid4()),
+            conversation_id=conversation.id,
+            role="assistant",
+            content=reply,
+            message_type="text",
+            message_metadata=reply_metadata(cached, structured),
+            token_count=reply_tokens,
+            character_count=len(reply),
+            status=MESSAGE_STATUS_ACTIVE,
+            context_offset=base_offset
+        )
+        db.add(user_message)
+        db.add(assistant_message)
+        conversation.message_count += 1
+        delta_id = await state_store.append_delta(db, conversation.id, agent, base_offset)
+        lease.record_delta(delta_id)
+        await store_reply_cache(db, cached, api_key, prompt, reply)
+        await db.commit()
+        completed = True
+        post_processor.notify()
+        await db.refresh(assistant_message)
+
+        # 首轮回复完成后在后台生成标题，这里只入队
+        if is_default_title(conversation.title):
+            title_queue.enqueue(conversation.id)
+
+        return BaseResponse(
+            code=200,
+            message="消息发送成功",
+            data={
+                "message_id": user_message.uuid,
+                "reply_id": assistant_message.uuid,
+                "content": reply,
+                "token_count": reply_tokens,
+                "cached": cached.content is not None,
+                "cache": cached.info,
+                "structured": structured_payload(engine, structured, reply),
+                "created_at": assistant_message.created_at.isoformat()
+            }
+        )
+    except TimeoutError:
+        await db.rollback()
+        raise HTTPException(status_code=504, detail=f"生成超时（{deadline}秒）")
+    except StructuredOutputError as e:
+        await db.rollback()
+        raise HTTPException(status_code=502, detail=str(e))
+    finally:
+        ticket.release()
+        # 未完成的轮次没有写入增量，上下文回滚后归还代理
+        if agent is not None:
+            if not completed and base_offset is not None:
+                agent.model_context.truncate(base_offset)
+            agent_cache.checkin(lease, agent, signature)
+
+
 @router.post("/messages", response_model=BaseResponse)
 async def send_chat_message(
     data: MessageCreate,
     db: AsyncSession = Depends(get_db)
 ):
-    """发送消息"""
+    """发送消息：非流式时在截止时间内生成回复并一并返回"""
     try:
         conversation = await get_conversation_by_uuid(db, data.chat_id)
 
-        # 创建用户消息
-        user_message_uuid = str(uuid.uuid4())
+        if not data.stream:
+            return await generate_reply(db, conversation, data)
+
+        # 流式对话走SSE接口，这里只保存用户消息
+        model_name = await get_conversation_model_name(db, conversation)
         user_message = Message(
-            uuid=user_message_uuid,
+            uuid=str(uuid.uuid4()),
             conversation_id=conversation.id,
             role="user",
             content=data.content,
             message_type=data.message_type,
             message_metadata=data.message_metadata,
+            token_count=await tokenizer.acount(data.content, model_name),
             character_count=len(data.content)
         )
-
         db.add(user_message)
-        await db.flush()
-
-        # 如果不是流式响应，直接生成回复
-        if not data.stream:
-            # 这里可以添加非流式的AI回复逻辑
-            # 暂时返回用户消息
-            await db.commit()
-
-            return BaseResponse(
-                code=200,
-                message="消息发送成功",
-                data={
-                    "message_id": user_message.uuid,
-                    "content": user_message.content,
-                    "created_at": user_message.created_at.isoformat()
-                }
-            )
-        else:
-            # 流式响应需要通过WebSocket处理
-            await db.commit()
-            return BaseResponse(
-                code=200,
-                message="请使用WebSocket进行流式对话",
-                data={"message_id": user_message.uuid}
-            )
+        await db.commit()
+        return BaseResponse(
+            code=200,
+            message="请使用 /chat/messages/stream 进行流式对话",
+            data={"message_id": user_message.uuid}
+        )
 
     except HTTPException:
         raise
@@ -596,7 +863,11 @@ async def delete_message(message_id: str, db: AsyncSession = Depends(get_db)):
         message = await get_message_by_uuid(db, message_id)
         message.status = "deleted"
 
+        conversation = await get_conversation_by_id(db, message.conversation_id)
+
         await db.commit()
+        # 提交后再失效：快照由缓存用独立会话写入，提交前写入会等待本会话持有的写锁
+        await agent_cache.invalidate(conversation.uuid, persist=True)
 
         return BaseResponse(
             code=200,
@@ -620,10 +891,15 @@ async def edit_message(
     try:
         message = await get_message_by_uuid(db, message_id)
 
+        conversation = await get_conversation_by_id(db, message.conversation_id)
+        model_name = await get_conversation_model_name(db, conversation)
+
         message.content = data.content
         message.character_count = len(data.content)
+        message.token_count = await tokenizer.acount(data.content, model_name)
 
         await db.commit()
+        await agent_cache.invalidate(conversation.uuid, persist=True)
         await db.refresh(message)
 
         return BaseResponse(
@@ -647,13 +923,11 @@ async def edit_message(
 
 @router.post("/terminate")
 async def terminate_all_chats():
-    """终止所有SSE流式任务"""
-    cancelled_count = 0
-    for task_id, task in list(active_sse_tasks.items()):
-        if task and not task.cancelled():
-            task.cancel()
-            cancelled_count += 1
-        del active_sse_tasks[task_id]
+    """终止所有SSE流式任务，其他工作进程的任务通过注册表通知取消"""
+    try:
+        cancelled_count = generation_jobs.cancel_all() + await task_registry.request_cancel_all()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"终止流式任务失败: {str(e)}")
 
     return BaseResponse(
         code=200,
@@ -704,25 +978,11 @@ async def get_chat_groups(
                 )
                 conversations = conv_result.scalars().all()
 
-                group_info["conversations"] = [
-                    {
-                        "id": conv.id,
-                        "uuid": conv.uuid,
-                        "title": conv.title,
-                        "message_count": conv.message_count,
-                        "created_at": conv.created_at.isoformat(),
-                        "updated_at": conv.updated_at.isoformat()
-                    }
-                    for conv in conversations
-                ]
+                group_info["conversations"] = CONVERSATION_BRIEF_ROW.many(conversations)
 
             group_data.append(group_info)
 
-        return BaseResponse(
-            code=200,
-            message="获取分组列表成功",
-            data=group_data
-        )
+        return fast_response(group_data, message="获取分组列表成功")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取分组列表失败: {str(e)}")
 
@@ -889,23 +1149,11 @@ async def search_chats(
             )
             conversations = conv_result.scalars().all()
 
-            results["conversations"] = [
-                {
-                    "id": conv.id,
-                    "uuid": conv.uuid,
-                    "title": conv.title,
-                    "description": conv.description,
-                    "group_id": conv.group_id,
-                    "message_count": conv.message_count,
-                    "created_at": conv.created_at.isoformat(),
-                    "updated_at": conv.updated_at.isoformat()
-                }
-                for conv in conversations
-            ]
+            results["conversations"] = CONVERSATION_SEARCH_ROW.many(conversations)
 
         if query.type in ["all", "message"]:
             # 搜索消息
-            conditions = [Message.status == "active"]
+            conditions = [Message.status.in_(MESSAGE_VISIBLE_STATUSES)]
 
             if query.keyword:
                 conditions.append(Message.content.contains(query.keyword))
@@ -921,24 +1169,9 @@ async def search_chats(
             )
             messages = msg_result.scalars().all()
 
-            results["messages"] = [
-                {
-                    "id": msg.id,
-                    "uuid": msg.uuid,
-                    "conversation_id": msg.conversation_id,
-                    "role": msg.role,
-                    "content": msg.content,
-                    "message_type": msg.message_type,
-                    "created_at": msg.created_at.isoformat()
-                }
-                for msg in messages
-            ]
+            results["messages"] = MESSAGE_SEARCH_ROW.many(messages)
 
-        return BaseResponse(
-            code=200,
-            message="搜索完成",
-            data=results
-        )
+        return fast_response(results, message="搜索完成")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索失败: {str(e)}")
 
@@ -972,12 +1205,42 @@ async def generate_chat_title(data: GenerateTitleRequest):
 
 
 
-@router.post("/messages/regenerate", response_model=BaseResponse)
+def regenerate_offset(
+    agent: AssistantAgent,
+    context_offset: Optional[int],
+    status: str,
+    content: str
+) -> Optional[int]:
+    """目标回复所在轮次开始前的上下文位置，无法确定时返回None"""
+    size = state_store.context_size(agent)
+    if context_offset is not None:
+        return context_offset if context_offset <= size else None
+    if status == MESSAGE_STATUS_PARTIAL:
+        # 中断的轮次没有写入上下文
+        return size
+    # 早期的消息没有记录位置，上下文末尾正好是该轮的用户消息和回复时按末尾推算
+    tail = agent.model_context.all_messages()[-2:]
+    if (
+        len(tail) == 2
+        and isinstance(tail[0], UserMessage)
+        and isinstance(tail[1], AssistantMessage)
+        and tail[1].content == content
+    ):
+        return size - 2
+    return None
+
+
+@router.post("/messages/regenerate")
 async def regenerate_message(
     data: MessageRegenerate,
     db: AsyncSession = Depends(get_db)
 ):
-    """重新生成消息"""
+    """重新生成最近一轮的回复（Server-Sent Events）
+
+    代理上下文回滚到该轮开始前，用同一条用户消息重新生成；新回复与原回复是同一消息的
+    不同版本，原回复标记为alternate保留。缓存中的代理直接截断，无需重放历史。
+    """
+    ticket = None
     try:
         conversation = await get_conversation_by_uuid(db, data.chat_id)
         message = await get_message_by_uuid(db, data.message_id)
@@ -985,184 +1248,513 @@ async def regenerate_message(
         # 验证消息属于该对话
         if message.conversation_id != conversation.id:
             raise HTTPException(status_code=400, detail="消息不属于该对话")
-
-        # 这里可以添加实际的重新生成逻辑
-        # 暂时返回成功响应
-        return BaseResponse(
-            code=200,
-            message="消息重新生成成功",
-            data={
-                "message_id": message.uuid,
-                "new_content": "重新生成的内容",
-                "regenerated_at": datetime.now().isoformat()
-            }
+        if message.role != "assistant" or message.status not in (MESSAGE_STATUS_ACTIVE, MESSAGE_STATUS_PARTIAL):
+            raise HTTPException(status_code=400, detail="只能重新生成已完成或中断的助手回复")
+
+        visible = [Message.conversation_id == conversation.id, Message.status.in_(MESSAGE_VISIBLE_STATUSES)]
+        latest_id = await db.scalar(select(func.max(Message.id)).where(*visible))
+        if latest_id != message.id:
+            raise HTTPException(status_code=409, detail="只能重新生成最近一轮的回复")
+        user_message = await db.scalar(
+            select(Message)
+            .where(*visible, Message.role == "user", Message.id < message.id)
+            .order_by(Message.id.desc())
+            .limit(1)
         )
+        if user_message is None:
+            raise HTTPException(status_code=400, detail="找不到该回复对应的用户消息")
+
+        api_key = await get_api_key_by_id(db, conversation.api_key_id)
+        try:
+            ticket = admission.admit(api_key)
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+        task_id = str(uuid.uuid4())
+        target_uuid = message.uuid
+        target_offset = message.context_offset
+        target_status = message.status
+        target_content = message.content
+        user_content = user_message.content
+        # 所有版本都指向首个版本
+        root_uuid = message.parent_uuid or message.uuid
+
+        version_uuid = str(uuid.uuid4())
+        db.add(Message(
+            uuid=version_uuid,
+            conversation_id=conversation.id,
+            role="assistant",
+            content="",
+            message_type="text",
+            character_count=0,
+            status=MESSAGE_STATUS_STREAMING,
+            parent_uuid=root_uuid
+        ))
+        await db.commit()
+
+        # 新版本已生成的内容，同时作为续传时resync的快照
+        content = ContentBuffer()
+
+        async def generate():
+            from database import AsyncSessionLocal
+            async with AsyncSessionLocal() as gen_db:
+                lease = None
+                agent = None
+                signature = None
+                base_offset = None
+                previous = None
+                # 中断的新版本保留为alternate，原回复仍是当前版本
+                checkpointer = StreamCheckpointer.from_config(
+                    version_uuid, conversation.config, abandon_status=MESSAGE_STATUS_ALTERNATE
+                )
+                completed = False
+                try:
+                    conversation_obj = (await gen_db.execute(
+                        select(Conversation)
+                        .options(defer(Conversation.agent_state))
+                        .where(Conversation.uuid == data.chat_id)
+                    )).scalar_one()
+
+                    async for position in ticket.wait():
+                        yield {'type': 'queued', 'position': position, 'message_id': version_uuid}
+                    yield {'type': 'assistant_start', 'message_id': version_uuid, 'parent_id': root_uuid, 'replaces': target_uuid}
+
+                    api_key = await get_api_key_by_id(gen_db, conversation_obj.api_key_id)
+                    prompt = await get_prompt_by_id(gen_db, conversation_obj.prompt_id)
+                    lease = await agent_cache.checkout(conversation_obj.uuid, conversation_obj.id)
+                    agent = await acquire_agent(gen_db, lease, conversation_obj, api_key, prompt)
+                    signature = await agent_signature(api_key, prompt)
+
+                    # 回滚到该轮开始前，保留原来的上下文以便失败时恢复
+                    base_offset = regenerate_offset(agent, target_offset, target_status, target_content)
+                    if base_offset is None:
+                        raise ValueError("无法确定该回复在上下文中的位置")
+                    previous = agent.model_context.tail(base_offset)
+                    agent.model_context.truncate(base_offset)
+
+                    # 重新生成不使用回复缓存
+                    structured = None
+                    engine = StructuredOutput.from_prompt(prompt)
+                    if engine is not None:
+                        async for event in structured_events(
+                            engine, agent, user_content, content, checkpointer, version_uuid
+                        ):
+                            if event['type'] == 'result':
+                                structured = event
+                            else:
+                                yield event
+                    else:
+                        coalescer = ChunkCoalescer.from_config(conversation_obj.config, enabled=data.coalesce)
+                        chunks = model_text_chunks(agent.run_stream(task=user_content))
+                        async for content_chunk in coalescer.stream(chunks):
+                            content.append(content_chunk)
+                            checkpointer.feed(content)
+                            yield {'type': 'chunk', 'content': content_chunk, 'message_id': version_uuid}
+
+                    full_content = content.text()
+
+                    yield {
+                        'type': 'complete',
+                        'message_id': version_uuid,
+                        'parent_id': root_uuid,
+                        'replaces': target_uuid,
+                        'content': full_content,
+                        'structured': structured_payload(engine, structured, full_content)
+                    }
+                    await checkpointer.close()
+
+                    # 新版本成为当前版本，原回复转为alternate，上下文增量覆盖原来的一轮
+                    await gen_db.execute(
+                        update(Message)
+                        .where(Message.uuid == version_uuid)
+                        .values(
+                            content=full_content,
+                            character_count=len(full_content),
+                            status=MESSAGE_STATUS_ACTIVE,
+                            context_offset=base_offset,
+                            message_metadata=reply_metadata(None, structured)
+                        )
+                    )
+                    await gen_db.execute(
+                        update(Message).where(Message.uuid == target_uuid).values(status=MESSAGE_STATUS_ALTERNATE)
+                    )
+                    delta_id = await state_store.append_delta(gen_db, conversation_obj.id, agent, base_offset)
+                    lease.record_delta(delta_id)
+                    await post_processor.enqueue(gen_db, TASK_MESSAGE_TOKENS, {
+                        "message_uuids": [version_uuid], "model_name": api_key.model_name
+                    })
+                    await gen_db.commit()
+                    completed = True
+                    post_processor.notify()
+
+                except asyncio.CancelledError:
+                    checkpointer.abandon(content.text())
+                    yield {'type': 'cancelled', 'message': '重新生成已被取消'}
+                    raise
+                except StructuredOutputError as e:
+                    await gen_db.rollback()
+                    yield {'type': 'error', 'message': str(e), 'attempts': [asdict(a) for a in e.attempts]}
+                except Exception as e:
+                    print(f"重新生成失败: {str(e)}")
+                    await gen_db.rollback()
+                    yield {'type': 'error', 'message': f'重新生成失败: {str(e)}'}
+                finally:
+                    ticket.release()
+                    if not completed:
+                        checkpointer.abandon(content.text())
+                    if agent is not None:
+                        # 未完成时恢复原回复所在的上下文，与数据库中的状态保持一致
+                        if not completed and previous is not None:
+                            agent.model_context.replace_tail(base_offset, *previous)
+                        agent_cache.checkin(lease, agent, signature)
+
+        job = generation_jobs.start(task_id, generate(), conversation.uuid, version_uuid, snapshot=content.text)
+        job.task.add_done_callback(lambda _: ticket.release())
+        await task_registry.track(job)
+
+        return sse_response(job.subscribe(), task_id)
 
     except HTTPException:
         raise
     except Exception as e:
+        await db.rollback()
+        if ticket is not None:
+            ticket.release()
         raise HTTPException(status_code=500, detail=f"重新生成消息失败: {str(e)}")
 
 
+@router.get("/messages/{message_id}/versions", response_model=BaseResponse)
+async def get_message_versions(message_id: str, db: AsyncSession = Depends(get_db)):
+    """获取回复的全部版本，按生成顺序排列，status为active的是当前版本"""
+    try:
+        message = await get_message_by_uuid(db, message_id)
+        root_uuid = message.parent_uuid or message.uuid
+        result = await db.execute(
+            select(Message)
+            .where(
+                or_(Message.uuid == root_uuid, Message.parent_uuid == root_uuid),
+                Message.status != "deleted"
+            )
+            .order_by(Message.id.asc())
+        )
+        versions = result.scalars().all()
+
+        return fast_response(
+            {"parent_id": root_uuid, "list": MESSAGE_VERSION_ROW.many(versions)},
+            message="获取消息版本成功"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取消息版本失败: {str(e)}")
+
+
 @router.post("/messages/stream")
 async def stream_message(
     data: MessageCreate,
     db: AsyncSession = Depends(get_db)
 ):
     """流式消息接口（Server-Sent Events）"""
+    ticket = None
     try:
         conversation = await get_conversation_by_uuid(db, data.chat_id)
 
+        # 按ApiKey申请并发名额，等待队列已满时直接拒绝，不创建消息
+        api_key = await get_api_key_by_id(db, conversation.api_key_id)
+        # 各阶段耗时按ApiKey和模型记录到/metrics
+        timer = StreamTimer(api_key.id, api_key.model_name)
+        try:
+            ticket = admission.admit(api_key)
+        except AdmissionRejected as e:
+            timer.error("rejected")
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
         # 生成任务ID
         task_id = str(uuid.uuid4())
 
-        # 创建用户消息
-        user_message_uuid = str(uuid.uuid4())
-        user_message = Message(
-            uuid=user_message_uuid,
-            conversation_id=conversation.id,
-            role="user",
-            content=data.content,
-            message_type=data.message_type,
-            message_metadata=data.message_metadata,
-            character_count=len(data.content)
-        )
+        # 用户消息的Token数在写入时计算，生成失败或被取消时也不会停留在0
+        user_tokens = await tokenizer.acount(data.content, api_key.model_name)
+
+        with timer.phase("db_insert"):
+            # 创建用户消息
+            user_message_uuid = str(uuid.uuid4())
+            user_message = Message(
+                uuid=user_message_uuid,
+                conversation_id=conversation.id,
+                role="user",
+                content=data.content,
+                message_type=data.message_type,
+                message_metadata=data.message_metadata,
+                character_count=len(data.content),
+                token_count=user_tokens
+            )
 
-        db.add(user_message)
-        await db.flush()
+            db.add(user_message)
+            await db.flush()
+
+            # 创建助手消息
+            assistant_message_uuid = str(uuid.uuid4())
+            assistant_message = Message(
+                uuid=assistant_message_uuid,
+                conversation_id=conversation.id,
+                role="assistant",
+                content="",
+                message_type="text",
+                character_count=0,
+                status=MESSAGE_STATUS_STREAMING
+            )
 
-        # 创建助手消息
-        assistant_message_uuid = str(uuid.uuid4())
-        assistant_message = Message(
-            uuid=assistant_message_uuid,
-            conversation_id=conversation.id,
-            role="assistant",
-            content="",
-            message_type="text",
-            character_count=0
-        )
+            db.add(assistant_message)
+            await db.flush()
 
-        db.add(assistant_message)
-        await db.flush()
-        
+            # 先提交用户消息和初始助手消息
+            await db.commit()
 
-        # 先提交用户消息和初始助手消息
-        await db.commit()
+        # 已生成的内容，同时作为续传时resync的快照
+        content = ContentBuffer()
 
         async def generate():
             # 在生成器内部创建新的数据库会话
             from database import AsyncSessionLocal
             async with AsyncSessionLocal() as gen_db:
+                lease = None
+                agent = None
+                signature = None
+                base_offset = None
+                # 已生成的内容定期写入检查点，未完成时保存为partial
+                checkpointer = StreamCheckpointer.from_config(assistant_message_uuid, conversation.config)
+                completed = False
+                timer.active()
                 try:
-                    # 重新获取对话和消息对象
-                    conversation_obj = await get_conversation_by_uuid(gen_db, data.chat_id)
-                    assistant_msg_result = await gen_db.execute(
-                        select(Message).where(Message.uuid == assistant_message_uuid)
-                    )
-                    assistant_message_obj = assistant_msg_result.scalar_one()
+                    # 重新获取对话和消息对象，agent_state只在缓存未命中时才加载
+                    with timer.phase("refetch"):
+                        conversation_result = await gen_db.execute(
+                            select(Conversation)
+                            .options(defer(Conversation.agent_state))
+                            .where(Conversation.uuid == data.chat_id)
+                        )
+                        conversation_obj = conversation_result.scalar_one()
+                        assistant_msg_result = await gen_db.execute(
+                            select(Message).where(Message.uuid == assistant_message_uuid)
+                        )
+                        assistant_message_obj = assistant_msg_result.scalar_one()
                     
                     # 发送用户消息确认
-                    yield f"data: {json.dumps({'type': 'user_message', 'content': data.content, 'message_id': user_message_uuid})}\n\n"
+                    yield {'type': 'user_message', 'content': data.content, 'message_id': user_message_uuid}
+
+                    # 排队等待ApiKey的并发名额，位置变化时推送queued事件
+                    with timer.phase("queue"):
+                        async for position in ticket.wait():
+                            yield {'type': 'queued', 'position': position, 'message_id': assistant_message_uuid}
 
                     # 发送助手消息开始标识
-                    yield f"data: {json.dumps({'type': 'assistant_start', 'message_id': assistant_message_uuid})}\n\n"
+                    yield {'type': 'assistant_start', 'message_id': assistant_message_uuid}
 
                     # 获取API密钥和提示词
-                    api_key = await get_api_key_by_id(gen_db, conversation_obj.api_key_id)
-                    prompt = await get_prompt_by_id(gen_db, conversation_obj.prompt_id)
-
-                    # 创建代理
-                    agent = await create_agent(api_key, prompt, conversation_obj.agent_state)
-
-                    # 流式生成回复
-                    full_content = ""
-                    async for chunk in agent.run_stream(task=data.content):
-                        # 检查是否被取消
-                        if task_id in active_sse_tasks:
-                            current_task = active_sse_tasks[task_id]
-                            if current_task.cancelled():
-                                yield f"data: {json.dumps({'type': 'cancelled', 'message': '生成已被取消'})}\n\n"
-                                break
-
-                        if hasattr(chunk, 'content') and chunk.content and chunk.type == "ModelClientStreamingChunkEvent":
-                            content_chunk = chunk.content
-                            full_content += content_chunk
-                            yield f"data: {json.dumps({'type': 'chunk', 'content': content_chunk, 'message_id': assistant_message_uuid})}\n\n"
+                    with timer.phase("lookup"):
+                        api_key = await get_api_key_by_id(gen_db, conversation_obj.api_key_id)
+                        prompt = await get_prompt_by_id(gen_db, conversation_obj.prompt_id)
+
+                    # 借出缓存中的代理，未命中时从数据库加载状态
+                    lease = await agent_cache.checkout(conversation_obj.uuid, conversation_obj.id)
+                    agent = await acquire_agent(gen_db, lease, conversation_obj, api_key, prompt, timer)
+                    signature = await agent_signature(api_key, prompt)
+                    base_offset = state_store.context_size(agent)
+
+                    # 提示词开启了回复缓存时，按实际发送给模型的内容查找相同请求的回复
+                    cached = await lookup_reply_cache(agent, api_key, prompt, data.content, base_offset)
+                    structured = None
+                    engine = StructuredOutput.from_prompt(prompt)
+
+                    if cached.content is not None:
+                        # 命中缓存：本轮对话照常写入上下文，内容切分后按分片回放
+                        await apply_cached_reply(agent, data.content, cached.content)
+                        for content_chunk in replay_chunks(cached.content):
+                            content.append(content_chunk)
+                            yield {'type': 'chunk', 'content': content_chunk, 'message_id': assistant_message_uuid}
+                    elif engine is not None:
+                        # 结构化输出：校验失败或超时按退避重试
+                        timer.start_generation()
+                        async for event in structured_events(
+                            engine, agent, data.content, content, checkpointer, assistant_message_uuid
+                        ):
+                            if event['type'] == 'result':
+                                structured = event
+                            else:
+                                if event['type'] == 'chunk':
+                                    timer.chunk()
+                                yield event
+                    else:
+                        # 流式生成回复，分片按时间/大小窗口合并后推送
+                        coalescer = ChunkCoalescer.from_config(conversation_obj.config, enabled=data.coalesce)
+                        timer.start_generation()
+                        async for content_chunk in coalescer.stream(model_text_chunks(agent.run_stream(task=data.content))):
+                            timer.chunk()
+                            content.append(content_chunk)
+                            checkpointer.feed(content)
+                            yield {'type': 'chunk', 'content': content_chunk, 'message_id': assistant_message_uuid}
+
+                    full_content = content.text()
+                    generation_seconds = timer.generation_seconds()
+
+                    # 内容已确定，先发送完成信号；之后的写入不再接受取消
+                    yield {
+                        'type': 'complete',
+                        'message_id': assistant_message_uuid,
+                        'content': full_content,
+                        'cached': cached.content is not None,
+                        'cache': cached.info,
+                        'structured': structured_payload(engine, structured, full_content)
+                    }
+                    await checkpointer.close()
 
                     # 更新助手消息内容
                     assistant_message_obj.content = full_content
                     assistant_message_obj.character_count = len(full_content)
-
-                    # 更新对话消息计数
-                    conversation_obj.message_count += 1  # 只增加1，因为用户消息已经计数了
-
-                    # 保存代理状态
-                    try:
-                        state = await agent.save_state()
-                        print(f"代理状态: {state}")
-                        conversation_obj.agent_state = state
-                    except Exception as e:
-                        print(f"保存代理状态失败: {e}")
-                        # 即使状态保存失败，也要保存消息内容
+                    assistant_message_obj.status = MESSAGE_STATUS_ACTIVE
+                    assistant_message_obj.context_offset = base_offset
+                    assistant_message_obj.message_metadata = reply_metadata(cached, structured)
+
+                    # 只追加本轮新增的上下文，快照由缓存择机合并
+                    with timer.phase("save_state"):
+                        delta_id = await state_store.append_delta(gen_db, conversation_obj.id, agent, base_offset)
+                        lease.record_delta(delta_id)
+
+                    # 回复的Token计数、消息计数和缓存写入随本轮事务加入后处理队列，生成速度在计数后记录
+                    await post_processor.enqueue(gen_db, TASK_MESSAGE_TOKENS, {
+                        "message_uuids": [assistant_message_uuid],
+                        "model_name": api_key.model_name,
+                        "throughput": generation_seconds and {
+                            "message_uuid": assistant_message_uuid,
+                            "seconds": generation_seconds,
+                            "api_key_id": api_key.id
+                        }
+                    })
+                    # 只增加1，因为用户消息已经计数了
+                    await post_processor.enqueue(gen_db, TASK_CONVERSATION_STATS, {
+                        "conversation_id": conversation_obj.id, "messages": 1
+                    })
+                    await store_reply_cache(gen_db, cached, api_key, prompt, full_content)
 
                     # 提交所有更改
-                    await gen_db.commit()
-                    print(f"数据库提交成功，消息内容长度: {len(full_content)}")
-
-                    # 发送完成信号
-                    yield f"data: {json.dumps({'type': 'complete', 'message_id': assistant_message_uuid, 'content': full_content})}\n\n"
+                    with timer.phase("commit"):
+                        await gen_db.commit()
+                    completed = True
+                    post_processor.notify()
+
+                    # 首轮回复完成后在后台生成标题，这里只入队
+                    if is_default_title(conversation_obj.title):
+                        title_queue.enqueue(conversation_obj.id)
                     
                 except asyncio.CancelledError:
-                    yield f"data: {json.dumps({'type': 'cancelled', 'message': '生成已被取消'})}\n\n"
+                    timer.error("cancelled")
+                    checkpointer.abandon(content.text())
+                    yield {'type': 'cancelled', 'message': '生成已被取消'}
                     raise
+                except StructuredOutputError as e:
+                    timer.error("structured")
+                    await gen_db.rollback()
+                    yield {'type': 'error', 'message': str(e), 'attempts': [asdict(a) for a in e.attempts]}
                 except Exception as e:
                     print(f"生成失败: {str(e)}")
-                    await db.rollback()
-                    yield f"data: {json.dumps({'type': 'error', 'message': f'生成失败: {str(e)}'})}\n\n"
+                    timer.error("error")
+                    await gen_db.rollback()
+                    yield {'type': 'error', 'message': f'生成失败: {str(e)}'}
                 finally:
-                    # 清理任务
-                    if task_id in active_sse_tasks:
-                        del active_sse_tasks[task_id]
-
-        # 创建并存储任务
-        task = asyncio.create_task(generate().__anext__())
-        active_sse_tasks[task_id] = task
-
-        return StreamingResponse(
-            generate(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "*",
-                "X-Task-ID": task_id  # 返回任务ID给前端
-            }
+                    ticket.release()
+                    timer.inactive()
+
+                    # 取消、失败或客户端断开时保留已生成的部分内容
+                    if not completed:
+                        checkpointer.abandon(content.text())
+
+                    # 归还代理，下一轮直接复用已加载的上下文；未完成的轮次没有写入增量，上下文回滚到本轮开始前
+                    if agent is not None:
+                        if not completed and base_offset is not None:
+                            agent.model_context.truncate(base_offset)
+                        agent_cache.checkin(lease, agent, signature)
+
+        # 生成在后台任务中运行，响应只是其中一个订阅者，断线后可凭任务ID续传
+        job = generation_jobs.start(
+            task_id, generate(), conversation.uuid, assistant_message_uuid, snapshot=content.text
         )
+        # 任务在生成器开始前就被取消时也要归还名额
+        job.task.add_done_callback(lambda _: ticket.release())
+        await task_registry.track(job)
+
+        return sse_response(job.subscribe(), task_id)
 
     except HTTPException:
         raise
     except Exception as e:
         await db.rollback()
+        if ticket is not None:
+            ticket.release()
         raise HTTPException(status_code=500, detail=f"流式消息失败: {str(e)}")
 
 
+@router.get("/messages/stream/resume")
+async def resume_stream_message(
+    task_id: str = Query(..., description="任务ID"),
+    last_event_id: Optional[int] = Query(None, description="已收到的最后一个事件ID"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """断线续传：重放Last-Event-ID之后的事件，然后继续跟随生成"""
+    job = generation_jobs.get(task_id)
+    if job is None:
+        # 事件缓冲区只在所属进程内存中，其他进程的任务无法在这里续传
+        if await task_registry.get(task_id):
+            raise HTTPException(status_code=409, detail="任务由其他工作进程处理，无法在当前进程续传")
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header) if last_event_id_header else 0
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID格式错误")
+
+    return sse_response(job.subscribe(last_event_id), task_id)
+
+
+@router.get("/messages/stream/status", response_model=BaseResponse)
+async def get_stream_status(
+    task_id: str = Query(..., description="任务ID")
+):
+    """查询流式生成任务状态，本进程没有时查询共享注册表"""
+    job = generation_jobs.get(task_id)
+    if job is not None:
+        data = {**job.info(), "owner": task_registry.worker_id}
+    else:
+        data = await task_registry.get(task_id)
+        if data is None:
+            raise HTTPException(status_code=404, detail="任务不存在或已过期")
+
+    return BaseResponse(
+        code=200,
+        message="获取任务状态成功",
+        data=data
+    )
+
+
 @router.post("/messages/stream/cancel")
 async def cancel_stream_message(
     task_id: str = Query(..., description="任务ID")
 ):
     """取消流式消息生成"""
     try:
-        if task_id in active_sse_tasks:
-            task = active_sse_tasks[task_id]
-            task.cancel()
-            del active_sse_tasks[task_id]
-
+        if generation_jobs.cancel(task_id):
             return BaseResponse(
                 code=200,
                 message="流式生成已取消",
                 data={"task_id": task_id}
             )
+        elif await task_registry.request_cancel(task_id):
+            # 任务属于其他工作进程，由其轮询到取消标记后取消
+            return BaseResponse(
+                code=200,
+                message="已通知所属进程取消流式生成",
+                data={"task_id": task_id}
+            )
         else:
             return BaseResponse(
                 code=404,
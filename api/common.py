@@ -13,7 +13,8 @@ from schemas import (
     OverviewStats,
     StatisticsResponse,
     BaseResponse,
-    SuccessResponse
+    SuccessResponse,
+    fast_response
 )
 
 router = APIRouter(prefix="/chat", tags=["公共接口"])
@@ -37,7 +38,7 @@ async def get_system_config():
             }
         )
 
-        return BaseResponse(data=config)
+        return fast_response(config)
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取配置失败: {str(e)}")
@@ -167,7 +168,7 @@ async def get_statistics(
                 trends=trends
             )
 
-            return BaseResponse(data=response_data)
+            return fast_response(response_data)
 
         else:
             raise HTTPException(status_code=400, detail="不支持的统计类型")
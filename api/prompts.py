@@ -6,25 +6,35 @@ import json
 from datetime import datetime
 
 from database import get_db
+from chat import semantic_cache
+from chat.structured import output_model
 from models.prompt import Prompt
 from schemas import (
     PromptCreate,
     PromptUpdate,
-    PromptResponse,
     PromptListQuery,
-    PromptListResponse,
     PromptBatchDelete,
     PromptTest,
     PromptTestResponse,
     PromptCategory,
     PromptTag,
     BaseResponse,
-    SuccessResponse
+    SuccessResponse,
+    fast_response,
+    PROMPT_ROW
 )
 
 router = APIRouter(prefix="/chat/prompts", tags=["提示词管理"])
 
 
+def check_structured_output(config: Optional[dict]) -> None:
+    """保存前检查结构化输出配置，schema无法转换时返回400"""
+    try:
+        output_model((config or {}).get("structured_output") or {})
+    except (ValueError, TypeError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"结构化输出配置无效: {e}")
+
+
 @router.get("/list", response_model=BaseResponse)
 async def list_prompts(
     pageNum: int = Query(1, ge=1, description="页码"),
@@ -89,15 +99,13 @@ async def list_prompts(
         result = await db.execute(query_stmt)
         items = result.scalars().all()
 
-        # 构造响应数据
-        response_data = PromptListResponse(
-            total=total,
-            items=[PromptResponse.from_orm(item) for item in items],
-            pageNum=pageNum,
-            pageSize=pageSize
-        )
-
-        return BaseResponse(data=response_data)
+        # 构造响应数据，字段与PromptListResponse一致
+        return fast_response({
+            "total": total,
+            "items": PROMPT_ROW.many(items),
+            "pageNum": pageNum,
+            "pageSize": pageSize
+        })
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
@@ -173,7 +181,7 @@ async def get_prompt(prompt_id: int, db: AsyncSession = Depends(get_db)):
     if not prompt:
         raise HTTPException(status_code=404, detail="提示词不存在")
 
-    return BaseResponse(data=PromptResponse.from_orm(prompt))
+    return fast_response(PROMPT_ROW(prompt))
 
 
 @router.post("", response_model=BaseResponse)
@@ -188,16 +196,15 @@ async def create_prompt(prompt_data: PromptCreate, db: AsyncSession = Depends(ge
         if existing:
             raise HTTPException(status_code=400, detail="该提示词标题已存在")
 
+        check_structured_output(prompt_data.config)
+
         # 创建新提示词
         db_prompt = Prompt(**prompt_data.dict())
         db.add(db_prompt)
         await db.commit()
         await db.refresh(db_prompt)
 
-        return BaseResponse(
-            message="提示词创建成功",
-            data=PromptResponse.from_orm(db_prompt)
-        )
+        return fast_response(PROMPT_ROW(db_prompt), message="提示词创建成功")
 
     except HTTPException:
         raise
@@ -230,16 +237,17 @@ async def update_prompt(prompt_data: PromptUpdate, db: AsyncSession = Depends(ge
 
         # 更新字段
         update_data = prompt_data.dict(exclude_unset=True, exclude={"id"})
+        if "config" in update_data:
+            check_structured_output(update_data["config"])
         for field, value in update_data.items():
             setattr(prompt, field, value)
 
         await db.commit()
         await db.refresh(prompt)
+        # 提示词变化后已缓存的回复不再适用
+        semantic_cache.clear(prompt.id)
 
-        return BaseResponse(
-            message="提示词更新成功",
-            data=PromptResponse.from_orm(prompt)
-        )
+        return fast_response(PROMPT_ROW(prompt), message="提示词更新成功")
 
     except HTTPException:
         raise
@@ -261,6 +269,7 @@ async def delete_prompt(prompt_id: int, db: AsyncSession = Depends(get_db)):
 
         await db.delete(prompt)
         await db.commit()
+        semantic_cache.clear(prompt_id)
 
         return SuccessResponse(message="提示词删除成功")
 
@@ -279,6 +288,8 @@ async def batch_delete_prompts(batch_data: PromptBatchDelete, db: AsyncSession =
         result = await db.execute(stmt)
         deleted_count = result.rowcount
         await db.commit()
+        for prompt_id in batch_data.ids:
+            semantic_cache.clear(prompt_id)
 
         return SuccessResponse(message=f"成功删除 {deleted_count} 个提示词")
 
@@ -326,10 +337,7 @@ async def copy_prompt(prompt_id: int, db: AsyncSession = Depends(get_db)):
         await db.commit()
         await db.refresh(new_prompt)
 
-        return BaseResponse(
-            message="提示词复制成功",
-            data=PromptResponse.from_orm(new_prompt)
-        )
+        return fast_response(PROMPT_ROW(new_prompt), message="提示词复制成功")
 
     except HTTPException:
         raise
@@ -0,0 +1,83 @@
+"""回填 messages.token_count
+
+按主键分块流式读取消息，按对话所用模型分组批量编码，再用按主键的批量UPDATE写回。
+每块单独提交，中断后重新运行会从未计数的消息继续。
+
+用法:
+    python backfill_token_counts.py [--chunk-size 1000] [--all]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import defaultdict
+
+# 添加当前目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import select, update, or_
+
+from database import AsyncSessionLocal
+from models import ApiKey, Conversation, Message
+from chat.tokenizer import tokenizer
+
+
+async def backfill(chunk_size: int, recount_all: bool) -> None:
+    last_id = 0
+    total = 0
+    start_time = time.time()
+
+    while True:
+        conditions = [Message.id > last_id]
+        if not recount_all:
+            conditions.append(or_(Message.token_count == 0, Message.token_count.is_(None)))
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Message.id, Message.content, ApiKey.model_name)
+                .join(Conversation, Conversation.id == Message.conversation_id)
+                .outerjoin(ApiKey, ApiKey.id == Conversation.api_key_id)
+                .where(*conditions)
+                .order_by(Message.id.asc())
+                .limit(chunk_size)
+            )
+            rows = result.all()
+            if not rows:
+                break
+
+            # 同一模型的消息一起批量编码
+            by_model = defaultdict(list)
+            for message_id, content, model_name in rows:
+                by_model[model_name].append((message_id, content or ""))
+
+            params = []
+            for model_name, items in by_model.items():
+                await tokenizer.prepare(model_name)
+                counts = await tokenizer.acount_batch([content for _, content in items], model_name)
+                params.extend(
+                    {"id": message_id, "token_count": count}
+                    for (message_id, _), count in zip(items, counts)
+                )
+
+            await db.execute(update(Message), params)
+            await db.commit()
+
+        last_id = rows[-1][0]
+        total += len(rows)
+        print(f"已回填 {total} 条消息 (最后ID: {last_id})")
+
+    print(f"回填完成，共 {total} 条消息，耗时 {time.time() - start_time:.2f}秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回填消息Token数")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="每批处理的消息数")
+    parser.add_argument("--all", action="store_true", help="重新计算所有消息，而不只是未计数的")
+    args = parser.parse_args()
+
+    asyncio.run(backfill(args.chunk_size, args.all))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""列表接口响应序列化的基准测试
+
+对Conversation、Message、ApiKey、Prompt各构造一页（默认100行）ORM对象，不访问数据库，比较：
+- 原方式：逐行构造dict并调用isoformat()（ApiKey、Prompt用from_orm），包装为BaseResponse，
+  由FastAPI按response_model校验后用标准库json输出
+- 新方式：RowSerializer取值，fast_response直接用orjson输出
+
+两种方式都挂在同一个FastAPI应用上，通过ASGI完整走一遍请求，另外单独统计序列化本身的耗时。
+
+用法:
+    python benchmark_serialization.py [--rows 100] [--requests 300]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+import warnings
+from datetime import datetime, timedelta
+
+# 添加当前目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from models import ApiKey, Prompt, Conversation, Message
+from schemas import (
+    ApiKeyResponse, ApiKeyListResponse, PromptResponse, PromptListResponse, BaseResponse,
+    fast_response, API_KEY_ROW, PROMPT_ROW, CONVERSATION_ROW, MESSAGE_ROW
+)
+from schemas import serializers
+
+# 与FastAPI处理response_model=BaseResponse的方式相同：先校验，再按JSON模式输出
+RESPONSE_ADAPTER = TypeAdapter(BaseResponse)
+
+def build_rows(count: int):
+    now = datetime(2024, 1, 1, 12, 0, 0)
+    conversations, messages, api_keys, prompts = [], [], [], []
+    for i in range(count):
+        created = now + timedelta(seconds=i, microseconds=i * 1000)
+        conversations.append(Conversation(
+            id=i + 1, uuid=str(uuid.uuid4()), title=f"对话标题{i}", description="这是一段对话描述" * 3,
+            group_id=1, message_count=i * 2, status="active", created_at=created, updated_at=created
+        ))
+        messages.append(Message(
+            id=i + 1, uuid=str(uuid.uuid4()), role="assistant" if i % 2 else "user",
+            content="这是一条比较长的消息内容，用来模拟真实的回复。" * 20, message_type="text",
+            message_metadata={"cache": {"type": "exact", "hit": False}}, token_count=300, character_count=480,
+            status="active", parent_uuid=None, created_at=created, updated_at=created
+        ))
+        api_keys.append(ApiKey(
+            id=i + 1, api_key=f"sk-{uuid.uuid4().hex}", model_name="gpt-4o-mini",
+            model_url="https://api.openai.com/v1", description="测试密钥", status="active", provider="openai",
+            config={"key_pool": True, "rpm": 500}, max_tokens=4096, timeout=30, created_at=created, updated_at=created
+        ))
+        prompts.append(Prompt(
+            id=i + 1, title=f"提示词{i}", category="system", content="你是一个乐于助人的助手。" * 10,
+            description="描述", tags=["通用", "助手"], is_public=False, variables={"name": "string"},
+            config={"response_cache": {"enabled": True, "ttl": 600}}, sort=i, created_at=created, updated_at=created
+        ))
+    return conversations, messages, api_keys, prompts
+
+
+def legacy_conversations(rows):
+    return BaseResponse(code=200, message="获取对话列表成功", data={
+        "list": [
+            {
+                "id": conv.id, "uuid": conv.uuid, "title": conv.title, "description": conv.description,
+                "group_id": conv.group_id, "message_count": conv.message_count, "status": conv.status,
+                "created_at": conv.created_at.isoformat(), "updated_at": conv.updated_at.isoformat()
+            }
+            for conv in rows
+        ],
+        "total": len(rows), "pageNum": 1, "pageSize": len(rows)
+    })
+
+
+def legacy_messages(rows):
+    return BaseResponse(code=200, message="获取消息列表成功", data={
+        "list": [
+            {
+                "id": msg.id, "uuid": msg.uuid, "role": msg.role, "content": msg.content,
+                "message_type": msg.message_type, "message_metadata": msg.message_metadata,
+                "token_count": msg.token_count, "character_count": msg.character_count, "status": msg.status,
+                "parent_uuid": msg.parent_uuid,
+                "created_at": msg.created_at.isoformat(), "updated_at": msg.updated_at.isoformat()
+            }
+            for msg in rows
+        ],
+        "total": len(rows), "pageNum": 1, "pageSize": len(rows)
+    })
+
+
+def legacy_api_keys(rows):
+    return BaseResponse(data=ApiKeyListResponse(
+        total=len(rows), items=[ApiKeyResponse.from_orm(item) for item in rows], pageNum=1, pageSize=len(rows)
+    ))
+
+
+def legacy_prompts(rows):
+    return BaseResponse(data=PromptListResponse(
+        total=len(rows), items=[PromptResponse.from_orm(item) for item in rows], pageNum=1, pageSize=len(rows)
+    ))
+
+
+def fast_page(serializer, rows, message="success"):
+    return fast_response(
+        {"list": serializer.many(rows), "total": len(rows), "pageNum": 1, "pageSize": len(rows)}, message=message
+    )
+
+
+def fast_items(serializer, rows):
+    return fast_response({"total": len(rows), "items": serializer.many(rows), "pageNum": 1, "pageSize": len(rows)})
+
+
+def build_cases(conversations, messages, api_keys, prompts):
+    """每个接口的（原方式，新方式）响应构造函数"""
+    return {
+        "conversations": (
+            lambda: legacy_conversations(conversations),
+            lambda: fast_page(CONVERSATION_ROW, conversations, "获取对话列表成功")
+        ),
+        "messages": (
+            lambda: legacy_messages(messages),
+            lambda: fast_page(MESSAGE_ROW, messages, "获取消息列表成功")
+        ),
+        "api_keys": (lambda: legacy_api_keys(api_keys), lambda: fast_items(API_KEY_ROW, api_keys)),
+        "prompts": (lambda: legacy_prompts(prompts), lambda: fast_items(PROMPT_ROW, prompts)),
+    }
+
+
+def build_app(cases) -> FastAPI:
+    app = FastAPI()
+    for name, (legacy, fast) in cases.items():
+        app.add_api_route(f"/legacy/{name}", lambda legacy=legacy: legacy(), response_model=BaseResponse)
+        app.add_api_route(f"/fast/{name}", lambda fast=fast: fast(), response_model=BaseResponse)
+    return app
+
+
+def time_serialization(cases, repeat: int):
+    """只统计从ORM对象到响应字节的耗时，原方式按FastAPI的处理顺序：校验、编码、json输出"""
+    results = {}
+    for name, (legacy, fast) in cases.items():
+        def run_legacy():
+            value = RESPONSE_ADAPTER.validate_python(legacy().model_dump())
+            return JSONResponse(RESPONSE_ADAPTER.dump_python(value, mode="json")).body
+
+        def run_fast():
+            return fast().body
+
+        assert len(run_legacy()) > 0 and len(run_fast()) > 0
+        timings = []
+        for func in (run_legacy, run_fast):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func()
+            timings.append((time.perf_counter() - start) / repeat * 1000)
+        results[name] = timings
+    return results
+
+
+async def time_requests(app: FastAPI, names, requests: int):
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for name in names:
+            # 两种方式输出的数据必须一致
+            legacy = (await client.get(f"/legacy/{name}")).json()
+            fast = (await client.get(f"/fast/{name}")).json()
+            assert legacy == fast, f"{name}的输出不一致"
+            timings = []
+            for prefix in ("legacy", "fast"):
+                start = time.perf_counter()
+                for _ in range(requests):
+                    response = await client.get(f"/{prefix}/{name}")
+                    response.raise_for_status()
+                timings.append((time.perf_counter() - start) / requests * 1000)
+            results[name] = timings
+    return results
+
+
+def report(title: str, results) -> None:
+    print(title)
+    print(f"{'接口':<16}{'原方式(ms)':>12}{'新方式(ms)':>12}{'加速':>8}")
+    for name, (legacy, fast) in results.items():
+        print(f"{name:<16}{legacy:>12.3f}{fast:>12.3f}{legacy / fast:>7.1f}x")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列表接口响应序列化基准测试")
+    parser.add_argument("--rows", type=int, default=100, help="每页行数")
+    parser.add_argument("--requests", type=int, default=300, help="每个接口的请求次数")
+    args = parser.parse_args()
+    # 原方式沿用已弃用的from_orm，不输出弃用警告
+    warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+    print(f"JSON库: {'orjson' if serializers.orjson is not None else 'json（未安装orjson）'}，每页{args.rows}行\n")
+    cases = build_cases(*build_rows(args.rows))
+    report("序列化耗时（每页）", time_serialization(cases, args.requests))
+    report("完整请求耗时（ASGI，每次）", asyncio.run(time_requests(build_app(cases), list(cases), args.requests)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from .client_pool import client_pool, ModelClientPool, PacedChatCompletionClient
+from .rate_limiter import rate_limits, KeyRateLimiter
+from .key_router import key_router, KeyRouter, RoutedChatCompletionClient
+from .agent_cache import agent_cache, AgentCache, AgentLease
+from .checkpoint import StreamCheckpointer, mark_partial, drain_partial_writes, recover_streaming_messages
+from .generation import generation_jobs, GenerationJobManager, GenerationJob
+from .task_registry import task_registry, TaskRegistry
+from .admission import admission, AdmissionController, AdmissionRejected
+from .response_cache import response_cache, ResponseCache
+from .semantic_cache import semantic_cache, SemanticCache, register_embedder
+from .batch import batch_runner, BatchRunner
+from .title_queue import title_queue, TitleQueue
+from .post_process import post_processor, PostProcessPool
+from .structured import StructuredOutput, StructuredOutputError, register_output_model
+from . import state_store
+
+__all__ = [
+    "client_pool",
+    "ModelClientPool",
+    "PacedChatCompletionClient",
+    "rate_limits",
+    "KeyRateLimiter",
+    "key_router",
+    "KeyRouter",
+    "RoutedChatCompletionClient",
+    "agent_cache",
+    "AgentCache",
+    "AgentLease",
+    "StreamCheckpointer",
+    "mark_partial",
+    "drain_partial_writes",
+    "recover_streaming_messages",
+    "generation_jobs",
+    "GenerationJobManager",
+    "GenerationJob",
+    "task_registry",
+    "TaskRegistry",
+    "admission",
+    "AdmissionController",
+    "AdmissionRejected",
+    "response_cache",
+    "ResponseCache",
+    "semantic_cache",
+    "SemanticCache",
+    "register_embedder",
+    "batch_runner",
+    "BatchRunner",
+    "title_queue",
+    "TitleQueue",
+    "post_processor",
+    "PostProcessPool",
+    "StructuredOutput",
+    "StructuredOutputError",
+    "register_output_model",
+    "state_store"
+]
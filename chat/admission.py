@@ -0,0 +1,199 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from models import ApiKey
+
+# 默认每个ApiKey的并发上限与等待队列长度
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_MAX_QUEUE = 32
+# 没有历史耗时可参考时建议的重试等待秒数，以及上下限
+DEFAULT_RETRY_AFTER = 5
+MAX_RETRY_AFTER = 60
+# 占用时长的指数平均系数
+HOLD_TIME_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满，请求被拒绝"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"请求过多，请在{retry_after}秒后重试")
+        self.retry_after = retry_after
+
+
+def admission_config(api_key: ApiKey) -> Dict[str, Any]:
+    """ApiKey.config中的准入配置"""
+    return dict((api_key.config or {}).get("admission") or {})
+
+
+class AdmissionTicket:
+    """一次准入申请：立即获得名额，或在队列中等待"""
+
+    def __init__(self, limiter: "KeyLimiter"):
+        self.limiter = limiter
+        self.granted = False
+        self.released = False
+        self.granted_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def position(self) -> int:
+        """在等待队列中的位置，从1开始；已获得名额时为0"""
+        if self.granted:
+            return 0
+        return self.limiter.position(self)
+
+    async def wait(self) -> AsyncIterator[int]:
+        """等待名额，排队期间位置变化时产出新的位置；被取消时退出队列"""
+        try:
+            last_position = None
+            while not self.granted:
+                # 先清除再读取位置，产出期间发生的变化（包括获得名额）不会被清掉
+                self._changed.clear()
+                position = self.position
+                if position != last_position:
+                    last_position = position
+                    yield position
+                    continue
+                await self._changed.wait()
+        except BaseException:
+            if not self.granted:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """归还名额或退出等待队列，重复调用只生效一次"""
+        if self.released:
+            return
+        self.released = True
+        if self.granted:
+            self.limiter.release(self)
+        else:
+            self.limiter.leave(self)
+
+    def _grant(self) -> None:
+        self.granted = True
+        self.granted_at = time.monotonic()
+        self._changed.set()
+
+    def _notify(self) -> None:
+        self._changed.set()
+
+
+class KeyLimiter:
+    """单个ApiKey的并发名额与先进先出的等待队列"""
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters: Deque[AdmissionTicket] = deque()
+        self._avg_hold: Optional[float] = None
+
+    def configure(self, max_concurrency: int, max_queue: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        # 调高并发上限后立即放行排队中的请求
+        self._grant_waiters()
+
+    def admit(self) -> AdmissionTicket:
+        """申请名额，队列已满时抛出AdmissionRejected"""
+        ticket = AdmissionTicket(self)
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+            ticket._grant()
+            return ticket
+        if len(self._waiters) >= self.max_queue:
+            raise AdmissionRejected(self.retry_after())
+        self._waiters.append(ticket)
+        return ticket
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        try:
+            return self._waiters.index(ticket) + 1
+        except ValueError:
+            return 0
+
+    def leave(self, ticket: AdmissionTicket) -> None:
+        """排队中的申请被取消"""
+        try:
+            self._waiters.remove(ticket)
+        except ValueError:
+            return
+        self._notify_waiters()
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        self.in_flight -= 1
+        if ticket.granted_at is not None:
+            hold = time.monotonic() - ticket.granted_at
+            self._avg_hold = hold if self._avg_hold is None else (
+                HOLD_TIME_ALPHA * hold + (1 - HOLD_TIME_ALPHA) * self._avg_hold
+            )
+        self._grant_waiters()
+
+    def retry_after(self) -> int:
+        """按平均占用时长估算队列排空所需的秒数"""
+        if self._avg_hold is None:
+            return DEFAULT_RETRY_AFTER
+        estimate = self._avg_hold * (len(self._waiters) + 1) / self.max_concurrency
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    def _grant_waiters(self) -> None:
+        granted = False
+        while self._waiters and self.in_flight < self.max_concurrency:
+            ticket = self._waiters.popleft()
+            self.in_flight += 1
+            ticket._grant()
+            granted = True
+        if granted:
+            self._notify_waiters()
+
+    def _notify_waiters(self) -> None:
+        # 队列变化后通知仍在等待的申请刷新位置
+        for ticket in self._waiters:
+            ticket._notify()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+class AdmissionController:
+    """按ApiKey.id管理并发名额
+
+    每个ApiKey同时调用模型的请求数不超过max_concurrency，超出的请求进入长度为max_queue的
+    等待队列，队列满时直接拒绝（503 + Retry-After），避免突发流量变成对上游的429风暴。
+    限额取自ApiKey.config["admission"]，每次申请时读取，修改配置后立即生效。
+    """
+
+    def __init__(self):
+        self._limiters: Dict[int, KeyLimiter] = {}
+
+    def limiter(self, api_key: ApiKey) -> KeyLimiter:
+        config = admission_config(api_key)
+        max_concurrency = max(1, int(config.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+        max_queue = max(0, int(config.get("max_queue", DEFAULT_MAX_QUEUE)))
+
+        limiter = self._limiters.get(api_key.id)
+        if limiter is None:
+            limiter = KeyLimiter(max_concurrency, max_queue)
+            self._limiters[api_key.id] = limiter
+        elif (limiter.max_concurrency, limiter.max_queue) != (max_concurrency, max_queue):
+            limiter.configure(max_concurrency, max_queue)
+        return limiter
+
+    def admit(self, api_key: ApiKey) -> AdmissionTicket:
+        return self.limiter(api_key).admit()
+
+    def stats(self) -> Dict[int, Dict[str, int]]:
+        return {api_key_id: limiter.stats() for api_key_id, limiter in self._limiters.items()}
+
+
+admission = AdmissionController()
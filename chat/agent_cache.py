@@ -0,0 +1,183 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from autogen_agentchat.agents import AssistantAgent
+
+from database import AsyncSessionLocal
+from . import state_store
+
+# 缓存容量与空闲过期时间
+AGENT_CACHE_MAX_SIZE = 256
+AGENT_CACHE_TTL_SECONDS = 1800.0
+AGENT_CACHE_SWEEP_INTERVAL = 60.0
+
+
+class AgentLease:
+    """一次checkout的凭据
+
+    记录借出时的失效版本号，以及该代理尚未合并进快照的增量数量和最后一条增量ID。
+    """
+
+    __slots__ = ("conversation_uuid", "conversation_id", "epoch", "agent", "signature",
+                 "pending_deltas", "last_delta_id", "last_used")
+
+    def __init__(self, conversation_uuid: str, conversation_id: int, epoch: int):
+        self.conversation_uuid = conversation_uuid
+        self.conversation_id = conversation_id
+        self.epoch = epoch
+        self.agent: Optional[AssistantAgent] = None
+        self.signature: Any = None
+        self.pending_deltas = 0
+        self.last_delta_id: Optional[int] = None
+        self.last_used = time.monotonic()
+
+    def record_delta(self, delta_id: int) -> None:
+        """记录本轮追加的增量"""
+        self.pending_deltas += 1
+        self.last_delta_id = delta_id
+
+    @property
+    def dirty(self) -> bool:
+        return self.pending_deltas > 0
+
+
+class AgentCache:
+    """按对话UUID缓存已加载状态的AssistantAgent（LRU + TTL）
+
+    活跃对话命中缓存时跳过快照与增量的解码和load_state回放。
+    代理以checkout/checkin的方式借出，同一对话的并发请求不会共享同一个代理实例。
+    每轮只追加增量（见state_store），快照合并采用写回策略：在淘汰、过期、服务关闭
+    或增量累积到COMPACT_EVERY条时，用内存中的完整状态写快照并删除已覆盖的增量。
+    """
+
+    def __init__(self, max_size: int = AGENT_CACHE_MAX_SIZE, ttl: float = AGENT_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, AgentLease]" = OrderedDict()
+        self._epochs: Dict[str, int] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def checkout(self, conversation_uuid: str, conversation_id: int) -> AgentLease:
+        """借出对话的代理；未命中时lease.agent为None，调用方需从数据库加载状态"""
+        self._sweep()
+        # 等待该对话尚未完成的快照写入，保证未命中时读到的是最新状态
+        pending = self._pending.get(conversation_uuid)
+        if pending:
+            await asyncio.shield(pending)
+
+        entry = self._entries.pop(conversation_uuid, None)
+        if entry:
+            return entry
+        return AgentLease(conversation_uuid, conversation_id, self._epochs.get(conversation_uuid, 0))
+
+    def checkin(self, lease: AgentLease, agent: AssistantAgent, signature: Any) -> None:
+        """归还代理；借出期间对话被失效过则直接丢弃"""
+        if lease.epoch != self._epochs.get(lease.conversation_uuid, 0):
+            return
+
+        previous = self._entries.pop(lease.conversation_uuid, None)
+        if previous and previous.dirty and previous.agent is not agent:
+            self._schedule_persist(previous)
+
+        lease.agent = agent
+        lease.signature = signature
+        lease.last_used = time.monotonic()
+        self._entries[lease.conversation_uuid] = lease
+
+        if lease.pending_deltas >= state_store.COMPACT_EVERY:
+            self._schedule_persist(lease)
+        self._evict_overflow()
+
+    async def invalidate(self, conversation_uuid: str, persist: bool = False) -> None:
+        """使对话的缓存代理失效
+
+        persist=False用于状态被重置的场景（如清空消息），缓存中的状态直接丢弃；
+        persist=True用于仅需重新加载的场景，先把未合并的增量写成快照。
+        """
+        self._epochs[conversation_uuid] = self._epochs.get(conversation_uuid, 0) + 1
+        entry = self._entries.pop(conversation_uuid, None)
+        if persist and entry and entry.dirty:
+            self._schedule_persist(entry)
+
+        pending = self._pending.get(conversation_uuid)
+        if pending:
+            await asyncio.shield(pending)
+
+    def start(self) -> None:
+        """启动后台过期清理"""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        """合并所有未写快照的代理，服务退出时调用"""
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+        while self._entries:
+            _, entry = self._entries.popitem(last=False)
+            if entry.dirty:
+                self._schedule_persist(entry)
+
+        if self._pending:
+            await asyncio.gather(*self._pending.values(), return_exceptions=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_overflow(self) -> None:
+        while len(self._entries) > self.max_size:
+            _, entry = self._entries.popitem(last=False)
+            if entry.dirty:
+                self._schedule_persist(entry)
+
+    def _sweep(self) -> None:
+        # 条目按最近使用排序，从最旧的开始检查即可
+        deadline = time.monotonic() - self.ttl
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.last_used > deadline:
+                break
+            self._entries.popitem(last=False)
+            if entry.dirty:
+                self._schedule_persist(entry)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(AGENT_CACHE_SWEEP_INTERVAL)
+            self._sweep()
+
+    def _schedule_persist(self, entry: AgentLease) -> None:
+        conversation_uuid = entry.conversation_uuid
+        previous = self._pending.get(conversation_uuid)
+        task = asyncio.create_task(
+            self._persist(entry.conversation_id, entry.agent, entry.last_delta_id, previous)
+        )
+        self._pending[conversation_uuid] = task
+        entry.pending_deltas = 0
+
+        def _done(t: asyncio.Task) -> None:
+            if self._pending.get(conversation_uuid) is t:
+                del self._pending[conversation_uuid]
+
+        task.add_done_callback(_done)
+
+    async def _persist(self, conversation_id: int, agent: AssistantAgent,
+                       last_delta_id: Optional[int], previous: Optional[asyncio.Task]) -> None:
+        # 同一对话的快照按顺序写入，避免旧状态覆盖新状态
+        if previous:
+            await asyncio.gather(previous, return_exceptions=True)
+        try:
+            state = await agent.save_state()
+            async with AsyncSessionLocal() as db:
+                await state_store.write_snapshot(db, conversation_id, state, last_delta_id)
+                await db.commit()
+        except Exception as e:
+            # 增量仍在，下次加载时可以完整恢复
+            print(f"写入代理状态快照失败: {e}")
+
+
+agent_cache = AgentCache()
@@ -0,0 +1,289 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import select, update, or_, func
+from autogen_agentchat.agents import AssistantAgent
+
+from database import AsyncSessionLocal
+from models import ApiKey, Prompt, BatchJob, BatchItem
+from models.batch_job import (
+    BATCH_RUNNING, BATCH_COMPLETED, BATCH_FAILED,
+    ITEM_PENDING, ITEM_RUNNING, ITEM_COMPLETED, ITEM_FAILED
+)
+from .key_router import key_router
+
+# 并发数上下限
+DEFAULT_BATCH_CONCURRENCY = 4
+MAX_BATCH_CONCURRENCY = 32
+# 心跳间隔；心跳超过BATCH_STALE_SECONDS未更新的任务由其他进程接管
+BATCH_HEARTBEAT_INTERVAL = 10.0
+BATCH_STALE_SECONDS = 30
+# 每次从数据库读取的待执行条目数
+BATCH_FETCH_SIZE = 100
+
+
+class BatchRunner:
+    """批量推理任务的执行器
+
+    每个任务在本进程内由一个协程负责：按行号分页读取pending条目，交给并发数个worker执行，
+    每条的状态和结果单独提交。任务通过owner + 心跳归属到一个工作进程，进程退出后
+    心跳过期的任务由任意进程接管，上次执行到一半的条目重新置为pending后继续。
+    取消请求写在任务状态上，所属进程在心跳时发现后停止本地执行。
+    """
+
+    def __init__(
+        self,
+        heartbeat_interval: float = BATCH_HEARTBEAT_INTERVAL,
+        stale_seconds: int = BATCH_STALE_SECONDS
+    ):
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_seconds = stale_seconds
+        self._jobs: Dict[int, asyncio.Task] = {}
+        self._poller: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+
+    @property
+    def worker_id(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _stale_threshold(self):
+        return func.datetime("now", f"-{self.stale_seconds} seconds")
+
+    async def submit(self, job_id: int) -> bool:
+        """认领任务并在后台执行，任务已由其他存活进程执行时返回False"""
+        task = self._jobs.get(job_id)
+        if task is not None:
+            if not task.cancelling():
+                return True
+            # 取消后立即重新提交（重试）时，等上一轮执行退出后再认领
+            await asyncio.gather(task, return_exceptions=True)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(BatchJob)
+                .where(
+                    BatchJob.id == job_id,
+                    BatchJob.status == BATCH_RUNNING,
+                    or_(
+                        BatchJob.owner.is_(None),
+                        BatchJob.owner == self.worker_id,
+                        BatchJob.heartbeat_at < self._stale_threshold()
+                    )
+                )
+                .values(owner=self.worker_id, heartbeat_at=func.now())
+            )
+            await db.commit()
+            if result.rowcount == 0:
+                return False
+
+        task = asyncio.create_task(self._run_job(job_id))
+        self._jobs[job_id] = task
+        task.add_done_callback(lambda _: self._jobs.pop(job_id, None))
+        return True
+
+    def cancel(self, job_id: int) -> bool:
+        """停止本进程中的任务，任务不在本进程时返回False"""
+        task = self._jobs.get(job_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    def start(self) -> None:
+        """启动心跳与接管轮询，启动后立即接管上次未完成的任务"""
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll_loop())
+
+    async def close(self) -> None:
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            try:
+                await self._poll_once()
+            except Exception as e:
+                print(f"轮询批量任务失败: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _poll_once(self) -> None:
+        async with AsyncSessionLocal() as db:
+            if self._jobs:
+                local = list(self._jobs)
+                await db.execute(
+                    update(BatchJob)
+                    .where(BatchJob.id.in_(local), BatchJob.owner == self.worker_id)
+                    .values(heartbeat_at=func.now())
+                )
+                await db.commit()
+                # 已被取消（或被其他进程接管）的任务停止本地执行
+                result = await db.execute(
+                    select(BatchJob.id).where(
+                        BatchJob.id.in_(local),
+                        or_(BatchJob.status != BATCH_RUNNING, BatchJob.owner != self.worker_id)
+                    )
+                )
+                for job_id in result.scalars().all():
+                    self.cancel(job_id)
+
+            now = time.monotonic()
+            if now - self._last_sweep < self.stale_seconds:
+                return
+            self._last_sweep = now
+            result = await db.execute(
+                select(BatchJob.id).where(
+                    BatchJob.status == BATCH_RUNNING,
+                    or_(BatchJob.owner.is_(None), BatchJob.heartbeat_at < self._stale_threshold())
+                )
+            )
+            orphaned = [job_id for job_id in result.scalars().all() if job_id not in self._jobs]
+
+        for job_id in orphaned:
+            if await self.submit(job_id):
+                print(f"接管批量任务: {job_id}")
+
+    async def _run_job(self, job_id: int) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                job = await db.get(BatchJob, job_id)
+                if job is None:
+                    return
+                api_key = await db.scalar(select(ApiKey).where(ApiKey.id == job.api_key_id, ApiKey.status == "active"))
+                prompt = await db.get(Prompt, job.prompt_id)
+                if api_key is None or prompt is None:
+                    await self._finish_job(db, job_id, BATCH_FAILED, "API密钥或提示词不存在")
+                    return
+                # 接管时上一个进程执行到一半的条目重新执行
+                await db.execute(
+                    update(BatchItem)
+                    .where(BatchItem.job_id == job_id, BatchItem.status == ITEM_RUNNING)
+                    .values(status=ITEM_PENDING)
+                )
+                await db.commit()
+                concurrency = max(1, min(MAX_BATCH_CONCURRENCY, job.concurrency or DEFAULT_BATCH_CONCURRENCY))
+
+            model_client = await key_router.client(api_key)
+            queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+            workers = [
+                asyncio.create_task(self._worker(queue, model_client, prompt.content))
+                for _ in range(concurrency)
+            ]
+            try:
+                await self._feed(job_id, queue)
+                await queue.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+            async with AsyncSessionLocal() as db:
+                await self._finish_job(db, job_id, BATCH_COMPLETED)
+        except asyncio.CancelledError:
+            # 被取消或服务关闭：执行到一半的条目放回pending，任务状态保持不变，之后可以继续
+            await self._release_running(job_id)
+            raise
+        except Exception as e:
+            print(f"批量任务执行失败: {e}")
+            await self._release_running(job_id)
+            async with AsyncSessionLocal() as db:
+                await self._finish_job(db, job_id, BATCH_FAILED, str(e))
+
+    async def _feed(self, job_id: int, queue: asyncio.Queue) -> None:
+        """按行号顺序分页读取pending条目放入队列"""
+        last_line = -1
+        while True:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(BatchItem.id, BatchItem.line_no, BatchItem.content)
+                    .where(
+                        BatchItem.job_id == job_id,
+                        BatchItem.status == ITEM_PENDING,
+                        BatchItem.line_no > last_line
+                    )
+                    .order_by(BatchItem.line_no.asc())
+                    .limit(BATCH_FETCH_SIZE)
+                )
+                rows = result.all()
+            if not rows:
+                return
+            for row in rows:
+                await queue.put((job_id, row.id, row.content))
+            last_line = rows[-1].line_no
+
+    async def _worker(self, queue: asyncio.Queue, model_client, system_message: str) -> None:
+        while True:
+            job_id, item_id, content = await queue.get()
+            try:
+                await self._run_item(job_id, item_id, content, model_client, system_message)
+            finally:
+                queue.task_done()
+
+    async def _run_item(self, job_id: int, item_id: int, content: str, model_client, system_message: str) -> None:
+        """执行一条任务：每条使用独立的代理，互不共享上下文"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(BatchItem).where(BatchItem.id == item_id).values(status=ITEM_RUNNING))
+            await db.commit()
+
+        started = time.monotonic()
+        output = None
+        error = None
+        try:
+            agent = AssistantAgent(name="assistant", model_client=model_client, system_message=system_message)
+            result = await agent.run(task=content)
+            output = result.messages[-1].to_text()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = str(e)
+
+        status = ITEM_COMPLETED if error is None else ITEM_FAILED
+        counter = BatchJob.completed_count if error is None else BatchJob.failed_count
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(BatchItem)
+                .where(BatchItem.id == item_id)
+                .values(
+                    status=status,
+                    output=output,
+                    error=error,
+                    attempts=BatchItem.attempts + 1,
+                    duration_ms=int((time.monotonic() - started) * 1000),
+                    finished_at=func.now()
+                )
+            )
+            await db.execute(update(BatchJob).where(BatchJob.id == job_id).values({counter: counter + 1}))
+            await db.commit()
+
+    @staticmethod
+    async def _release_running(job_id: int) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(BatchItem)
+                    .where(BatchItem.job_id == job_id, BatchItem.status == ITEM_RUNNING)
+                    .values(status=ITEM_PENDING)
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"重置批量条目状态失败: {e}")
+
+    @staticmethod
+    async def _finish_job(db, job_id: int, status: str, error: Optional[str] = None) -> None:
+        # 只结束仍在运行的任务，执行期间被取消的任务保持cancelled
+        await db.execute(
+            update(BatchJob)
+            .where(BatchJob.id == job_id, BatchJob.status == BATCH_RUNNING)
+            .values(status=status, error=error, finished_at=func.now())
+        )
+        await db.commit()
+
+
+batch_runner = BatchRunner()
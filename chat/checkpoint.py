@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Set
+
+from sqlalchemy import select, update, func
+
+from database import AsyncSessionLocal
+from models import Message, GenerationTask
+from models.conversation import MESSAGE_STATUS_STREAMING, MESSAGE_STATUS_PARTIAL
+
+# 默认检查点间隔：每K个推送分片或T秒写一次，满足任一条件即写
+DEFAULT_CHECKPOINT_CHUNKS = 20
+DEFAULT_CHECKPOINT_SECONDS = 2.0
+
+# 后台收尾任务的强引用，防止任务在完成前被回收
+_background_tasks: Set[asyncio.Task] = set()
+
+
+class StreamCheckpointer:
+    """流式生成过程中定期把已生成的内容写回助手消息
+
+    写入在独立会话的后台任务中进行，同一时间最多一个写入，未完成时跳过本次触发，
+    推送分片的路径不会等待数据库。写入只作用于状态仍为streaming的消息，
+    生成结束后迟到的检查点不会覆盖最终内容。
+    生成被取消、失败或客户端断开时调用abandon保存已生成的部分。
+    """
+
+    def __init__(
+        self,
+        message_uuid: str,
+        every_chunks: int = DEFAULT_CHECKPOINT_CHUNKS,
+        interval_seconds: float = DEFAULT_CHECKPOINT_SECONDS,
+        abandon_status: str = MESSAGE_STATUS_PARTIAL
+    ):
+        self.message_uuid = message_uuid
+        # 未完成时消息最终的状态，重新生成的版本中断后作为其他版本保留
+        self.abandon_status = abandon_status
+        self.every_chunks = max(1, every_chunks)
+        self.interval = max(0.0, interval_seconds)
+        self._chunks = 0
+        self._last_write = time.monotonic()
+        self._written_length = 0
+        self._task: Optional[asyncio.Task] = None
+        self._abandoned = False
+
+    @classmethod
+    def from_config(
+        cls,
+        message_uuid: str,
+        config: Optional[Dict[str, Any]],
+        abandon_status: str = MESSAGE_STATUS_PARTIAL
+    ) -> "StreamCheckpointer":
+        """从对话配置的stream项读取检查点间隔"""
+        stream_config = (config or {}).get("stream") or {}
+        return cls(
+            message_uuid,
+            int(stream_config.get("checkpoint_chunks", DEFAULT_CHECKPOINT_CHUNKS)),
+            float(stream_config.get("checkpoint_seconds", DEFAULT_CHECKPOINT_SECONDS)),
+            abandon_status
+        )
+
+    def feed(self, content) -> None:
+        """每推送一个分片调用一次，content为ContentBuffer"""
+        self._chunks += 1
+        if self._task is not None and not self._task.done():
+            return
+        if self._chunks < self.every_chunks and time.monotonic() - self._last_write < self.interval:
+            return
+        if len(content) == self._written_length:
+            return
+
+        text = content.text()
+        self._chunks = 0
+        self._last_write = time.monotonic()
+        self._written_length = len(text)
+        self._task = asyncio.create_task(self._write(text))
+
+    async def _write(self, text: str) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(Message)
+                    .where(Message.uuid == self.message_uuid, Message.status == MESSAGE_STATUS_STREAMING)
+                    .values(content=text, character_count=len(text))
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"写入流式检查点失败: {e}")
+
+    async def close(self) -> None:
+        """等待进行中的检查点写完，避免与最终写入争用数据库"""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def abandon(self, text: str) -> None:
+        """在后台把消息标记为abandon_status并写入已生成的内容，重复调用只生效一次
+
+        调用方可能处于已取消的任务中，收尾写入放在独立任务里，不受调用方取消影响。
+        """
+        if self._abandoned:
+            return
+        self._abandoned = True
+        task = asyncio.create_task(mark_partial(self.message_uuid, text, self, self.abandon_status))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+
+async def mark_partial(
+    message_uuid: str,
+    text: str,
+    checkpointer: Optional[StreamCheckpointer] = None,
+    status: str = MESSAGE_STATUS_PARTIAL
+) -> None:
+    """生成被取消或失败时保留已生成的内容，并把消息标记为partial（或指定的状态）"""
+    if checkpointer is not None:
+        await checkpointer.close()
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Message)
+                .where(Message.uuid == message_uuid, Message.status == MESSAGE_STATUS_STREAMING)
+                .values(content=text, character_count=len(text), status=status)
+            )
+            await db.commit()
+    except Exception as e:
+        print(f"保存部分生成内容失败: {e}")
+
+
+async def drain_partial_writes() -> None:
+    """等待后台的partial收尾写入完成，关闭时调用"""
+    if _background_tasks:
+        await asyncio.gather(*list(_background_tasks), return_exceptions=True)
+
+
+async def recover_streaming_messages(stale_seconds: int = 30) -> int:
+    """把所属进程已退出的streaming消息标记为partial，返回处理的条数
+
+    多个工作进程共享数据库时，仍有进程在生成（任务心跳未过期）的消息不处理；
+    最近stale_seconds内有更新的消息也先跳过，留给之后的清理。
+    """
+    threshold = func.datetime("now", f"-{stale_seconds} seconds")
+    live_messages = (
+        select(GenerationTask.message_uuid)
+        .where(GenerationTask.state == "running", GenerationTask.heartbeat_at >= threshold)
+    )
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(Message)
+                .where(
+                    Message.status == MESSAGE_STATUS_STREAMING,
+                    Message.updated_at < threshold,
+                    Message.uuid.not_in(live_messages)
+                )
+                .values(status=MESSAGE_STATUS_PARTIAL)
+            )
+            await db.commit()
+            return result.rowcount
+    except Exception as e:
+        print(f"恢复中断的流式消息失败: {e}")
+        return 0
@@ -0,0 +1,164 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Mapping, Sequence, Set, Tuple
+
+import httpx
+from openai import DefaultAsyncHttpxClient
+from autogen_core.models import CreateResult, LLMMessage
+from autogen_ext.models.openai import OpenAIChatCompletionClient
+
+from models import ApiKey
+from .context_window import estimate_tokens
+from .rate_limiter import KeyRateLimiter, rate_limits, DEFAULT_COMPLETION_TOKENS
+
+# 连接池参数：空闲连接保活时间要覆盖两轮对话之间的间隔，否则每轮仍要重新握手
+POOL_MAX_CONNECTIONS = 100
+POOL_MAX_KEEPALIVE_CONNECTIONS = 20
+POOL_KEEPALIVE_EXPIRY = 300.0
+DEFAULT_TIMEOUT = 60.0
+# 被替换的客户端延迟关闭，给进行中的流留出完成时间
+RETIRE_GRACE_SECONDS = 600.0
+
+MODEL_INFO = {
+    "vision": False,
+    "function_calling": True,
+    "json_output": True,
+    "family": "unknown",
+    "structured_output": True
+}
+
+
+class PacedChatCompletionClient(OpenAIChatCompletionClient):
+    """调用前按ApiKey的RPM/TPM额度排队的模型客户端
+
+    Token按消息长度和max_tokens估算，调用结束后按返回的实际用量修正。
+    """
+
+    def __init__(self, rate_limiter: KeyRateLimiter, **kwargs):
+        super().__init__(**kwargs)
+        self._rate_limiter = rate_limiter
+
+    def _estimate(self, messages: Sequence[LLMMessage], extra_create_args: Mapping[str, Any]) -> int:
+        completion = extra_create_args.get("max_tokens") or self._create_args.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        return sum(estimate_tokens(message) for message in messages) + int(completion)
+
+    def _reconcile(self, estimated: int, result: CreateResult) -> None:
+        usage = result.usage
+        if usage is not None:
+            self._rate_limiter.reconcile(estimated, usage.prompt_tokens + usage.completion_tokens)
+
+    async def create(self, messages: Sequence[LLMMessage], **kwargs) -> CreateResult:
+        estimated = self._estimate(messages, kwargs.get("extra_create_args") or {})
+        await self._rate_limiter.acquire(estimated)
+        result = await super().create(messages, **kwargs)
+        self._reconcile(estimated, result)
+        return result
+
+    async def create_stream(self, messages: Sequence[LLMMessage], **kwargs):
+        estimated = self._estimate(messages, kwargs.get("extra_create_args") or {})
+        await self._rate_limiter.acquire(estimated)
+        async for item in super().create_stream(messages, **kwargs):
+            if isinstance(item, CreateResult):
+                self._reconcile(estimated, item)
+            yield item
+
+
+def _fingerprint(api_key: ApiKey) -> Tuple:
+    """影响客户端构造的字段，任一变化都需要重建客户端"""
+    return (api_key.api_key, api_key.model_name, api_key.model_url, api_key.timeout)
+
+
+class ModelClientPool:
+    """按ApiKey ID复用的模型客户端池
+
+    每个ApiKey持有一个长期存活的OpenAIChatCompletionClient，底层httpx连接池保持keep-alive，
+    避免每轮对话重新建立TLS连接。ApiKey被修改时通过invalidate失效，
+    即使漏掉了失效通知，get时的指纹比对也会发现配置变化并重建。
+    客户端共享该ApiKey的限速器，上游响应头（Retry-After、x-ratelimit-*）通过httpx钩子回传给限速器。
+    """
+
+    def __init__(self):
+        self._clients: Dict[int, Tuple[Tuple, OpenAIChatCompletionClient]] = {}
+        # 被替换下来的客户端可能还有进行中的流，宽限期过后再关闭
+        self._retired: List[Tuple[float, OpenAIChatCompletionClient]] = []
+        self._closing: Set[asyncio.Task] = set()
+
+    def _build(self, api_key: ApiKey, rate_limiter: KeyRateLimiter) -> OpenAIChatCompletionClient:
+        timeout = float(api_key.timeout or DEFAULT_TIMEOUT)
+
+        async def observe_response(response: httpx.Response) -> None:
+            rate_limiter.observe(response.status_code, response.headers)
+
+        http_client = DefaultAsyncHttpxClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+            ),
+            event_hooks={"response": [observe_response]}
+        )
+        return PacedChatCompletionClient(
+            rate_limiter,
+            model=api_key.model_name,
+            api_key=api_key.api_key,
+            base_url=api_key.model_url,
+            timeout=timeout,
+            http_client=http_client,
+            # 429/5xx由路由客户端换密钥重试，SDK内部不再原地重试
+            max_retries=0,
+            model_info=MODEL_INFO
+        )
+
+    def get(self, api_key: ApiKey) -> OpenAIChatCompletionClient:
+        """获取ApiKey对应的客户端，不存在或配置已变化时重建"""
+        fingerprint = _fingerprint(api_key)
+        # 每次获取都刷新限速配置，修改ApiKey.config后无需重建客户端
+        rate_limiter = rate_limits.limiter(api_key)
+        entry = self._clients.get(api_key.id)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+
+        if entry:
+            self._retire(entry[1])
+        client = self._build(api_key, rate_limiter)
+        self._clients[api_key.id] = (fingerprint, client)
+        return client
+
+    def invalidate(self, *api_key_ids: int) -> None:
+        """使指定ApiKey的客户端失效，下次get时重建"""
+        for api_key_id in api_key_ids:
+            entry = self._clients.pop(api_key_id, None)
+            if entry:
+                self._retire(entry[1])
+
+    def _retire(self, client: OpenAIChatCompletionClient) -> None:
+        now = time.monotonic()
+        self._retired.append((now, client))
+
+        expired = [c for retired_at, c in self._retired if now - retired_at > RETIRE_GRACE_SECONDS]
+        if not expired:
+            return
+        self._retired = [(t, c) for t, c in self._retired if now - t <= RETIRE_GRACE_SECONDS]
+        for old_client in expired:
+            task = asyncio.create_task(self._close_client(old_client))
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close_client(client: OpenAIChatCompletionClient) -> None:
+        try:
+            await client.close()
+        except Exception as e:
+            print(f"关闭模型客户端失败: {e}")
+
+    async def close(self) -> None:
+        """关闭所有客户端，服务退出时调用"""
+        clients = [client for _, client in self._clients.values()] + [c for _, c in self._retired]
+        self._clients.clear()
+        self._retired = []
+        for client in clients:
+            await self._close_client(client)
+
+
+client_pool = ModelClientPool()
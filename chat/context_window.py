@@ -0,0 +1,294 @@
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import (
+    LLMMessage, SystemMessage, FunctionExecutionResultMessage
+)
+
+from models import ApiKey, Prompt
+
+# 模型回复预留的Token数，窗口预算 = max_tokens - 系统提示词 - 预留
+DEFAULT_RESERVE_TOKENS = 512
+DEFAULT_LAST_N = 20
+# 摘要头最多占用预算的比例，以及每条旧消息保留的字符数
+SUMMARY_BUDGET_RATIO = 0.25
+SUMMARY_EXCERPT_CHARS = 80
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TokenCounter = Callable[[LLMMessage], int]
+# 批量计数，在线程池中编码，避免长历史阻塞事件循环
+BatchTokenCounter = Callable[[List[LLMMessage]], Awaitable[List[int]]]
+
+
+def message_text(message: LLMMessage) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(item if isinstance(item, str) else str(item) for item in content)
+    return str(content)
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算Token数：ASCII约4字符一个Token，CJK等非ASCII字符约一字一个Token"""
+    ascii_count = sum(1 for ch in text if ch.isascii())
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+def estimate_tokens(message: LLMMessage) -> int:
+    """估算单条消息的Token数"""
+    return estimate_text_tokens(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _drop_orphan_results(messages: List[LLMMessage]) -> List[LLMMessage]:
+    # 窗口不能以工具结果开头，否则缺少对应的工具调用
+    start = 0
+    while start < len(messages) - 1 and isinstance(messages[start], FunctionExecutionResultMessage):
+        start += 1
+    return messages[start:]
+
+
+class WindowStrategy:
+    """窗口策略：从完整历史中选出发给模型的消息"""
+
+    name = "none"
+
+    def select(self, messages: List[LLMMessage], counts: List[int], budget: Optional[int]) -> List[LLMMessage]:
+        return list(messages)
+
+
+class SlidingWindowStrategy(WindowStrategy):
+    """从最新消息向前取，直到用完Token预算"""
+
+    name = "sliding_window"
+
+    def select(self, messages, counts, budget):
+        if budget is None or not messages:
+            return list(messages)
+        start = _window_start(counts, budget, len(messages))
+        return _drop_orphan_results(messages[start:])
+
+
+class KeepSystemLastNStrategy(WindowStrategy):
+    """保留上下文中的系统消息和最近N条消息，同时受Token预算约束"""
+
+    name = "keep_last_n"
+
+    def __init__(self, last_n: int = DEFAULT_LAST_N):
+        self.last_n = max(1, last_n)
+
+    def select(self, messages, counts, budget):
+        system_indexes = [i for i, m in enumerate(messages) if isinstance(m, SystemMessage)]
+        tail_start = max(0, len(messages) - self.last_n)
+        if budget is not None:
+            system_cost = sum(counts[i] for i in system_indexes if i < tail_start)
+            tail_start = max(tail_start, _window_start(counts, budget - system_cost, len(messages)))
+        head = [messages[i] for i in system_indexes if i < tail_start]
+        return head + _drop_orphan_results(messages[tail_start:])
+
+
+class SummarizedHeadStrategy(WindowStrategy):
+    """超出预算时把较早的轮次折叠成一条摘要，后面接最近的原始消息
+
+    摘要是抽取式的（每条旧消息截取开头一段），不额外调用模型，
+    折叠结果只与消息内容有关，相同历史得到相同的请求。
+    """
+
+    name = "summarized_head"
+
+    def __init__(self, excerpt_chars: int = SUMMARY_EXCERPT_CHARS, budget_ratio: float = SUMMARY_BUDGET_RATIO):
+        self.excerpt_chars = excerpt_chars
+        self.budget_ratio = budget_ratio
+
+    def select(self, messages, counts, budget):
+        if budget is None or sum(counts) <= budget:
+            return list(messages)
+
+        summary_budget = int(budget * self.budget_ratio)
+        tail_start = _window_start(counts, budget - summary_budget, len(messages))
+        summary = self._summarize(messages[:tail_start], summary_budget)
+        tail = _drop_orphan_results(messages[tail_start:])
+        return ([summary] if summary else []) + tail
+
+    def _summarize(self, messages: List[LLMMessage], budget: int) -> Optional[SystemMessage]:
+        lines = []
+        used = 0
+        # 从最接近窗口的旧消息开始取，预算不足时丢弃更早的
+        for message in reversed(messages):
+            text = " ".join(message_text(message).split())
+            if not text:
+                continue
+            if len(text) > self.excerpt_chars:
+                text = text[:self.excerpt_chars] + "..."
+            line = f"{getattr(message, 'source', None) or message.type}: {text}"
+            cost = estimate_text_tokens(line) + 1
+            if used + cost > budget:
+                break
+            lines.append(line)
+            used += cost
+
+        if not lines:
+            return None
+        lines.reverse()
+        return SystemMessage(content="以下是较早对话的摘要：\n" + "\n".join(lines))
+
+
+def _window_start(counts: List[int], budget: int, total: int) -> int:
+    """从末尾向前累加Token数，返回预算内能容纳的最早下标；最后一条消息总是保留"""
+    used = 0
+    start = total
+    while start > 0:
+        cost = counts[start - 1]
+        if used + cost > budget and start < total:
+            break
+        used += cost
+        start -= 1
+    return start
+
+
+STRATEGIES = {
+    WindowStrategy.name: WindowStrategy,
+    SlidingWindowStrategy.name: SlidingWindowStrategy,
+    KeepSystemLastNStrategy.name: KeepSystemLastNStrategy,
+    SummarizedHeadStrategy.name: SummarizedHeadStrategy,
+}
+
+
+class WindowedChatCompletionContext(ChatCompletionContext):
+    """保存完整历史、只向模型暴露窗口内消息的上下文
+
+    状态保存与增量持久化使用完整历史（all_messages），get_messages返回按策略裁剪后的视图。
+    每条消息的Token数在加入时计算一次并缓存；提供batch_counter时，加入消息和load_state
+    都通过它计数，不在事件循环中编码。initial_counts为initial_messages预先算好的Token数。
+    """
+
+    def __init__(
+        self,
+        strategy: WindowStrategy = None,
+        token_budget: Optional[int] = None,
+        token_counter: TokenCounter = estimate_tokens,
+        initial_messages: Optional[List[LLMMessage]] = None,
+        initial_counts: Optional[List[int]] = None,
+        batch_counter: Optional[BatchTokenCounter] = None
+    ):
+        super().__init__(initial_messages)
+        self.strategy = strategy or WindowStrategy()
+        self.token_budget = token_budget
+        self._token_counter = token_counter
+        self._batch_counter = batch_counter
+        if initial_counts is not None and len(initial_counts) == len(self._messages):
+            self._token_counts: List[int] = list(initial_counts)
+        else:
+            self._token_counts = [token_counter(m) for m in self._messages]
+
+    async def _count(self, messages: List[LLMMessage]) -> List[int]:
+        if self._batch_counter is not None:
+            return await self._batch_counter(messages)
+        return [self._token_counter(m) for m in messages]
+
+    async def add_message(self, message: LLMMessage) -> None:
+        # 先计数再加入，计数期间消息列表与计数保持一致
+        counts = await self._count([message])
+        await super().add_message(message)
+        self._token_counts.extend(counts)
+
+    async def get_messages(self) -> List[LLMMessage]:
+        return self.strategy.select(self._messages, self._token_counts, self.token_budget)
+
+    async def clear(self) -> None:
+        await super().clear()
+        self._token_counts = []
+
+    async def load_state(self, state: Mapping[str, Any]) -> None:
+        await super().load_state(state)
+        self._token_counts = await self._count(self._messages)
+
+    def all_messages(self) -> List[LLMMessage]:
+        """完整历史（不经过窗口裁剪）"""
+        return self._messages
+
+    def message_count(self) -> int:
+        return len(self._messages)
+
+    def total_tokens(self) -> int:
+        return sum(self._token_counts)
+
+    def truncate(self, count: int) -> None:
+        """回滚到前count条消息"""
+        del self._messages[count:]
+        del self._token_counts[count:]
+
+    def tail(self, count: int) -> Tuple[List[LLMMessage], List[int]]:
+        """前count条之后的消息及其Token数，配合replace_tail恢复时无需重新计数"""
+        return list(self._messages[count:]), list(self._token_counts[count:])
+
+    def replace_tail(self, count: int, messages: List[LLMMessage], counts: Optional[List[int]] = None) -> None:
+        """回滚到前count条消息后接上messages，用于撤销未完成的重新生成"""
+        self.truncate(count)
+        self._messages.extend(messages)
+        if counts is None or len(counts) != len(messages):
+            counts = [self._token_counter(m) for m in messages]
+        self._token_counts.extend(counts)
+
+
+def window_config(api_key: ApiKey) -> Dict[str, Any]:
+    """ApiKey.config中的上下文窗口配置"""
+    return dict((api_key.config or {}).get("context_window") or {})
+
+
+def build_strategy(config: Dict[str, Any], has_budget: bool) -> WindowStrategy:
+    # 配置了预算但未指定策略时默认使用滑动窗口
+    name = config.get("strategy") or (SlidingWindowStrategy.name if has_budget else WindowStrategy.name)
+    if name not in STRATEGIES:
+        raise ValueError(f"未知的上下文窗口策略: {name}")
+    if name == KeepSystemLastNStrategy.name:
+        return KeepSystemLastNStrategy(int(config.get("last_n", DEFAULT_LAST_N)))
+    if name == SummarizedHeadStrategy.name:
+        return SummarizedHeadStrategy(
+            int(config.get("excerpt_chars", SUMMARY_EXCERPT_CHARS)),
+            float(config.get("summary_ratio", SUMMARY_BUDGET_RATIO))
+        )
+    return STRATEGIES[name]()
+
+
+def token_budget(
+    api_key: ApiKey,
+    prompt: Prompt,
+    token_counter: TokenCounter = estimate_tokens,
+    system_tokens: Optional[int] = None
+) -> Optional[int]:
+    """ApiKey的Token预算扣除系统提示词和回复预留后，留给历史消息的部分
+
+    system_tokens为预先算好的系统提示词Token数，未提供时用token_counter计算。
+    """
+    config = window_config(api_key)
+    max_tokens = config.get("max_tokens") or api_key.max_tokens
+    if not max_tokens:
+        return None
+    reserve = int(config.get("reserve_tokens", DEFAULT_RESERVE_TOKENS))
+    if system_tokens is None:
+        system_tokens = token_counter(SystemMessage(content=prompt.content or ""))
+    return max(1, int(max_tokens) - reserve - system_tokens)
+
+
+def build_context(
+    api_key: ApiKey,
+    prompt: Prompt,
+    initial_messages: Optional[List[LLMMessage]] = None,
+    token_counter: TokenCounter = estimate_tokens,
+    initial_counts: Optional[List[int]] = None,
+    batch_counter: Optional[BatchTokenCounter] = None,
+    system_tokens: Optional[int] = None
+) -> WindowedChatCompletionContext:
+    """按ApiKey配置构造上下文窗口"""
+    budget = token_budget(api_key, prompt, token_counter, system_tokens)
+    strategy = build_strategy(window_config(api_key), budget is not None)
+    return WindowedChatCompletionContext(
+        strategy, budget, token_counter, initial_messages, initial_counts, batch_counter
+    )
+
+
+def window_signature(api_key: ApiKey) -> tuple:
+    """影响窗口构造的配置，变化后需要重建上下文"""
+    return (api_key.max_tokens, repr(sorted(window_config(api_key).items())))
@@ -0,0 +1,174 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from tracing import current_trace_id
+from .stream_buffer import StreamEventBuffer, DEFAULT_REPLAY_EVENTS
+
+# 生成结束后任务保留多久，供断线的客户端续传和查询状态
+DEFAULT_RETAIN_SECONDS = 300
+
+# 任务状态
+JOB_PENDING = "pending"
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# 结束事件与任务最终状态的对应关系
+_TERMINAL_EVENTS = {
+    "complete": JOB_COMPLETED,
+    "error": JOB_FAILED,
+    "cancelled": JOB_CANCELLED,
+}
+
+
+class GenerationJob:
+    """一次流式生成：一个生产者任务，事件写入环形缓冲区供任意多个订阅者读取"""
+
+    def __init__(
+        self,
+        task_id: str,
+        conversation_uuid: str,
+        message_uuid: str,
+        max_events: int = DEFAULT_REPLAY_EVENTS,
+        snapshot: Optional[Callable[[], str]] = None
+    ):
+        self.task_id = task_id
+        self.conversation_uuid = conversation_uuid
+        self.message_uuid = message_uuid
+        self.status = JOB_PENDING
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events = StreamEventBuffer(task_id, max_events)
+        self.events.snapshot = snapshot
+        self.task: Optional[asyncio.Task] = None
+        # 创建任务的请求的trace_id，写入除分片外的每个事件
+        self.trace_id = current_trace_id()
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+    def subscribe(self, last_event_id: int = 0) -> AsyncIterator[str]:
+        return self.events.subscribe(last_event_id)
+
+    def cancel(self) -> bool:
+        """取消生产者任务，已结束的任务返回False
+
+        已发送结束事件的任务只剩落库收尾，不再取消。
+        """
+        if self.task is None or self.task.done() or self.done:
+            return False
+        self.task.cancel()
+        return True
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "task_id": self.task_id,
+            "chat_id": self.conversation_uuid,
+            "message_id": self.message_uuid,
+            "status": self.status,
+            "error": self.error,
+            "last_event_id": self.events.last_event_id,
+            "trace_id": self.trace_id,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    async def _run(self, events: AsyncIterator[Dict[str, Any]]) -> None:
+        self.status = JOB_RUNNING
+        try:
+            async for payload in events:
+                event_type = payload.get("type")
+                if self.trace_id is not None and event_type != "chunk":
+                    payload["trace_id"] = self.trace_id
+                self.events.publish(payload)
+                if event_type == "queued":
+                    self.status = JOB_QUEUED
+                elif self.status == JOB_QUEUED:
+                    self.status = JOB_RUNNING
+                status = _TERMINAL_EVENTS.get(event_type)
+                if status:
+                    self.status = status
+                    if status == JOB_FAILED:
+                        self.error = payload.get("message")
+            if not self.done:
+                self.status = JOB_COMPLETED
+        except asyncio.CancelledError:
+            self.status = JOB_CANCELLED
+            raise
+        except Exception as e:
+            print(f"生成任务异常: {e}")
+            self.status = JOB_FAILED
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+            self.events.close()
+
+
+class GenerationJobManager:
+    """管理进程内的生成任务
+
+    生成在后台任务中运行，与HTTP响应解耦：订阅者断开或读取缓慢都不影响生成，
+    取消直接作用于真正产生Token的任务。结束的任务保留retain_seconds后移除。
+    """
+
+    def __init__(
+        self,
+        max_events: int = DEFAULT_REPLAY_EVENTS,
+        retain_seconds: float = DEFAULT_RETAIN_SECONDS
+    ):
+        self.max_events = max_events
+        self.retain_seconds = retain_seconds
+        self._jobs: Dict[str, GenerationJob] = {}
+
+    def start(
+        self,
+        task_id: str,
+        events: AsyncIterator[Dict[str, Any]],
+        conversation_uuid: str,
+        message_uuid: str,
+        snapshot: Optional[Callable[[], str]] = None
+    ) -> GenerationJob:
+        """创建任务并在后台运行事件流，snapshot返回到目前为止的完整内容，供续传时resync"""
+        job = GenerationJob(task_id, conversation_uuid, message_uuid, self.max_events, snapshot)
+        self._jobs[task_id] = job
+        job.task = asyncio.create_task(job._run(events))
+        job.task.add_done_callback(lambda _: self._schedule_remove(job))
+        return job
+
+    def get(self, task_id: str) -> Optional[GenerationJob]:
+        return self._jobs.get(task_id)
+
+    def cancel(self, task_id: str) -> bool:
+        job = self._jobs.get(task_id)
+        return job is not None and job.cancel()
+
+    def cancel_all(self) -> int:
+        """取消全部运行中的任务，返回取消的数量"""
+        return sum(1 for job in list(self._jobs.values()) if job.cancel())
+
+    def active_jobs(self) -> List[GenerationJob]:
+        return [job for job in self._jobs.values() if not job.done]
+
+    def _schedule_remove(self, job: GenerationJob) -> None:
+        asyncio.get_running_loop().call_later(self.retain_seconds, self._remove, job)
+
+    def _remove(self, job: GenerationJob) -> None:
+        if self._jobs.get(job.task_id) is job:
+            del self._jobs[job.task_id]
+
+    async def close(self) -> None:
+        """关闭时取消运行中的任务并等待其收尾（保存部分内容、归还代理）"""
+        jobs = [job for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for job in jobs:
+            job.cancel()
+        tasks = [job.task for job in jobs]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+generation_jobs = GenerationJobManager()
@@ -0,0 +1,457 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+import openai
+from sqlalchemy import select
+from autogen_core.models import ChatCompletionClient, CreateResult, LLMMessage
+
+from database import AsyncSessionLocal
+from tracing import tracer
+from models import ApiKey
+from .client_pool import client_pool
+
+# 同模型密钥列表的缓存时长，ApiKey被修改时通过invalidate立即失效
+POOL_REFRESH_SECONDS = 30.0
+# 调用失败（429/5xx/连接错误）后该密钥降级的时长
+FAILURE_COOLDOWN_SECONDS = 15.0
+# 密钥池只有一两个密钥时也至少尝试的次数，重试同一密钥前按次数退避
+MIN_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 0.5
+# 首Token耗时的指数平均系数
+LATENCY_ALPHA = 0.3
+# 对冲请求：未配置after_ms时的等待时间，按分位数计算时的样本窗口和最少样本数
+DEFAULT_HEDGE_AFTER_MS = 1000
+HEDGE_SAMPLE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+# 每个密钥同时进行的对冲请求上限
+DEFAULT_HEDGE_MAX_IN_FLIGHT = 2
+
+Member = Tuple[int, ChatCompletionClient]
+
+# 流在第一个分片之前就结束
+_EMPTY = object()
+# 后台关闭输掉的对冲流，保留引用避免任务被回收
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _spawn(coroutine) -> None:
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def pool_enabled(api_key: ApiKey) -> bool:
+    """ApiKey.config["key_pool"]为False时该密钥不参与同模型密钥池"""
+    return (api_key.config or {}).get("key_pool", True) is not False
+
+
+def pool_key(api_key: ApiKey) -> Tuple[str, str, Optional[str]]:
+    """密钥池的分组：只有模型、地址和提供商都相同的密钥才互相替换，不会切换到其他服务商"""
+    return (api_key.model_name, api_key.model_url, api_key.provider)
+
+
+def hedge_config(api_key: ApiKey) -> Optional[Dict[str, Any]]:
+    """ApiKey.config中的对冲配置，未启用时返回None
+
+    enabled、after_ms（等待首Token的毫秒数）、percentile（按同模型最近首Token耗时的分位数计算等待时间，
+    样本不足时使用after_ms）、min_ms/max_ms（分位数结果的上下限）、max_in_flight（每个密钥的对冲并发上限）
+    """
+    config = (api_key.config or {}).get("hedge") or {}
+    return dict(config) if config.get("enabled") else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """429、5xx和连接错误可以换一个密钥重试"""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, openai.APIConnectionError)
+
+
+@dataclass
+class KeyStats:
+    """单个ApiKey在本进程内的调用统计"""
+    in_flight: int = 0
+    latency: Optional[float] = None
+    requests: int = 0
+    failures: int = 0
+    cooldown_until: float = 0.0
+    # 作为对冲目标进行中的请求数、累计发起数和胜出数
+    hedges_in_flight: int = 0
+    hedged: int = 0
+    hedge_wins: int = 0
+
+    def cooling(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+
+class RoutedChatCompletionClient(ChatCompletionClient):
+    """在同模型的多个ApiKey之间路由的模型客户端
+
+    每次调用按进行中的请求数和最近的首Token耗时挑选密钥；在收到第一个分片之前遇到
+    429/5xx或连接错误时换一个密钥重试，已经开始输出的流不再切换，错误直接抛出。
+    模型信息和Token计数沿用会话绑定的密钥（members中的第一个）。
+
+    会话密钥开启了对冲时，流式调用在等待首Token超过阈值后向另一个同模型密钥发出相同的请求，
+    先返回首个分片的一路胜出，另一路取消。
+    """
+
+    def __init__(
+        self,
+        router: "KeyRouter",
+        members: List[Member],
+        model_name: Optional[str] = None,
+        hedge: Optional[Dict[str, Any]] = None
+    ):
+        self._router = router
+        self.members = members
+        self.model_name = model_name
+        self.hedge = hedge
+        self._primary = members[0][1]
+
+    def _attempts(self) -> int:
+        return max(MIN_ATTEMPTS, len(self.members))
+
+    async def _before_attempt(self, attempt: int, tried: Set[int]) -> Member:
+        member = self._router.pick(self.members, tried)
+        if member[0] in tried:
+            # 所有密钥都已失败过，重试前退避；429的Retry-After由限速器负责等待
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * attempt)
+        tried.add(member[0])
+        return member
+
+    async def create(self, messages: Sequence[LLMMessage], **kwargs) -> CreateResult:
+        tried: Set[int] = set()
+        for attempt in range(self._attempts()):
+            api_key_id, client = await self._before_attempt(attempt, tried)
+            started = self._router.begin(api_key_id)
+            try:
+                with tracer.span("model.create", api_key_id=api_key_id, model=self.model_name, attempt=attempt):
+                    result = await client.create(messages, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self._router.failed(api_key_id, e)
+                if attempt + 1 >= self._attempts():
+                    raise
+                continue
+            finally:
+                self._router.end(api_key_id)
+            self._router.succeeded(api_key_id, started)
+            return result
+
+    async def _open(self, member: Member, messages: Sequence[LLMMessage], kwargs: Dict[str, Any]):
+        """发起一路流式调用并等待第一个分片，失败或被取消时关闭这一路
+
+        span从发起到流结束，跨越多次yield，不设为当前span，由create_stream或_discard结束。
+        """
+        api_key_id, client = member
+        started = self._router.begin(api_key_id)
+        span = tracer.start_span("model.stream", api_key_id=api_key_id, model=self.model_name)
+        stream = client.create_stream(messages, **kwargs)
+        try:
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = _EMPTY
+        except BaseException as e:
+            self._router.end(api_key_id)
+            if span is not None:
+                # 对冲输掉的一路被取消，不算错误
+                if isinstance(e, asyncio.CancelledError):
+                    span.set(cancelled=True)
+                    span.end()
+                else:
+                    span.end(e)
+            await stream.aclose()
+            if isinstance(e, Exception) and is_retryable(e):
+                self._router.failed(api_key_id, e)
+            raise
+        self._router.succeeded(api_key_id, started, self.model_name)
+        if span is not None:
+            span.set(first_chunk_ms=round((time.monotonic() - started) * 1000, 3))
+        return api_key_id, stream, first, span
+
+    async def _open_hedged(self, member: Member, tried: Set[int], messages: Sequence[LLMMessage], kwargs: Dict[str, Any]):
+        """首Token超过阈值仍未到达时向另一个密钥发出对冲请求，返回先出首个分片的一路"""
+        delay = self._router.hedge_delay(self.model_name, self.hedge)
+        tasks: Dict[asyncio.Task, int] = {asyncio.create_task(self._open(member, messages, kwargs)): member[0]}
+        hedge_id = None
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                alternate = self._router.hedge_target(self.members, tried | {member[0]}, self.hedge)
+                if alternate is not None:
+                    hedge_id = alternate[0]
+                    tried.add(hedge_id)
+                    tasks[asyncio.create_task(self._open(alternate, messages, kwargs))] = hedge_id
+
+            pending = set(tasks)
+            error = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and winner is None:
+                        winner = task
+                    elif task.exception() is not None and error is None:
+                        error = task.exception()
+            if winner is None:
+                raise error
+            if hedge_id is not None and tasks[winner] == hedge_id:
+                self._router.hedge_won(hedge_id)
+            return winner.result()
+        finally:
+            # 输掉的一路取消后在自己的任务中关闭流；同时完成的一路在后台关闭
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    _spawn(self._discard(task.result()))
+            if hedge_id is not None:
+                _spawn(self._release_hedge(tasks, hedge_id, winner))
+
+    async def _discard(self, opened) -> None:
+        api_key_id, stream, _, span = opened
+        self._router.end(api_key_id)
+        if span is not None:
+            span.set(discarded=True)
+            span.end()
+        await stream.aclose()
+
+    async def _release_hedge(self, tasks: Dict[asyncio.Task, int], hedge_id: int, winner) -> None:
+        """对冲的一路结束后释放名额；胜出时由create_stream在流结束后释放"""
+        if winner is not None and tasks[winner] == hedge_id:
+            return
+        await asyncio.gather(*[task for task, key in tasks.items() if key == hedge_id], return_exceptions=True)
+        self._router.hedge_done(hedge_id)
+
+    async def create_stream(self, messages: Sequence[LLMMessage], **kwargs):
+        tried: Set[int] = set()
+        for attempt in range(self._attempts()):
+            member = await self._before_attempt(attempt, tried)
+            try:
+                if self.hedge is not None and len(self.members) > 1:
+                    api_key_id, stream, first, span = await self._open_hedged(member, tried, messages, kwargs)
+                else:
+                    api_key_id, stream, first, span = await self._open(member, messages, kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt + 1 >= self._attempts():
+                    raise
+                continue
+
+            hedged = api_key_id != member[0]
+            if span is not None:
+                span.set(attempt=attempt, hedged=hedged)
+            try:
+                if first is _EMPTY:
+                    return
+                yield first
+                async for item in stream:
+                    yield item
+                return
+            except BaseException as e:
+                if span is not None:
+                    span.end(e)
+                raise
+            finally:
+                if span is not None:
+                    span.end()
+                self._router.end(api_key_id)
+                if hedged:
+                    self._router.hedge_done(api_key_id)
+                await stream.aclose()
+
+    async def close(self) -> None:
+        # 成员客户端归连接池管理
+        pass
+
+    def actual_usage(self):
+        return self._primary.actual_usage()
+
+    def total_usage(self):
+        return self._primary.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], **kwargs) -> int:
+        return self._primary.count_tokens(messages, **kwargs)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], **kwargs) -> int:
+        return self._primary.remaining_tokens(messages, **kwargs)
+
+    @property
+    def capabilities(self):
+        return self._primary.capabilities
+
+    @property
+    def model_info(self):
+        return self._primary.model_info
+
+
+class KeyRouter:
+    """同模型ApiKey的负载均衡
+
+    会话仍绑定一个ApiKey，但调用时可以使用任意status为active、model_name、model_url和provider
+    都相同且未关闭key_pool的密钥。密钥按（是否处于失败降级期，进行中的请求数，最近首Token耗时）排序，
+    并列时优先会话绑定的密钥。统计只在本进程内有效。
+    """
+
+    def __init__(self, refresh_seconds: float = POOL_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._pools: Dict[Tuple[str, str, Optional[str]], Tuple[float, List[ApiKey]]] = {}
+        self._routes: Dict[int, RoutedChatCompletionClient] = {}
+        self._stats: Dict[int, KeyStats] = {}
+        # 按模型记录最近的首Token耗时，用于计算对冲阈值
+        self._ttft: Dict[str, Deque[float]] = {}
+
+    async def _pool_keys(self, api_key: ApiKey) -> List[ApiKey]:
+        group = pool_key(api_key)
+        now = time.monotonic()
+        entry = self._pools.get(group)
+        if entry and now - entry[0] < self.refresh_seconds:
+            return entry[1]
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(ApiKey)
+                    .where(
+                        ApiKey.model_name == api_key.model_name,
+                        ApiKey.model_url == api_key.model_url,
+                        ApiKey.status == "active"
+                    )
+                    .order_by(ApiKey.id)
+                )
+                keys = [
+                    key for key in result.scalars().all()
+                    if pool_enabled(key) and pool_key(key) == group
+                ]
+        except Exception as e:
+            print(f"加载同模型密钥失败: {e}")
+            keys = entry[1] if entry else []
+        self._pools[group] = (now, keys)
+        return keys
+
+    async def client(self, api_key: ApiKey) -> RoutedChatCompletionClient:
+        """获取会话密钥对应的路由客户端，密钥池不变时返回同一个对象"""
+        members: List[Member] = [(api_key.id, client_pool.get(api_key))]
+        if pool_enabled(api_key):
+            for key in await self._pool_keys(api_key):
+                if key.id != api_key.id:
+                    members.append((key.id, client_pool.get(key)))
+
+        hedge = hedge_config(api_key)
+        route = self._routes.get(api_key.id)
+        if route is None or route.members != members or route.hedge != hedge:
+            route = RoutedChatCompletionClient(self, members, api_key.model_name, hedge)
+            self._routes[api_key.id] = route
+        return route
+
+    def invalidate(self) -> None:
+        """ApiKey增删改后调用，下次获取时重新加载密钥池"""
+        self._pools.clear()
+
+    def _stat(self, api_key_id: int) -> KeyStats:
+        stats = self._stats.get(api_key_id)
+        if stats is None:
+            stats = self._stats[api_key_id] = KeyStats()
+        return stats
+
+    def pick(self, members: List[Member], tried: Set[int]) -> Member:
+        """挑选本次调用使用的密钥，优先未尝试过的"""
+        now = time.monotonic()
+        candidates = [member for member in members if member[0] not in tried] or members
+
+        def rank(member: Member):
+            stats = self._stat(member[0])
+            # 没有耗时记录的密钥按0计，新加入的密钥能尽快分到流量
+            return (stats.cooling(now), stats.in_flight, stats.latency or 0.0)
+
+        return min(candidates, key=rank)
+
+    def begin(self, api_key_id: int) -> float:
+        stats = self._stat(api_key_id)
+        stats.in_flight += 1
+        stats.requests += 1
+        return time.monotonic()
+
+    def end(self, api_key_id: int) -> None:
+        self._stat(api_key_id).in_flight -= 1
+
+    def succeeded(self, api_key_id: int, started: float, model_name: Optional[str] = None) -> None:
+        stats = self._stat(api_key_id)
+        latency = time.monotonic() - started
+        stats.latency = latency if stats.latency is None else (
+            LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * stats.latency
+        )
+        stats.cooldown_until = 0.0
+        if model_name is not None:
+            samples = self._ttft.get(model_name)
+            if samples is None:
+                samples = self._ttft[model_name] = deque(maxlen=HEDGE_SAMPLE_WINDOW)
+            samples.append(latency)
+
+    def hedge_delay(self, model_name: Optional[str], config: Dict[str, Any]) -> float:
+        """发出对冲请求前等待首Token的秒数：配置了percentile且样本足够时取分位数，否则取after_ms"""
+        delay = float(config.get("after_ms", DEFAULT_HEDGE_AFTER_MS)) / 1000
+        samples = self._ttft.get(model_name)
+        if config.get("percentile") and samples and len(samples) >= HEDGE_MIN_SAMPLES:
+            ordered = sorted(samples)
+            index = min(len(ordered) - 1, int(float(config["percentile"]) / 100 * (len(ordered) - 1)))
+            delay = ordered[index]
+            if config.get("min_ms") is not None:
+                delay = max(delay, float(config["min_ms"]) / 1000)
+            if config.get("max_ms") is not None:
+                delay = min(delay, float(config["max_ms"]) / 1000)
+        return delay
+
+    def hedge_target(self, members: List[Member], exclude: Set[int], config: Dict[str, Any]) -> Optional[Member]:
+        """挑选对冲目标：未尝试过、不在降级期且对冲并发未达上限的密钥，没有可用密钥时不对冲"""
+        now = time.monotonic()
+        limit = int(config.get("max_in_flight", DEFAULT_HEDGE_MAX_IN_FLIGHT))
+        candidates = [
+            member for member in members
+            if member[0] not in exclude
+            and not self._stat(member[0]).cooling(now)
+            and self._stat(member[0]).hedges_in_flight < limit
+        ]
+        if not candidates:
+            return None
+        member = self.pick(candidates, set())
+        stats = self._stat(member[0])
+        stats.hedges_in_flight += 1
+        stats.hedged += 1
+        return member
+
+    def hedge_won(self, api_key_id: int) -> None:
+        self._stat(api_key_id).hedge_wins += 1
+
+    def hedge_done(self, api_key_id: int) -> None:
+        self._stat(api_key_id).hedges_in_flight -= 1
+
+    def failed(self, api_key_id: int, error: Exception) -> None:
+        stats = self._stat(api_key_id)
+        stats.failures += 1
+        stats.cooldown_until = time.monotonic() + FAILURE_COOLDOWN_SECONDS
+        print(f"ApiKey {api_key_id} 调用失败: {error}")
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        now = time.monotonic()
+        return {
+            api_key_id: {
+                "in_flight": stats.in_flight,
+                "latency": stats.latency,
+                "requests": stats.requests,
+                "failures": stats.failures,
+                "cooling": stats.cooling(now),
+                "hedges_in_flight": stats.hedges_in_flight,
+                "hedged": stats.hedged,
+                "hedge_wins": stats.hedge_wins,
+            }
+            for api_key_id, stats in self._stats.items()
+        }
+
+
+key_router = KeyRouter()
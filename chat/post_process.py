@@ -0,0 +1,300 @@
+import asyncio
+import os
+import socket
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update, delete, and_, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from metrics import observe_tokens_per_second
+from models import Conversation, Message, PostTask
+from models.post_task import TASK_PENDING, TASK_RUNNING, TASK_FAILED
+from .tokenizer import tokenizer
+from .response_cache import response_cache
+
+# worker数量
+POST_WORKERS = 4
+# 未完成的任务数上限，超过时enqueue等待，生成任务因此迟迟不归还并发名额
+POST_MAX_BACKLOG = 1000
+# 最多执行次数，失败后按指数退避重试
+POST_MAX_ATTEMPTS = 5
+POST_RETRY_BASE_SECONDS = 1
+POST_RETRY_MAX_SECONDS = 60
+# 没有通知时的轮询间隔；其他进程领取后超过POST_STALE_SECONDS未完成的任务视为所属进程已退出
+POST_POLL_INTERVAL = 2.0
+POST_STALE_SECONDS = 60
+# 关闭时等待已就绪任务处理完的最长时间
+POST_DRAIN_SECONDS = 10.0
+POST_FETCH_SIZE = 50
+
+# 任务类型
+TASK_MESSAGE_TOKENS = "message_tokens"
+TASK_CONVERSATION_STATS = "conversation_stats"
+TASK_REPLY_CACHE = "reply_cache"
+
+PostHandler = Callable[[AsyncSession, Dict[str, Any]], Awaitable[None]]
+
+
+class PostProcessPool:
+    """回复完成后的后处理队列
+
+    任务与回复在同一个事务中写入post_tasks表，进程退出也不会丢失。后台分发协程按ID顺序
+    领取就绪的任务交给worker，处理函数的数据库写入与删除任务在同一事务提交，
+    重试不会重复累加计数。失败按指数退避重试，达到上限后标记为failed保留在表中。
+    未完成的任务过多时enqueue等待（背压）；关闭时在限定时间内处理完已就绪的任务，
+    剩余的留在表中，下次启动（或其他进程）继续。
+    """
+
+    def __init__(
+        self,
+        workers: int = POST_WORKERS,
+        max_backlog: int = POST_MAX_BACKLOG,
+        max_attempts: int = POST_MAX_ATTEMPTS,
+        poll_interval: float = POST_POLL_INTERVAL,
+        stale_seconds: int = POST_STALE_SECONDS
+    ):
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self._handlers: Dict[str, PostHandler] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._backlog = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+        self._closing = False
+        self._instance = uuid.uuid4().hex[:8]
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def worker_id(self) -> str:
+        # 带实例标识，容器重启后主机名和进程号可能不变，新进程仍能接管旧进程遗留的任务
+        return f"{socket.gethostname()}:{os.getpid()}:{self._instance}"
+
+    def register(self, kind: str, handler: PostHandler) -> None:
+        """注册任务类型的处理函数，处理函数不提交事务"""
+        self._handlers[kind] = handler
+
+    async def enqueue(self, db: AsyncSession, kind: str, payload: Dict[str, Any]) -> None:
+        """在调用方的事务中写入任务，随调用方一起提交，提交后调用notify
+
+        未完成的任务达到max_backlog时先等待worker消化。
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"未注册的后处理任务类型: {kind}")
+        while self._dispatcher is not None and self._backlog >= self.max_backlog:
+            self._space.clear()
+            await self._space.wait()
+        db.add(PostTask(kind=kind, payload=payload, status=TASK_PENDING))
+        self._backlog += 1
+
+    def notify(self) -> None:
+        """唤醒分发协程，不必等到下一次轮询"""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        """启动分发协程和worker，启动后先处理上次进程留下的任务"""
+        if self._dispatcher is None:
+            self._closing = False
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def close(self, timeout: float = POST_DRAIN_SECONDS) -> None:
+        if self._dispatcher is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._dispatcher), timeout)
+        except asyncio.TimeoutError:
+            print(f"后处理队列未在{timeout}秒内处理完，剩余任务下次启动继续")
+        except Exception as e:
+            print(f"后处理队列关闭异常: {e}")
+
+        tasks = [self._dispatcher, *self._workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._workers = []
+        self._space.set()
+        # 已领取但没处理完的任务放回pending
+        await self._release_claimed()
+
+    def _stale_threshold(self):
+        return func.datetime("now", f"-{self.stale_seconds} seconds")
+
+    def _ready(self):
+        # 只接管其他进程遗留的过期任务；本进程领取的任务仍在worker中执行，重复领取会重复累加计数
+        return or_(
+            and_(PostTask.status == TASK_PENDING, PostTask.run_after <= func.now()),
+            and_(
+                PostTask.status == TASK_RUNNING,
+                PostTask.owner != self.worker_id,
+                PostTask.claimed_at < self._stale_threshold()
+            )
+        )
+
+    async def _claim(self, limit: int) -> List[Tuple[int, str, Dict[str, Any], int]]:
+        """领取就绪的任务，同时用表中未完成的任务数校正背压计数"""
+        async with AsyncSessionLocal() as db:
+            ids = select(PostTask.id).where(self._ready()).order_by(PostTask.id.asc()).limit(limit)
+            result = await db.execute(
+                update(PostTask)
+                .where(PostTask.id.in_(ids.scalar_subquery()), self._ready())
+                .values(
+                    status=TASK_RUNNING,
+                    owner=self.worker_id,
+                    claimed_at=func.now(),
+                    attempts=PostTask.attempts + 1
+                )
+                .returning(PostTask.id, PostTask.kind, PostTask.payload, PostTask.attempts)
+            )
+            claimed = sorted(tuple(row) for row in result.all())
+            await db.commit()
+            self._set_backlog(await db.scalar(
+                select(func.count(PostTask.id)).where(PostTask.status.in_([TASK_PENDING, TASK_RUNNING]))
+            ))
+        return claimed
+
+    def _set_backlog(self, backlog: int) -> None:
+        self._backlog = backlog
+        if backlog < self.max_backlog:
+            self._space.set()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            try:
+                claimed = await self._claim(POST_FETCH_SIZE)
+            except Exception as e:
+                print(f"领取后处理任务失败: {e}")
+                claimed = []
+            for task in claimed:
+                await self._queue.put(task)
+            if len(claimed) >= POST_FETCH_SIZE:
+                continue
+
+            if self._closing:
+                # 等已分发的任务处理完，确认没有新的就绪任务后退出
+                await self._queue.join()
+                if not claimed:
+                    return
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self) -> None:
+        while True:
+            task_id, kind, payload, attempts = await self._queue.get()
+            try:
+                await self._execute(task_id, kind, payload, attempts)
+            finally:
+                self._queue.task_done()
+
+    async def _execute(self, task_id: int, kind: str, payload: Dict[str, Any], attempts: int) -> None:
+        try:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                raise ValueError(f"未注册的后处理任务类型: {kind}")
+            async with AsyncSessionLocal() as db:
+                await handler(db, payload or {})
+                await db.execute(delete(PostTask).where(PostTask.id == task_id))
+                await db.commit()
+            self.processed += 1
+            self._set_backlog(max(0, self._backlog - 1))
+        except Exception as e:
+            print(f"后处理任务失败: {kind} {e}")
+            await self._retry_later(task_id, attempts, str(e))
+
+    async def _retry_later(self, task_id: int, attempts: int, error: str) -> None:
+        if attempts >= self.max_attempts:
+            values = {"status": TASK_FAILED, "error": error}
+            self.failed += 1
+            self._set_backlog(max(0, self._backlog - 1))
+        else:
+            delay = min(POST_RETRY_MAX_SECONDS, POST_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+            values = {
+                "status": TASK_PENDING,
+                "error": error,
+                "run_after": func.datetime("now", f"+{delay} seconds")
+            }
+            self.retried += 1
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(PostTask).where(PostTask.id == task_id).values(**values))
+                await db.commit()
+        except Exception as e:
+            # 任务保持running，过期后重新领取
+            print(f"更新后处理任务状态失败: {e}")
+
+    async def _release_claimed(self) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(PostTask)
+                    .where(PostTask.status == TASK_RUNNING, PostTask.owner == self.worker_id)
+                    .values(status=TASK_PENDING, attempts=PostTask.attempts - 1)
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"重置后处理任务状态失败: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "backlog": self._backlog,
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+async def count_message_tokens(db: AsyncSession, payload: Dict[str, Any]) -> None:
+    """按对话所用模型的编码器计算消息的Token数
+
+    payload带throughput时，用回复的Token数和生成耗时记录生成速度指标。
+    """
+    result = await db.execute(
+        select(Message.id, Message.uuid, Message.content).where(Message.uuid.in_(payload["message_uuids"]))
+    )
+    rows = result.all()
+    if not rows:
+        return
+    counts = await tokenizer.acount_batch([content for _, _, content in rows], payload.get("model_name"))
+    throughput = payload.get("throughput")
+    for (message_id, message_uuid, _), count in zip(rows, counts):
+        await db.execute(update(Message).where(Message.id == message_id).values(token_count=count))
+        if throughput and message_uuid == throughput["message_uuid"]:
+            observe_tokens_per_second(
+                count, throughput["seconds"], throughput["api_key_id"], payload.get("model_name")
+            )
+
+
+async def update_conversation_stats(db: AsyncSession, payload: Dict[str, Any]) -> None:
+    """累加对话的消息数"""
+    await db.execute(
+        update(Conversation)
+        .where(Conversation.id == payload["conversation_id"])
+        .values(message_count=Conversation.message_count + payload.get("messages", 1))
+    )
+
+
+async def store_reply(db: AsyncSession, payload: Dict[str, Any]) -> None:
+    """模型新生成的回复写入精确匹配的回复缓存，与删除任务在同一事务提交"""
+    await response_cache.write(db, payload["key"], payload["model_name"], payload["content"], payload["ttl"])
+
+
+post_processor = PostProcessPool()
+post_processor.register(TASK_MESSAGE_TOKENS, count_message_tokens)
+post_processor.register(TASK_CONVERSATION_STATS, update_conversation_stats)
+post_processor.register(TASK_REPLY_CACHE, store_reply)
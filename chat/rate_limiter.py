@@ -0,0 +1,169 @@
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional
+
+from models import ApiKey
+
+# 没有指定max_tokens时按此估算回复占用的Token
+DEFAULT_COMPLETION_TOKENS = 512
+# 单次暂停的上限，防止异常的Retry-After把请求挂起太久
+MAX_PAUSE_SECONDS = 120.0
+
+
+def rate_limit_config(api_key: ApiKey) -> Dict[str, Any]:
+    """ApiKey.config中的限速配置：rpm（每分钟请求数）、tpm（每分钟Token数）"""
+    return dict((api_key.config or {}).get("rate_limit") or {})
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """解析Retry-After（秒数或HTTP日期）以及retry-after-ms，返回需要等待的秒数"""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟额度，按额度/60的速率连续补充
+
+    余量允许为负，按实际用量补扣后，超出的部分由后续请求等待补回。
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """还需等待多少秒才能取出amount（超过容量时按容量计算）"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate) if missing > 0 else 0.0
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, remaining: float) -> None:
+        """按服务端返回的剩余额度校准，只向下调整（同一密钥可能还有其他调用方）"""
+        self._refill()
+        if remaining < self.level:
+            self.level = remaining
+
+
+class KeyRateLimiter:
+    """单个ApiKey的请求数桶与Token桶
+
+    调用前按估算的Token数等待两个桶都有余量，调用后按实际用量补扣或退还；
+    收到Retry-After时在指定时间内暂停所有调用。等待的调用按到达顺序依次放行。
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self._lock = asyncio.Lock()
+        self._paused_until = 0.0
+        self.configure(rpm, tpm)
+
+    def configure(self, rpm: Optional[int], tpm: Optional[int]) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def _delay(self, tokens: int) -> float:
+        delay = max(0.0, self._paused_until - time.monotonic())
+        if self.requests:
+            delay = max(delay, self.requests.delay(1))
+        if self.tokens:
+            delay = max(delay, self.tokens.delay(tokens))
+        return delay
+
+    async def acquire(self, tokens: int) -> float:
+        """等待额度并扣除，返回等待的秒数"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                delay = self._delay(tokens)
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+                waited += delay
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+        return waited
+
+    def reconcile(self, estimated: int, actual: int) -> None:
+        """按实际用量修正调用前的估算"""
+        if self.tokens and actual > 0:
+            difference = estimated - actual
+            if difference > 0:
+                self.tokens.give(difference)
+            elif difference < 0:
+                self.tokens.take(-difference)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + min(seconds, MAX_PAUSE_SECONDS))
+
+    def observe(self, status_code: int, headers: Mapping[str, str]) -> None:
+        """根据上游响应头校准：429/503的Retry-After暂停调用，x-ratelimit-*校准余量"""
+        if status_code in (429, 503):
+            retry_after = parse_retry_after(headers)
+            if retry_after:
+                self.pause(retry_after)
+
+        for bucket, name in ((self.requests, "requests"), (self.tokens, "tokens")):
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if bucket is None or remaining is None:
+                continue
+            try:
+                bucket.sync(float(remaining))
+            except ValueError:
+                continue
+
+
+class RateLimiterRegistry:
+    """按ApiKey.id管理限速器，每次获取时读取最新配置"""
+
+    def __init__(self):
+        self._limiters: Dict[int, KeyRateLimiter] = {}
+
+    def limiter(self, api_key: ApiKey) -> KeyRateLimiter:
+        config = rate_limit_config(api_key)
+        rpm = int(config["rpm"]) if config.get("rpm") else None
+        tpm = int(config["tpm"]) if config.get("tpm") else None
+
+        limiter = self._limiters.get(api_key.id)
+        if limiter is None:
+            limiter = KeyRateLimiter(rpm, tpm)
+            self._limiters[api_key.id] = limiter
+        elif (limiter.rpm, limiter.tpm) != (rpm, tpm):
+            limiter.configure(rpm, tpm)
+        return limiter
+
+
+rate_limits = RateLimiterRegistry()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from autogen_core.models import LLMMessage
+
+from database import AsyncSessionLocal
+from models import Prompt, ResponseCacheEntry
+
+# 内存层最多保留的条目数
+DEFAULT_MEMORY_ENTRIES = 512
+# 未配置ttl时缓存的有效期（秒）
+DEFAULT_TTL_SECONDS = 3600
+# 清理SQLite中过期条目的最小间隔
+PRUNE_INTERVAL_SECONDS = 600
+# 命中后按此长度切分缓存内容回放
+REPLAY_CHUNK_CHARS = 64
+
+
+def cache_config(prompt: Prompt) -> Dict[str, Any]:
+    """Prompt.config中的回复缓存配置：enabled（是否启用）、ttl（有效期秒数）"""
+    return dict((prompt.config or {}).get("response_cache") or {})
+
+
+def cache_ttl(prompt: Prompt) -> Optional[int]:
+    """提示词开启了缓存时返回有效期，否则返回None"""
+    config = cache_config(prompt)
+    if not config.get("enabled"):
+        return None
+    return max(1, int(config.get("ttl", DEFAULT_TTL_SECONDS)))
+
+
+def request_key(model_name: str, system_message: str, history: Sequence[LLMMessage], user_content: str) -> str:
+    """按实际发送给模型的内容计算缓存键：模型、系统提示词、窗口内的历史和本轮用户消息"""
+    payload = {
+        "model": model_name,
+        "system": system_message,
+        "history": [message.model_dump(mode="json") for message in history],
+        "user": user_content,
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def replay_chunks(content: str, size: int = REPLAY_CHUNK_CHARS) -> Iterator[str]:
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+class ResponseCache:
+    """模型回复的精确匹配缓存
+
+    内存层是按最近使用淘汰的LRU，SQLite层跨进程、跨重启共享。查询先查内存，
+    未命中再查SQLite并回填内存。条目按写入时的ttl过期，过期条目在查询时忽略、定期清理。
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._last_prune = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, key: str, content: str, ttl: float) -> None:
+        self._memory[key] = (time.time() + ttl, content)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._memory[key]
+
+        try:
+            async with AsyncSessionLocal() as db:
+                row = (await db.execute(
+                    select(
+                        ResponseCacheEntry.content,
+                        (func.julianday(ResponseCacheEntry.expires_at) - func.julianday("now")) * 86400
+                    ).where(
+                        ResponseCacheEntry.cache_key == key,
+                        ResponseCacheEntry.expires_at > func.datetime("now")
+                    )
+                )).first()
+        except Exception as e:
+            print(f"读取回复缓存失败: {e}")
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+        content, remaining = row
+        self._remember(key, content, remaining or 0)
+        self.hits += 1
+        return content
+
+    async def write(self, db: AsyncSession, key: str, model_name: str, content: str, ttl: int) -> None:
+        """在调用方的事务中写入两层缓存，调用方负责提交，失败时抛出异常"""
+        self._remember(key, content, ttl)
+        expires_at = func.datetime("now", f"+{int(ttl)} seconds")
+        stmt = insert(ResponseCacheEntry).values(
+            cache_key=key, model_name=model_name, content=content, expires_at=expires_at
+        )
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[ResponseCacheEntry.cache_key],
+            set_={"content": content, "model_name": model_name, "expires_at": expires_at}
+        ))
+        if time.monotonic() - self._last_prune >= PRUNE_INTERVAL_SECONDS:
+            self._last_prune = time.monotonic()
+            await db.execute(
+                delete(ResponseCacheEntry).where(ResponseCacheEntry.expires_at <= func.datetime("now"))
+            )
+
+    async def put(self, key: str, model_name: str, content: str, ttl: int) -> None:
+        """用独立的会话写入两层缓存，失败只记录日志，不影响本轮回复"""
+        try:
+            async with AsyncSessionLocal() as db:
+                await self.write(db, key, model_name, content, ttl)
+                await db.commit()
+        except Exception as e:
+            print(f"写入回复缓存失败: {e}")
+
+    def clear_memory(self) -> None:
+        self._memory.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._memory), "hits": self.hits, "misses": self.misses}
+
+
+response_cache = ResponseCache()
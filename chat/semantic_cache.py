@@ -0,0 +1,215 @@
+import asyncio
+import re
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from models import Prompt
+
+try:
+    import numpy as np
+except ImportError:  # numpy为可选依赖，缺失时语义缓存不生效
+    np = None
+
+# 默认配置：相似度阈值、有效期（秒）、每个分区的条目上限
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_EMBEDDER = "hashing"
+# 哈希嵌入的维度和字符n-gram长度
+HASHING_DIMENSIONS = 1024
+HASHING_NGRAMS = (2, 3, 4)
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def semantic_config(prompt: Prompt) -> Dict[str, Any]:
+    """Prompt.config中的语义缓存配置
+
+    enabled（是否启用）、threshold（命中所需的余弦相似度）、ttl、max_entries、
+    embedder（嵌入器名称）、any_turn（默认只在对话首轮使用，历史不同的回复不宜复用）
+    """
+    return dict((prompt.config or {}).get("semantic_cache") or {})
+
+
+class HashingEmbedder:
+    """离线可用的哈希嵌入：词与字符n-gram按哈希分桶计数后归一化
+
+    不依赖模型文件，对措辞的细微差异（标点、大小写、个别字词）不敏感，
+    适合识别近似重复的问题，不理解同义改写。
+    """
+
+    def __init__(self, dimensions: int = HASHING_DIMENSIONS, ngrams: Tuple[int, ...] = HASHING_NGRAMS):
+        self.dimensions = dimensions
+        self.ngrams = ngrams
+
+    def _features(self, text: str) -> List[str]:
+        text = text.lower()
+        words = _WORD_PATTERN.findall(text)
+        features = [f"w:{word}" for word in words]
+        # 字符n-gram不跨越空白，中文等不分词的文本也能得到有效特征
+        compact = " ".join(words)
+        for n in self.ngrams:
+            features.extend(f"c{n}:{compact[i:i + n]}" for i in range(len(compact) - n + 1))
+        return features
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                # crc32在进程间稳定，高位决定符号以抵消哈希冲突
+                digest = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dimensions] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+_embedders: Dict[str, Callable[[], Any]] = {"hashing": HashingEmbedder}
+
+
+def register_embedder(name: str, factory: Callable[[], Any]) -> None:
+    """注册本地嵌入器：factory返回带embed(texts) -> 归一化矩阵方法的对象"""
+    _embedders[name] = factory
+
+
+@dataclass
+class SemanticLookup:
+    """一次语义缓存查询的结果，未命中时similarity为最接近条目的相似度"""
+    hit: bool
+    similarity: Optional[float]
+    content: Optional[str] = None
+    vector: Optional[Any] = None
+
+    def info(self) -> Dict[str, Any]:
+        similarity = round(self.similarity, 4) if self.similarity is not None else None
+        return {"type": "semantic", "hit": self.hit, "similarity": similarity}
+
+
+class VectorPartition:
+    """单个（提示词, 模型）分区的向量矩阵，容量按需翻倍，满时淘汰最早写入的条目"""
+
+    def __init__(self, dimensions: int, max_entries: int):
+        self.max_entries = max_entries
+        self.size = 0
+        self._vectors = np.zeros((min(64, max_entries), dimensions), dtype=np.float32)
+        self._contents: List[str] = []
+        self._expires = np.zeros(self._vectors.shape[0], dtype=np.float64)
+
+    def search(self, vector: "np.ndarray") -> Tuple[Optional[int], Optional[float]]:
+        if self.size == 0:
+            return None, None
+        scores = self._vectors[:self.size] @ vector
+        scores[self._expires[:self.size] <= time.time()] = -np.inf
+        index = int(np.argmax(scores))
+        if not np.isfinite(scores[index]):
+            return None, None
+        return index, float(scores[index])
+
+    def content(self, index: int) -> str:
+        return self._contents[index]
+
+    def add(self, vector: "np.ndarray", content: str, ttl: float) -> None:
+        if self.size >= self.max_entries:
+            self._drop_oldest(self.size - self.max_entries + max(1, self.max_entries // 10))
+        if self.size >= self._vectors.shape[0]:
+            capacity = min(self.max_entries, self._vectors.shape[0] * 2)
+            self._vectors = np.resize(self._vectors, (capacity, self._vectors.shape[1]))
+            self._expires = np.resize(self._expires, capacity)
+        self._vectors[self.size] = vector
+        self._expires[self.size] = time.time() + ttl
+        self._contents.append(content)
+        self.size += 1
+
+    def _drop_oldest(self, count: int) -> None:
+        keep = max(0, self.size - count)
+        count = self.size - keep
+        self._vectors[:keep] = self._vectors[count:self.size]
+        self._expires[:keep] = self._expires[count:self.size]
+        self._contents = self._contents[count:]
+        self.size = keep
+
+
+class SemanticCache:
+    """按用户消息相似度复用回复的语义缓存
+
+    索引只保存在进程内存中，按（提示词ID, 模型）分区，嵌入在线程池中计算。
+    命中与否及相似度随complete事件返回并写入助手消息的元数据，便于调整阈值。
+    """
+
+    def __init__(self):
+        self._partitions: Dict[Tuple[int, str], VectorPartition] = {}
+        self._embedder_instances: Dict[str, Any] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def available() -> bool:
+        return np is not None
+
+    def _embedder(self, name: str):
+        if name not in self._embedder_instances:
+            factory = _embedders.get(name)
+            if factory is None:
+                print(f"未知的嵌入器: {name}，使用{DEFAULT_EMBEDDER}")
+                factory = _embedders[DEFAULT_EMBEDDER]
+            self._embedder_instances[name] = factory()
+        return self._embedder_instances[name]
+
+    def _partition(self, prompt_id: int, model_name: str, dimensions: int, max_entries: int) -> VectorPartition:
+        key = (prompt_id, model_name)
+        partition = self._partitions.get(key)
+        if partition is None or partition._vectors.shape[1] != dimensions:
+            partition = VectorPartition(dimensions, max_entries)
+            self._partitions[key] = partition
+        partition.max_entries = max_entries
+        return partition
+
+    async def lookup(self, prompt: Prompt, model_name: str, text: str) -> SemanticLookup:
+        config = semantic_config(prompt)
+        embedder = self._embedder(config.get("embedder", DEFAULT_EMBEDDER))
+        # 嵌入在线程池中计算；检索只是一次矩阵乘法，在事件循环中执行，避免与写入并发修改矩阵
+        vector = (await asyncio.to_thread(embedder.embed, [text]))[0]
+        threshold = float(config.get("threshold", DEFAULT_THRESHOLD))
+
+        index, similarity = None, None
+        partition = self._partitions.get((prompt.id, model_name))
+        if partition is not None and partition._vectors.shape[1] == vector.shape[0]:
+            index, similarity = partition.search(vector)
+
+        if index is not None and similarity >= threshold:
+            self.hits += 1
+            return SemanticLookup(True, similarity, partition.content(index), vector)
+        self.misses += 1
+        return SemanticLookup(False, similarity, vector=vector)
+
+    def store(self, prompt: Prompt, model_name: str, lookup: SemanticLookup, content: str) -> None:
+        """写入查询时已计算的向量和本轮回复"""
+        config = semantic_config(prompt)
+        if lookup.vector is None:
+            return
+        max_entries = max(1, int(config.get("max_entries", DEFAULT_MAX_ENTRIES)))
+        ttl = max(1, int(config.get("ttl", DEFAULT_TTL_SECONDS)))
+        partition = self._partition(prompt.id, model_name, lookup.vector.shape[0], max_entries)
+        partition.add(lookup.vector, content, ttl)
+
+    def clear(self, prompt_id: Optional[int] = None) -> None:
+        """清空指定提示词或全部分区，提示词内容修改后调用"""
+        if prompt_id is None:
+            self._partitions.clear()
+            return
+        for key in [key for key in self._partitions if key[0] == prompt_id]:
+            del self._partitions[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "partitions": len(self._partitions),
+            "entries": sum(partition.size for partition in self._partitions.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# 默认合并窗口：满足任一条件即推送
+DEFAULT_FLUSH_INTERVAL_MS = 50
+DEFAULT_FLUSH_BYTES = 1024
+
+
+def sse_event(payload: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    """格式化一个SSE数据帧，带event_id时客户端可凭Last-Event-ID续传"""
+    frame = f"data: {json.dumps(payload)}\n\n"
+    return frame if event_id is None else with_event_id(frame, event_id)
+
+
+def with_event_id(frame: str, event_id: int) -> str:
+    """给不带ID的数据帧加上事件ID"""
+    return f"id: {event_id}\n{frame}"
+
+
+async def model_text_chunks(events: AsyncIterator[Any]) -> AsyncIterator[str]:
+    """从agent.run_stream的事件流中取出模型输出的文本分片"""
+    async for event in events:
+        if getattr(event, "type", None) == "ModelClientStreamingChunkEvent" and event.content:
+            yield event.content
+
+
+class ContentBuffer:
+    """线性时间的内容累积，替代逐块字符串拼接"""
+
+    __slots__ = ("_parts", "_length")
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._length = 0
+
+    def append(self, text: str) -> None:
+        self._parts.append(text)
+        self._length += len(text)
+
+    def text(self) -> str:
+        # 合并后只保留一段，重复调用不会重复拼接
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def clear(self) -> None:
+        self._parts = []
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+
+class ChunkCoalescer:
+    """把模型的细粒度分片按时间/大小窗口合并后再推送
+
+    缓冲区从第一个分片开始计时，达到flush_interval毫秒或flush_bytes字节即推送；
+    上游长时间没有新分片时也会按时推送，不会卡住已缓冲的内容。
+    enabled=False时逐块透传，供需要Token粒度的客户端使用。
+    """
+
+    def __init__(
+        self,
+        flush_interval_ms: int = DEFAULT_FLUSH_INTERVAL_MS,
+        flush_bytes: int = DEFAULT_FLUSH_BYTES,
+        enabled: bool = True
+    ):
+        self.flush_interval = max(0, flush_interval_ms) / 1000
+        self.flush_bytes = max(1, flush_bytes)
+        self.enabled = enabled
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]], enabled: bool = True) -> "ChunkCoalescer":
+        """从对话配置的stream项读取合并窗口"""
+        stream_config = (config or {}).get("stream") or {}
+        return cls(
+            int(stream_config.get("flush_ms", DEFAULT_FLUSH_INTERVAL_MS)),
+            int(stream_config.get("flush_bytes", DEFAULT_FLUSH_BYTES)),
+            enabled and stream_config.get("coalesce", True)
+        )
+
+    async def stream(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        if not self.enabled:
+            async for chunk in chunks:
+                yield chunk
+            return
+
+        # 上游在独立任务中消费，超时等待只作用于队列，不会打断上游生成器
+        queue: asyncio.Queue = asyncio.Queue()
+        pump = asyncio.create_task(_pump(chunks, queue))
+        getter: Optional[asyncio.Task] = None
+        buffer: List[str] = []
+        buffered_bytes = 0
+        deadline = None
+
+        try:
+            while True:
+                if getter is None:
+                    getter = asyncio.ensure_future(queue.get())
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                done, _ = await asyncio.wait({getter}, timeout=timeout)
+                if not done:
+                    # 窗口到期，推送已缓冲的内容，继续等待同一次读取
+                    yield "".join(buffer)
+                    buffer, buffered_bytes, deadline = [], 0, None
+                    continue
+
+                item, getter = getter.result(), None
+                if item is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                buffer.append(item)
+                buffered_bytes += len(item.encode("utf-8"))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+                if buffered_bytes >= self.flush_bytes or time.monotonic() >= deadline:
+                    yield "".join(buffer)
+                    buffer, buffered_bytes, deadline = [], 0, None
+
+            if buffer:
+                yield "".join(buffer)
+        finally:
+            if getter is not None:
+                getter.cancel()
+            if not pump.done():
+                pump.cancel()
+                await asyncio.gather(pump, return_exceptions=True)
+
+
+_END = object()
+
+
+async def _pump(chunks: AsyncIterator[str], queue: asyncio.Queue) -> None:
+    try:
+        async for chunk in chunks:
+            queue.put_nowait(chunk)
+    except Exception as e:
+        queue.put_nowait(e)
+    finally:
+        queue.put_nowait(_END)
@@ -0,0 +1,111 @@
+from typing import Any, Dict, List, Optional
+
+from autogen_agentchat.agents import AssistantAgent
+from sqlalchemy import select, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Conversation, ConversationStateDelta
+
+# 累积多少条增量后合并为快照
+COMPACT_EVERY = 20
+
+
+class StateLoadResult:
+    """快照 + 增量合并后的代理状态"""
+
+    __slots__ = ("state", "delta_count", "last_delta_id")
+
+    def __init__(self, state: Optional[Dict[str, Any]], delta_count: int, last_delta_id: Optional[int]):
+        self.state = state
+        self.delta_count = delta_count
+        self.last_delta_id = last_delta_id
+
+
+def _empty_state() -> Dict[str, Any]:
+    return {"type": "AssistantAgentState", "version": "1.0.0", "llm_context": {"messages": []}}
+
+
+def apply_delta(state: Optional[Dict[str, Any]], base_offset: int, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """把一条增量应用到状态上
+
+    增量语义是"截断到base_offset后追加"，因此快照中已包含的消息不会重复，
+    回滚后写入的增量也能正确覆盖旧的尾部。
+    """
+    state = state or _empty_state()
+    context = state.setdefault("llm_context", {})
+    current = context.get("messages") or []
+    context["messages"] = current[:base_offset] + messages
+    return state
+
+
+async def load_state(db: AsyncSession, conversation_id: int) -> StateLoadResult:
+    """读取快照并按顺序应用之后的增量"""
+    snapshot = await db.scalar(
+        select(Conversation.agent_state).where(Conversation.id == conversation_id)
+    )
+    result = await db.execute(
+        select(ConversationStateDelta.id, ConversationStateDelta.base_offset, ConversationStateDelta.messages)
+        .where(ConversationStateDelta.conversation_id == conversation_id)
+        .order_by(ConversationStateDelta.id.asc())
+    )
+    deltas = result.all()
+
+    state = snapshot
+    for _, base_offset, messages in deltas:
+        state = apply_delta(state, base_offset, messages)
+
+    last_delta_id = deltas[-1][0] if deltas else None
+    return StateLoadResult(state, len(deltas), last_delta_id)
+
+
+def context_size(agent: AssistantAgent) -> int:
+    """代理完整上下文中的消息数，作为本轮增量的起点"""
+    return agent.model_context.message_count()
+
+
+async def append_delta(db: AsyncSession, conversation_id: int, agent: AssistantAgent, base_offset: int) -> int:
+    """追加本轮新增的上下文消息，返回增量ID
+
+    只写入base_offset之后的消息，写入量与历史长度无关。调用方负责提交。
+    """
+    messages = agent.model_context.all_messages()[base_offset:]
+    delta = ConversationStateDelta(
+        conversation_id=conversation_id,
+        base_offset=base_offset,
+        messages=[message.model_dump() for message in messages]
+    )
+    db.add(delta)
+    await db.flush()
+    return delta.id
+
+
+async def write_snapshot(
+    db: AsyncSession,
+    conversation_id: int,
+    state: Optional[Dict[str, Any]],
+    last_delta_id: Optional[int] = None
+) -> None:
+    """写入快照并删除已合并的增量
+
+    last_delta_id为None时删除该对话的全部增量；否则只删除快照已覆盖的部分，
+    快照之后新追加的增量保留。快照覆盖的最后一条增量已不存在时（对话已被清空）不写入，
+    避免清空前发起的合并把旧状态写回。调用方负责提交。
+    """
+    conditions = [ConversationStateDelta.conversation_id == conversation_id]
+    snapshot_conditions = [Conversation.id == conversation_id]
+    if last_delta_id is not None:
+        conditions.append(ConversationStateDelta.id <= last_delta_id)
+        snapshot_conditions.append(
+            select(ConversationStateDelta.id).where(ConversationStateDelta.id == last_delta_id).exists()
+        )
+    await db.execute(
+        update(Conversation)
+        .where(*snapshot_conditions)
+        .values(agent_state=state)
+    )
+    await db.execute(delete(ConversationStateDelta).where(*conditions))
+
+
+async def clear_state(db: AsyncSession, conversation_id: int) -> None:
+    """清空对话的快照与全部增量。调用方负责提交。"""
+    await write_snapshot(db, conversation_id, None)
@@ -0,0 +1,88 @@
+import asyncio
+import itertools
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Tuple
+
+from .sse import sse_event, with_event_id
+
+# 每个任务保留的最近事件数
+DEFAULT_REPLAY_EVENTS = 2048
+
+
+class StreamEventBuffer:
+    """单个流式任务的事件环形缓冲区
+
+    生产者发布的每个事件分配递增的ID并写入有界队列，发布不等待任何订阅者。
+    订阅者从指定的事件ID之后开始读取：先重放缓冲区中已有的事件，再继续跟随实时事件。
+    请求的起点已被环形缓冲区淘汰时，推送一条resync事件携带到目前为止的完整内容，
+    其ID为快照覆盖的最后一个chunk，客户端凭它续传时不会重放快照中已有的分片。
+    """
+
+    def __init__(self, task_id: str, max_events: int = DEFAULT_REPLAY_EVENTS):
+        self.task_id = task_id
+        self.closed = False
+        # 返回到目前为止已生成的完整内容，用于resync
+        self.snapshot: Optional[Callable[[], str]] = None
+        # (事件ID, 类型, 不带ID的数据帧)
+        self._events: Deque[Tuple[int, str, str]] = deque(maxlen=max(1, max_events))
+        self._next_id = 1
+        self._signal = asyncio.Event()
+
+    @property
+    def last_event_id(self) -> int:
+        return self._next_id - 1
+
+    def publish(self, payload: Dict[str, Any]) -> int:
+        event_id = self._next_id
+        self._next_id += 1
+        self._events.append((event_id, payload.get("type"), sse_event(payload)))
+        self._notify()
+        return event_id
+
+    def close(self) -> None:
+        self.closed = True
+        self._notify()
+
+    def _notify(self) -> None:
+        # 唤醒当前所有等待者，之后的等待使用新的Event
+        self._signal.set()
+        self._signal = asyncio.Event()
+
+    async def subscribe(self, last_event_id: int = 0) -> AsyncIterator[str]:
+        """从last_event_id之后开始输出SSE帧，任务结束且事件读完后返回"""
+        cursor = max(0, last_event_id)
+        while True:
+            # 先取信号再检查事件，避免在检查之后、等待之前发布的事件被错过
+            signal = self._signal
+            oldest_id = self._events[0][0] if self._events else self._next_id
+
+            if cursor + 1 < oldest_id:
+                # 快照和缓冲区在同一时刻读取，快照正好包含缓冲区中的全部chunk
+                events = list(self._events)
+                content = self.snapshot() if self.snapshot else ""
+                resync_id = oldest_id - 1
+                for event_id, event_type, _ in events:
+                    if event_type == "chunk":
+                        resync_id = event_id
+                # 快照之前的非chunk事件（如消息ID）不带ID补发，不改变客户端的Last-Event-ID，
+                # 断开重连时仍从原位置走resync
+                for event_id, event_type, frame in events:
+                    if event_id < resync_id and event_type != "chunk":
+                        yield frame
+                yield sse_event({"type": "resync", "content": content}, resync_id)
+                cursor = resync_id
+
+            # ID连续，可以直接按偏移切片；先复制再输出，输出期间缓冲区可能继续写入
+            oldest_id = self._events[0][0] if self._events else self._next_id
+            if cursor + 1 < oldest_id:
+                # 输出期间起点又被淘汰，重新resync
+                continue
+            pending = list(itertools.islice(self._events, cursor + 1 - oldest_id, None))
+            for event_id, _, frame in pending:
+                cursor = event_id
+                yield with_event_id(frame, event_id)
+
+            if cursor >= self.last_event_id:
+                if self.closed:
+                    return
+                await signal.wait()
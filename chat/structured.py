@@ -0,0 +1,295 @@
+import asyncio
+import json
+import random
+import re
+import time
+from dataclasses import dataclass, asdict
+from typing import Annotated, Any, AsyncIterator, Dict, List, Literal, Optional, Tuple, Type, Union
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, create_model
+from autogen_agentchat.agents import AssistantAgent
+from autogen_agentchat.base import TaskResult
+from autogen_agentchat.messages import StructuredMessage
+
+# 默认的尝试次数、单次超时和总截止时间（秒）
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_ATTEMPT_TIMEOUT = 30.0
+DEFAULT_DEADLINE = 90.0
+# 重试间隔按指数增长并取[0, 上限)内的随机值
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 8.0
+DEFAULT_MODEL_NAME = "StructuredOutput"
+
+_JSON_TYPES = {"string": str, "integer": int, "number": float, "boolean": bool, "null": type(None)}
+_NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def structured_config(prompt) -> Dict[str, Any]:
+    """Prompt.config中的结构化输出配置
+
+    schema（JSON Schema）或model（register_output_model注册的名称）二选一，
+    name（输出模型名称）、max_attempts、attempt_timeout、deadline、backoff_base、backoff_max
+    """
+    return dict((prompt.config or {}).get("structured_output") or {})
+
+
+_registered_models: Dict[str, Type[BaseModel]] = {}
+_schema_models: Dict[str, Type[BaseModel]] = {}
+
+
+def register_output_model(name: str, model: Type[BaseModel]) -> None:
+    """注册Pydantic输出模型，提示词通过structured_output.model引用"""
+    _registered_models[name] = model
+
+
+def _model_name(name: str) -> str:
+    name = _NAME_PATTERN.sub("_", name) or DEFAULT_MODEL_NAME
+    return name[0].upper() + name[1:]
+
+
+class _SchemaConverter:
+    """把JSON Schema转换为Pydantic模型，支持常用的类型、约束、枚举、$ref和anyOf"""
+
+    def __init__(self, root: Dict[str, Any]):
+        self.definitions = {**root.get("definitions", {}), **root.get("$defs", {})}
+        self._refs: Dict[str, Any] = {}
+
+    def model(self, schema: Dict[str, Any], name: str) -> Type[BaseModel]:
+        if schema.get("type", "object") != "object" or "properties" not in schema:
+            raise ValueError(f"{name}必须是带properties的object")
+        required = set(schema.get("required", []))
+        fields = {}
+        for key, prop in schema["properties"].items():
+            annotation = self.annotation(prop, f"{name}_{key}")
+            info = {"description": prop.get("description")}
+            if "default" in prop:
+                fields[key] = (annotation, Field(prop["default"], **info))
+            elif key in required:
+                fields[key] = (annotation, Field(..., **info))
+            else:
+                fields[key] = (Optional[annotation], Field(None, **info))
+        extra = "forbid" if schema.get("additionalProperties") is False else "ignore"
+        return create_model(
+            _model_name(schema.get("title") or name),
+            __config__=ConfigDict(strict=True, extra=extra),
+            **fields
+        )
+
+    def annotation(self, schema: Dict[str, Any], name: str) -> Any:
+        if "$ref" in schema:
+            ref = schema["$ref"]
+            if ref not in self._refs:
+                key = ref.rsplit("/", 1)[-1]
+                if key not in self.definitions:
+                    raise ValueError(f"无法解析的$ref: {ref}")
+                self._refs[ref] = self.annotation(self.definitions[key], key)
+            return self._refs[ref]
+        if "enum" in schema:
+            return Literal[tuple(schema["enum"])]
+        if "const" in schema:
+            return Literal[schema["const"]]
+        for keyword in ("anyOf", "oneOf"):
+            if keyword in schema:
+                options = [self.annotation(option, f"{name}_{i}") for i, option in enumerate(schema[keyword])]
+                return Union[tuple(options)]
+
+        json_type = schema.get("type")
+        if isinstance(json_type, list):
+            return Union[tuple(self.annotation({**schema, "type": t}, name) for t in json_type)]
+        if json_type == "object" or (json_type is None and "properties" in schema):
+            if "properties" in schema:
+                return self.model(schema, name)
+            return Dict[str, Any]
+        if json_type == "array":
+            items = self.annotation(schema["items"], f"{name}_item") if "items" in schema else Any
+            return self._constrained(List[items], schema, min_length="minItems", max_length="maxItems")
+        if json_type == "string":
+            return self._constrained(str, schema, min_length="minLength", max_length="maxLength", pattern="pattern")
+        if json_type in ("integer", "number"):
+            return self._constrained(
+                _JSON_TYPES[json_type], schema,
+                ge="minimum", le="maximum", gt="exclusiveMinimum", lt="exclusiveMaximum", multiple_of="multipleOf"
+            )
+        if json_type in _JSON_TYPES:
+            return _JSON_TYPES[json_type]
+        if json_type is None:
+            return Any
+        raise ValueError(f"不支持的类型: {json_type}")
+
+    @staticmethod
+    def _constrained(annotation: Any, schema: Dict[str, Any], **keywords: str) -> Any:
+        constraints = {arg: schema[key] for arg, key in keywords.items() if key in schema}
+        return Annotated[annotation, Field(**constraints)] if constraints else annotation
+
+
+def output_model(config: Dict[str, Any]) -> Optional[Type[BaseModel]]:
+    """structured_output配置声明的输出模型，未配置时返回None，配置无效时抛出ValueError
+
+    同一份schema只构造一次，缓存的代理比较签名时不会因为重新构造而失效。
+    """
+    if config.get("model"):
+        model = _registered_models.get(config["model"])
+        if model is None:
+            raise ValueError(f"未注册的输出模型: {config['model']}")
+        return model
+    schema = config.get("schema")
+    if not schema:
+        return None
+    if not isinstance(schema, dict):
+        raise ValueError("schema必须是JSON对象")
+    name = config.get("name", DEFAULT_MODEL_NAME)
+    key = json.dumps([name, schema], sort_keys=True)
+    model = _schema_models.get(key)
+    if model is None:
+        model = _SchemaConverter(schema).model({**schema, "title": schema.get("title") or name}, name)
+        _schema_models[key] = model
+    return model
+
+
+@dataclass
+class StructuredAttempt:
+    """一次尝试的记录，backoff为失败后等待的秒数"""
+    attempt: int
+    ok: bool
+    duration_ms: int
+    error: Optional[str] = None
+    timeout: bool = False
+    backoff: Optional[float] = None
+
+
+class StructuredOutputError(Exception):
+    """所有尝试都未得到合法输出"""
+
+    def __init__(self, message: str, attempts: List[StructuredAttempt]):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+@dataclass
+class StructuredOutput:
+    """结构化输出的执行器：校验、重试和截止时间
+
+    每次尝试前记录上下文位置，失败时回滚，重试不会在上下文中留下无效的回复。
+    run返回的事件流依次包含：模型分片（chunk）、每次尝试的结果（attempt），
+    成功时最后是result事件；全部失败时抛出StructuredOutputError。
+    """
+    model: Type[BaseModel]
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS
+    attempt_timeout: float = DEFAULT_ATTEMPT_TIMEOUT
+    deadline: float = DEFAULT_DEADLINE
+    backoff_base: float = DEFAULT_BACKOFF_BASE
+    backoff_max: float = DEFAULT_BACKOFF_MAX
+
+    @classmethod
+    def from_prompt(cls, prompt) -> Optional["StructuredOutput"]:
+        config = structured_config(prompt)
+        model = output_model(config)
+        if model is None:
+            return None
+        return cls(
+            model=model,
+            max_attempts=max(1, int(config.get("max_attempts", DEFAULT_MAX_ATTEMPTS))),
+            attempt_timeout=float(config.get("attempt_timeout", DEFAULT_ATTEMPT_TIMEOUT)),
+            deadline=float(config.get("deadline", DEFAULT_DEADLINE)),
+            backoff_base=float(config.get("backoff_base", DEFAULT_BACKOFF_BASE)),
+            backoff_max=float(config.get("backoff_max", DEFAULT_BACKOFF_MAX))
+        )
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def validate(self, result: Optional[TaskResult]) -> BaseModel:
+        if result is None or not result.messages:
+            raise ValueError("没有返回任何消息")
+        message = result.messages[-1]
+        if not isinstance(message, StructuredMessage) or not isinstance(message.content, self.model):
+            raise ValueError(f"不是结构化消息: {type(message).__name__}")
+        return message.content
+
+    async def _attempt(self, agent: AssistantAgent, task: str, timeout: float) -> AsyncIterator[Any]:
+        """执行一次生成，逐个产出模型分片，最后产出TaskResult
+
+        超时只作用于等待上游的那一步，调用方处理分片的时间不会被打断。
+        """
+        stream = agent.run_stream(task=task)
+        loop = asyncio.get_running_loop()
+        until = loop.time() + timeout
+        try:
+            while True:
+                async with asyncio.timeout_at(until):
+                    try:
+                        event = await stream.__anext__()
+                    except StopAsyncIteration:
+                        return
+                if isinstance(event, TaskResult):
+                    yield event
+                elif getattr(event, "type", None) == "ModelClientStreamingChunkEvent" and event.content:
+                    yield event.content
+        finally:
+            await stream.aclose()
+
+    async def run(self, agent: AssistantAgent, task: str) -> AsyncIterator[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        until = loop.time() + self.deadline
+        offset = agent.model_context.message_count()
+        attempts: List[StructuredAttempt] = []
+
+        for number in range(1, self.max_attempts + 1):
+            started = time.monotonic()
+            record = StructuredAttempt(attempt=number, ok=False, duration_ms=0)
+            result = None
+            try:
+                async for item in self._attempt(agent, task, min(self.attempt_timeout, until - loop.time())):
+                    if isinstance(item, TaskResult):
+                        result = item
+                    else:
+                        yield {'type': 'chunk', 'content': item}
+                content = self.validate(result)
+                record.ok = True
+            except TimeoutError:
+                record.timeout = True
+                record.error = "请求超时"
+            except ValidationError as e:
+                record.error = "验证失败: " + "; ".join(
+                    f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                )
+            except ValueError as e:
+                record.error = f"验证失败: {e}"
+            except Exception as e:
+                record.error = f"执行异常: {e}"
+            record.duration_ms = int((time.monotonic() - started) * 1000)
+            attempts.append(record)
+
+            if record.ok:
+                yield {'type': 'attempt', **asdict(record)}
+                yield {
+                    'type': 'result',
+                    'content': content.model_dump_json(),
+                    'data': content.model_dump(mode="json"),
+                    'attempts': [asdict(a) for a in attempts]
+                }
+                return
+
+            # 失败的尝试从上下文中移除，下一次从同样的起点重新生成
+            agent.model_context.truncate(offset)
+            remaining = until - loop.time()
+            if number < self.max_attempts:
+                record.backoff = round(self.backoff(number), 3)
+                if record.backoff >= remaining:
+                    record.backoff = None
+            yield {'type': 'attempt', **asdict(record)}
+            if record.backoff is None:
+                break
+            await asyncio.sleep(record.backoff)
+
+        raise StructuredOutputError(
+            f"结构化输出失败（{len(attempts)}次尝试）: {attempts[-1].error}", attempts
+        )
+
+
+def structured_signature(prompt) -> Optional[Tuple[str, ...]]:
+    """输出模型的构造签名，schema变化后缓存的代理需要重建"""
+    config = structured_config(prompt)
+    if not config.get("schema") and not config.get("model"):
+        return None
+    return (json.dumps(config.get("schema"), sort_keys=True), config.get("model"), config.get("name"))
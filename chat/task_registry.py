@@ -0,0 +1,197 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Any, Dict, Optional, Set
+
+from sqlalchemy import select, update, delete, func
+
+from database import AsyncSessionLocal
+from models import GenerationTask
+from .checkpoint import recover_streaming_messages
+from .generation import GenerationJob, GenerationJobManager, JOB_RUNNING, generation_jobs
+
+# 轮询取消请求的间隔，只在本进程有运行中的任务时查询
+TASK_POLL_INTERVAL = 1.0
+# 心跳间隔；心跳超过TASK_STALE_SECONDS未更新的任务视为所属进程已退出
+TASK_HEARTBEAT_INTERVAL = 10.0
+TASK_STALE_SECONDS = 30
+# 已结束的任务记录保留时长
+TASK_RETAIN_HOURS = 24
+
+TASK_LOST = "lost"
+
+
+class TaskRegistry:
+    """跨工作进程共享的生成任务注册表（SQLite）
+
+    每个生成任务在表中记录所属进程、状态和开始时间。取消请求落到非所属进程时只写入
+    cancel_requested标记，所属进程轮询到后取消本地任务。所属进程定期刷新心跳，
+    心跳过期的任务由任意进程标记为lost，其消息标记为partial。
+    """
+
+    def __init__(
+        self,
+        manager: GenerationJobManager,
+        poll_interval: float = TASK_POLL_INTERVAL,
+        heartbeat_interval: float = TASK_HEARTBEAT_INTERVAL,
+        stale_seconds: int = TASK_STALE_SECONDS
+    ):
+        self.manager = manager
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_seconds = stale_seconds
+        self._poller: Optional[asyncio.Task] = None
+        self._pending: Set[asyncio.Task] = set()
+        self._last_heartbeat = 0.0
+        self._last_sweep = 0.0
+
+    @property
+    def worker_id(self) -> str:
+        # 每次取当前进程号，fork出的工作进程不会沿用父进程的标识
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    async def track(self, job: GenerationJob) -> None:
+        """登记本进程启动的任务，任务结束时自动更新状态"""
+        try:
+            async with AsyncSessionLocal() as db:
+                db.add(GenerationTask(
+                    task_id=job.task_id,
+                    owner=self.worker_id,
+                    conversation_uuid=job.conversation_uuid,
+                    message_uuid=job.message_uuid,
+                    state=JOB_RUNNING
+                ))
+                await db.commit()
+        except Exception as e:
+            print(f"登记生成任务失败: {e}")
+            return
+
+        if job.task is not None:
+            job.task.add_done_callback(lambda _: self._spawn(self._finish(job)))
+
+    async def _finish(self, job: GenerationJob) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(GenerationTask)
+                    .where(GenerationTask.task_id == job.task_id)
+                    .values(state=job.status, finished_at=func.now())
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"更新生成任务状态失败: {e}")
+
+    async def request_cancel(self, task_id: str) -> bool:
+        """为其他进程的运行中任务写入取消标记，任务不存在、已结束或属于本进程时返回False
+
+        本进程的任务由generation_jobs直接取消，不在其中说明已经结束，写入标记也不会有人处理。
+        """
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(GenerationTask)
+                .where(
+                    GenerationTask.task_id == task_id,
+                    GenerationTask.state == JOB_RUNNING,
+                    GenerationTask.owner != self.worker_id
+                )
+                .values(cancel_requested=1)
+            )
+            await db.commit()
+            return result.rowcount > 0
+
+    async def request_cancel_all(self) -> int:
+        """为其他进程的全部运行中任务写入取消标记，返回标记的数量"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(GenerationTask)
+                .where(GenerationTask.state == JOB_RUNNING, GenerationTask.owner != self.worker_id)
+                .values(cancel_requested=1)
+            )
+            await db.commit()
+            return result.rowcount
+
+    async def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            task = await db.scalar(select(GenerationTask).where(GenerationTask.task_id == task_id))
+        if task is None:
+            return None
+        return {
+            "task_id": task.task_id,
+            "chat_id": task.conversation_uuid,
+            "message_id": task.message_uuid,
+            "status": task.state,
+            "owner": task.owner,
+            "cancel_requested": bool(task.cancel_requested),
+            "started_at": task.started_at.isoformat() if task.started_at else None,
+            "finished_at": task.finished_at.isoformat() if task.finished_at else None,
+        }
+
+    def start(self) -> None:
+        """启动后台轮询"""
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll_loop())
+
+    async def close(self) -> None:
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._poll_once()
+            except Exception as e:
+                print(f"轮询生成任务失败: {e}")
+
+    async def _poll_once(self) -> None:
+        now = time.monotonic()
+        owned = [GenerationTask.owner == self.worker_id, GenerationTask.state == JOB_RUNNING]
+        swept = False
+
+        async with AsyncSessionLocal() as db:
+            if self.manager.active_jobs():
+                result = await db.execute(
+                    select(GenerationTask.task_id).where(*owned, GenerationTask.cancel_requested == 1)
+                )
+                for task_id in result.scalars().all():
+                    self.manager.cancel(task_id)
+
+                if now - self._last_heartbeat >= self.heartbeat_interval:
+                    self._last_heartbeat = now
+                    await db.execute(update(GenerationTask).where(*owned).values(heartbeat_at=func.now()))
+                    await db.commit()
+
+            if now - self._last_sweep >= self.stale_seconds:
+                self._last_sweep = now
+                swept = True
+                # 所属进程已退出的任务标记为lost，并清理过期的已结束记录
+                await db.execute(
+                    update(GenerationTask)
+                    .where(
+                        GenerationTask.state == JOB_RUNNING,
+                        GenerationTask.heartbeat_at < func.datetime("now", f"-{self.stale_seconds} seconds")
+                    )
+                    .values(state=TASK_LOST, finished_at=func.now())
+                )
+                await db.execute(
+                    delete(GenerationTask).where(
+                        GenerationTask.state != JOB_RUNNING,
+                        GenerationTask.finished_at < func.datetime("now", f"-{TASK_RETAIN_HOURS} hours")
+                    )
+                )
+                await db.commit()
+
+        if swept:
+            await recover_streaming_messages(self.stale_seconds)
+
+
+task_registry = TaskRegistry(generation_jobs)
@@ -0,0 +1,230 @@
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update, or_
+from autogen_core.models import SystemMessage, UserMessage
+
+from database import AsyncSessionLocal
+from models import ApiKey, Conversation, Message
+from .client_pool import client_pool
+
+# 新建对话的默认标题，只有仍是默认标题的对话才会生成
+DEFAULT_TITLE = "新对话"
+# 队列容量，已满时丢弃新的请求，不阻塞调用方
+TITLE_QUEUE_SIZE = 1000
+# 每次模型调用最多包含的对话数，凑批最多等待的秒数
+TITLE_BATCH_SIZE = 8
+TITLE_BATCH_WINDOW = 0.5
+# 同时进行的模型调用数
+TITLE_CONCURRENCY = 2
+# 单次调用的超时
+TITLE_TIMEOUT_SECONDS = 30
+# 标题长度上限，每段对话截取的字符数
+TITLE_MAX_CHARS = 20
+TITLE_EXCERPT_CHARS = 500
+# 标题模型密钥的缓存时长
+TITLE_KEY_REFRESH_SECONDS = 30.0
+
+TITLE_SYSTEM_MESSAGE = (
+    f"你负责为对话生成标题。用户会给出若干段编号的对话，请为每段生成一个不超过{TITLE_MAX_CHARS}个字的标题，"
+    "概括对话主题，不要加引号和句号。只返回JSON字符串数组，顺序与编号一致。"
+)
+
+
+def is_default_title(title: Optional[str]) -> bool:
+    return not title or title == DEFAULT_TITLE
+
+
+def title_model_enabled(api_key: ApiKey) -> bool:
+    """ApiKey.config["title_model"]为True的密钥用于生成标题，与对话使用的密钥分开配置"""
+    return bool((api_key.config or {}).get("title_model"))
+
+
+def clean_title(title: str) -> str:
+    title = " ".join(str(title).split()).strip("\"'“”「」《》。.")
+    return title[:TITLE_MAX_CHARS]
+
+
+class TitleQueue:
+    """对话标题的后台生成队列
+
+    对话的第一条回复完成后按对话ID入队，入队不等待、不访问数据库，队列满时直接丢弃。
+    后台worker把短时间内到达的多个对话合并为一次模型调用，并发调用数有上限。
+    生成结果只在对话仍是默认标题时写入，不覆盖用户修改过的标题。
+    """
+
+    def __init__(
+        self,
+        batch_size: int = TITLE_BATCH_SIZE,
+        batch_window: float = TITLE_BATCH_WINDOW,
+        concurrency: int = TITLE_CONCURRENCY
+    ):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.concurrency = concurrency
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=TITLE_QUEUE_SIZE)
+        self._queued: Set[int] = set()
+        self._workers: List[asyncio.Task] = []
+        self._key: Tuple[float, Optional[ApiKey]] = (0.0, None)
+        self.generated = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def enqueue(self, conversation_id: int) -> bool:
+        """请求为对话生成标题，重复入队和队列已满时返回False"""
+        if conversation_id in self._queued:
+            return False
+        try:
+            self._queue.put_nowait(conversation_id)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._queued.add(conversation_id)
+        return True
+
+    def start(self) -> None:
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def invalidate(self) -> None:
+        """ApiKey增删改后调用，下次生成时重新查找标题模型"""
+        self._key = (0.0, None)
+
+    async def _title_key(self) -> Optional[ApiKey]:
+        loaded_at, key = self._key
+        if loaded_at and time.monotonic() - loaded_at < TITLE_KEY_REFRESH_SECONDS:
+            return key
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(ApiKey).where(ApiKey.status == "active").order_by(ApiKey.id))
+            key = next((item for item in result.scalars().all() if title_model_enabled(item)), None)
+        self._key = (time.monotonic(), key)
+        return key
+
+    async def _next_batch(self) -> List[int]:
+        """取一个对话后在batch_window内继续凑批，最多batch_size个"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._generate(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"生成对话标题失败: {e}")
+            finally:
+                self._queued.difference_update(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _load(self, conversation_ids: List[int]) -> Dict[int, List[Tuple[str, str]]]:
+        """仍是默认标题的对话及其开头的消息"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Conversation.id).where(
+                    Conversation.id.in_(conversation_ids),
+                    or_(Conversation.title.is_(None), Conversation.title.in_(["", DEFAULT_TITLE]))
+                )
+            )
+            pending = result.scalars().all()
+            if not pending:
+                return {}
+            result = await db.execute(
+                select(Message.conversation_id, Message.role, Message.content)
+                .where(Message.conversation_id.in_(pending), Message.status == "active")
+                .order_by(Message.conversation_id, Message.id)
+            )
+            turns: Dict[int, List[Tuple[str, str]]] = {}
+            for conversation_id, role, content in result.all():
+                messages = turns.setdefault(conversation_id, [])
+                if len(messages) < 2:
+                    messages.append((role, content or ""))
+        return turns
+
+    async def _generate(self, conversation_ids: List[int]) -> None:
+        api_key = await self._title_key()
+        if api_key is None:
+            return
+        turns = await self._load(conversation_ids)
+        if not turns:
+            return
+
+        ids = list(turns)
+        sections = []
+        for number, conversation_id in enumerate(ids, 1):
+            lines = [
+                f"{'用户' if role == 'user' else '助手'}: {content[:TITLE_EXCERPT_CHARS]}"
+                for role, content in turns[conversation_id]
+            ]
+            sections.append(f"[{number}]\n" + "\n".join(lines))
+
+        client = client_pool.get(api_key)
+        result = await asyncio.wait_for(
+            client.create([
+                SystemMessage(content=TITLE_SYSTEM_MESSAGE),
+                UserMessage(content="\n\n".join(sections), source="user")
+            ]),
+            TITLE_TIMEOUT_SECONDS
+        )
+        titles = self._parse(result.content, len(ids))
+
+        async with AsyncSessionLocal() as db:
+            for conversation_id, title in zip(ids, titles):
+                if not title:
+                    continue
+                result = await db.execute(
+                    update(Conversation)
+                    .where(
+                        Conversation.id == conversation_id,
+                        or_(Conversation.title.is_(None), Conversation.title.in_(["", DEFAULT_TITLE]))
+                    )
+                    .values(title=title)
+                )
+                self.generated += result.rowcount
+            await db.commit()
+
+    @staticmethod
+    def _parse(content, count: int) -> List[str]:
+        """解析模型返回的标题数组，容忍代码块包裹，数量不符时按顺序对齐"""
+        if not isinstance(content, str):
+            return []
+        text = content.strip()
+        start, end = text.find("["), text.rfind("]")
+        if start >= 0 and end > start:
+            try:
+                titles = json.loads(text[start:end + 1])
+                if isinstance(titles, list):
+                    return [clean_title(title) for title in titles[:count]]
+            except ValueError:
+                pass
+        # 只有一段对话时允许直接返回标题文本
+        return [clean_title(text)] if count == 1 else []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "generated": self.generated,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+title_queue = TitleQueue()
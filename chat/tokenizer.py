@@ -0,0 +1,95 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from autogen_core.models import LLMMessage
+
+from .context_window import (
+    TokenCounter, MESSAGE_OVERHEAD_TOKENS, estimate_text_tokens, message_text
+)
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken为可选依赖，缺失时退化为估算
+    tiktoken = None
+
+# 无法按模型名识别编码时使用的默认编码
+DEFAULT_ENCODING = "cl100k_base"
+
+
+class Tokenizer:
+    """Token计数服务
+
+    按模型缓存tiktoken编码器，编码器不可用（未安装或离线无法下载词表）时退化为字符估算，
+    失败结果同样缓存，避免每次计数都重试下载。批量与异步接口在线程池中执行编码，
+    不阻塞事件循环。
+    """
+
+    def __init__(self):
+        self._encoders: Dict[str, Optional[object]] = {}
+
+    def _load(self, model: str):
+        if tiktoken is None:
+            return None
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+        except Exception as e:
+            print(f"加载Token编码器失败({model}): {e}")
+            return None
+        try:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as e:
+            print(f"加载Token编码器失败({DEFAULT_ENCODING}): {e}")
+            return None
+
+    def encoder(self, model: Optional[str]):
+        """获取模型的编码器，首次调用可能下载词表，异步代码中应先await prepare"""
+        model = model or DEFAULT_ENCODING
+        if model not in self._encoders:
+            self._encoders[model] = self._load(model)
+        return self._encoders[model]
+
+    async def prepare(self, model: Optional[str]) -> None:
+        """在线程池中预加载编码器"""
+        if (model or DEFAULT_ENCODING) not in self._encoders:
+            await asyncio.to_thread(self.encoder, model)
+
+    def count(self, text: str, model: Optional[str] = None) -> int:
+        if not text:
+            return 0
+        encoder = self.encoder(model)
+        if encoder is None:
+            return estimate_text_tokens(text)
+        return len(encoder.encode(text, disallowed_special=()))
+
+    def count_batch(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        encoder = self.encoder(model)
+        if encoder is None:
+            return [estimate_text_tokens(text) if text else 0 for text in texts]
+        encoded = encoder.encode_batch([text or "" for text in texts], disallowed_special=())
+        return [len(tokens) for tokens in encoded]
+
+    async def acount(self, text: str, model: Optional[str] = None) -> int:
+        return await asyncio.to_thread(self.count, text, model)
+
+    async def acount_batch(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        return await asyncio.to_thread(self.count_batch, texts, model)
+
+    def message_counter(self, model: Optional[str]) -> TokenCounter:
+        """供上下文窗口使用的单条消息计数函数"""
+        def count_message(message: LLMMessage) -> int:
+            return self.count(message_text(message), model) + MESSAGE_OVERHEAD_TOKENS
+        return count_message
+
+    def message_batch_counter(self, model: Optional[str]):
+        """供上下文窗口使用的批量计数函数，在线程池中编码"""
+        async def count_messages(messages: List[LLMMessage]) -> List[int]:
+            if not messages:
+                return []
+            counts = await self.acount_batch([message_text(m) for m in messages], model)
+            return [count + MESSAGE_OVERHEAD_TOKENS for count in counts]
+        return count_messages
+
+
+tokenizer = Tokenizer()
@@ -1,7 +1,10 @@
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import os
 
+from tracing import tracer, TRACE_STATEMENT_CHARS
+
 # SQLite异步数据库URL
 SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./chat_config.db"
 
@@ -12,6 +15,29 @@ engine = create_async_engine(
     future=True
 )
 
+# 采样的请求中每条SQL语句记录为一个span，未采样时只压入None
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _trace_before_execute(conn, cursor, statement, parameters, context, executemany):
+    span = tracer.start_span("db.query", statement=statement[:TRACE_STATEMENT_CHARS], executemany=executemany)
+    conn.info.setdefault("trace_spans", []).append(span)
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _trace_after_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("trace_spans")
+    span = spans.pop() if spans else None
+    if span is not None:
+        span.end()
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _trace_execute_error(exception_context):
+    conn = exception_context.connection
+    spans = conn.info.get("trace_spans") if conn is not None else None
+    span = spans.pop() if spans else None
+    if span is not None:
+        span.end(exception_context.original_exception)
+
 # 创建异步会话工厂
 AsyncSessionLocal = async_sessionmaker(
     engine,
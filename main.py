@@ -1,21 +1,53 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from contextlib import asynccontextmanager
 import uvicorn
 import asyncio
 
 from database import create_tables
-from api import api_keys_router, prompts_router, common_router
+from metrics import registry as metrics_registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from tracing import tracer, TracingMiddleware
+from chat import (
+    client_pool, agent_cache, generation_jobs, task_registry, batch_runner, title_queue, post_processor,
+    drain_partial_writes, recover_streaming_messages
+)
+from chat.task_registry import TASK_STALE_SECONDS
+from api import api_keys_router, prompts_router, common_router, batch_router
 from api.chat import router as chat_router
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     await create_tables()
+    tracer.start()
+    # 上次进程中断时仍在生成的消息标记为partial
+    recovered = await recover_streaming_messages(TASK_STALE_SECONDS)
+    if recovered:
+        print(f"已将 {recovered} 条中断的流式消息标记为partial")
+    agent_cache.start()
+    task_registry.start()
+    # 接管上次进程退出时未完成的批量任务
+    batch_runner.start()
+    title_queue.start()
+    # 继续处理上次进程留下的后处理任务
+    post_processor.start()
 
     yield
 
+    # 先结束进行中的生成，部分内容写回后再合并代理状态
+    await generation_jobs.close()
+    await batch_runner.close()
+    await title_queue.close()
+    # 生成任务都已收尾，在限定时间内处理完已入队的后处理任务
+    await post_processor.close()
+    await drain_partial_writes()
+    await task_registry.close()
+    await agent_cache.close()
+    await client_pool.close()
+    # 最后写出剩余的追踪数据
+    await tracer.close()
+
 #
 app = FastAPI(
     title="Chat Config API",
@@ -32,12 +64,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 放在最外层，CORS和异常处理也计入请求的根span
+app.add_middleware(TracingMiddleware)
 
 
 app.include_router(api_keys_router)
 app.include_router(prompts_router)
 app.include_router(common_router)
 app.include_router(chat_router)
+app.include_router(batch_router)
 
 
 
@@ -49,7 +84,8 @@ async def http_exception_handler(request, exc):
             "code": exc.status_code,
             "message": exc.detail,
             "data": None
-        }
+        },
+        headers=getattr(exc, "headers", None)
     )
 
 
@@ -92,6 +128,25 @@ async def health_check():
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus文本格式的指标"""
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/tracing")
+async def get_tracing():
+    """追踪的采样率和写出统计"""
+    return {"code": 200, "message": "success", "data": tracer.stats()}
+
+
+@app.put("/tracing")
+async def update_tracing(sample_rate: float = Query(..., ge=0, le=1, description="采样率，0到1之间")):
+    """调整追踪采样率，只对本进程生效，重启后恢复TRACE_SAMPLE_RATE"""
+    tracer.configure(sample_rate=sample_rate)
+    return {"code": 200, "message": "采样率已更新", "data": tracer.stats()}
+
+
 
 
 
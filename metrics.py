@@ -0,0 +1,264 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from tracing import tracer
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 各阶段耗时、首个Token耗时（秒）和生成速度（Token/秒）的桶
+PHASE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 20.0)
+TPS_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Sequence[Any]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name}需要标签: {', '.join(self.labelnames)}")
+        return tuple(str(label) for label in labels)
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels: Any, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: Any) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    """直方图：observe只做一次二分查找和三次累加，累计计数在输出时计算"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = PHASE_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: Any) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> Iterable[str]:
+        names = (*self.labelnames, "le")
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_labels(names, (*key, _number(float(bound))))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(names, (*key, '+Inf'))} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {count}"
+
+
+class MetricsRegistry:
+    """进程内的指标注册表，按Prometheus文本格式输出
+
+    collector在输出时调用，返回(name, kind, help, [(labels字典, 值)])，用于导出各组件已有的统计。
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]]]] = []
+
+    def _register(self, metric: _Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = PHASE_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, func: Callable) -> Callable:
+        self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                print(f"收集指标失败: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+STREAM_LABELS = ("api_key_id", "model_name")
+
+STREAM_PHASE_SECONDS = registry.histogram(
+    "chat_stream_phase_seconds", "流式生成各阶段耗时（秒）", ("phase", *STREAM_LABELS), PHASE_BUCKETS
+)
+STREAM_TTFT_SECONDS = registry.histogram(
+    "chat_stream_ttft_seconds", "开始调用模型到收到首个分片的耗时（秒）", STREAM_LABELS, TTFT_BUCKETS
+)
+STREAM_TOKENS_PER_SECOND = registry.histogram(
+    "chat_stream_tokens_per_second", "回复的生成速度（Token/秒）", STREAM_LABELS, TPS_BUCKETS
+)
+STREAM_ACTIVE = registry.gauge("chat_stream_active", "进行中的流式生成数", STREAM_LABELS)
+STREAM_ERRORS = registry.counter(
+    "chat_stream_errors_total", "流式生成失败次数，reason为rejected/error/structured/cancelled", (*STREAM_LABELS, "reason")
+)
+
+
+class StreamTimer:
+    """一次流式生成的计时，标签在创建时确定
+
+    phase只记录成功完成的阶段，失败由STREAM_ERRORS计数；采样的请求中每个阶段同时记录为stream.<phase>的span。
+    """
+
+    __slots__ = ("labels", "_generation_started", "_first_chunk_at")
+
+    def __init__(self, api_key_id: Any, model_name: Optional[str]):
+        self.labels = (api_key_id, model_name or "")
+        self._generation_started: Optional[float] = None
+        self._first_chunk_at: Optional[float] = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        with tracer.span(f"stream.{name}"):
+            yield
+        STREAM_PHASE_SECONDS.observe(time.perf_counter() - started, name, *self.labels)
+
+    def start_generation(self) -> None:
+        self._generation_started = time.perf_counter()
+
+    def chunk(self) -> None:
+        """收到模型分片，第一次调用时记录首个Token耗时"""
+        if self._first_chunk_at is None and self._generation_started is not None:
+            self._first_chunk_at = time.perf_counter()
+            STREAM_TTFT_SECONDS.observe(self._first_chunk_at - self._generation_started, *self.labels)
+
+    def generation_seconds(self) -> Optional[float]:
+        """首个分片到现在的生成耗时，没有调用模型时返回None"""
+        if self._first_chunk_at is None:
+            return None
+        return time.perf_counter() - self._first_chunk_at
+
+    def active(self) -> None:
+        STREAM_ACTIVE.inc(*self.labels)
+
+    def inactive(self) -> None:
+        STREAM_ACTIVE.dec(*self.labels)
+
+    def error(self, reason: str) -> None:
+        STREAM_ERRORS.inc(*self.labels, reason)
+
+
+def timed(timer: Optional[StreamTimer], name: str):
+    """timer为None时不计时，便于与非流式路径共用同一段代码"""
+    return timer.phase(name) if timer is not None else nullcontext()
+
+
+def observe_tokens_per_second(tokens: int, seconds: float, api_key_id: Any, model_name: Optional[str]) -> None:
+    if tokens > 0 and seconds > 0:
+        STREAM_TOKENS_PER_SECOND.observe(tokens / seconds, api_key_id, model_name or "")
+
+
+@registry.collector
+def collect_runtime_stats():
+    """导出并发名额、密钥池、缓存和后台队列的统计"""
+    from chat import admission, key_router, response_cache, semantic_cache, title_queue, post_processor, generation_jobs
+
+    admission_stats = admission.stats()
+    yield ("chat_admission_in_flight", "gauge", "按ApiKey正在调用模型的请求数",
+           [({"api_key_id": key}, stats["in_flight"]) for key, stats in admission_stats.items()])
+    yield ("chat_admission_queued", "gauge", "按ApiKey排队等待的请求数",
+           [({"api_key_id": key}, stats["queued"]) for key, stats in admission_stats.items()])
+
+    router_stats = key_router.stats()
+    yield ("chat_key_requests_total", "counter", "按ApiKey的模型请求数",
+           [({"api_key_id": key}, stats["requests"]) for key, stats in router_stats.items()])
+    yield ("chat_key_failures_total", "counter", "按ApiKey的模型请求失败数",
+           [({"api_key_id": key}, stats["failures"]) for key, stats in router_stats.items()])
+    yield ("chat_key_in_flight", "gauge", "按ApiKey进行中的模型请求数",
+           [({"api_key_id": key}, stats["in_flight"]) for key, stats in router_stats.items()])
+
+    cache_stats = response_cache.stats()
+    yield ("chat_response_cache_hits_total", "counter", "回复缓存命中次数", [({}, cache_stats["hits"])])
+    yield ("chat_response_cache_misses_total", "counter", "回复缓存未命中次数", [({}, cache_stats["misses"])])
+    semantic_stats = semantic_cache.stats()
+    yield ("chat_semantic_cache_hits_total", "counter", "语义缓存命中次数", [({}, semantic_stats["hits"])])
+    yield ("chat_semantic_cache_entries", "gauge", "语义缓存条目数", [({}, semantic_stats["entries"])])
+
+    title_stats = title_queue.stats()
+    yield ("chat_title_queue_size", "gauge", "等待生成标题的对话数", [({}, title_stats["queued"])])
+    yield ("chat_titles_generated_total", "counter", "已生成的标题数", [({}, title_stats["generated"])])
+
+    post_stats = post_processor.stats()
+    yield ("chat_post_tasks_backlog", "gauge", "未完成的后处理任务数", [({}, post_stats["backlog"])])
+    yield ("chat_post_tasks_processed_total", "counter", "已完成的后处理任务数", [({}, post_stats["processed"])])
+    yield ("chat_post_tasks_failed_total", "counter", "重试耗尽的后处理任务数", [({}, post_stats["failed"])])
+
+    yield ("chat_generation_jobs_active", "gauge", "本进程进行中的生成任务数（含重新生成）",
+           [({}, len(generation_jobs.active_jobs()))])
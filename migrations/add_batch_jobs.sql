@@ -0,0 +1,40 @@
+-- 批量推理任务：上传的每一行是一条独立的任务，逐条记录状态，进程重启后从未完成的条目继续
+
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid VARCHAR(36) NOT NULL UNIQUE COMMENT '批量任务唯一标识',
+    name VARCHAR(200) COMMENT '任务名称',
+    api_key_id INTEGER NOT NULL COMMENT '使用的API密钥ID',
+    prompt_id INTEGER NOT NULL COMMENT '使用的提示词ID',
+    concurrency INTEGER DEFAULT 4 COMMENT '并发数',
+    config JSON COMMENT '额外配置',
+    status VARCHAR(20) DEFAULT 'running' COMMENT '状态：running/completed/cancelled/failed',
+    error TEXT COMMENT '任务级错误信息',
+    total_count INTEGER DEFAULT 0 COMMENT '条目总数',
+    completed_count INTEGER DEFAULT 0 COMMENT '成功条数',
+    failed_count INTEGER DEFAULT 0 COMMENT '失败条数',
+    owner VARCHAR(100) COMMENT '执行任务的工作进程：主机名:进程号',
+    heartbeat_at DATETIME COMMENT '执行进程最近一次心跳',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    finished_at DATETIME COMMENT '结束时间'
+);
+
+CREATE TABLE IF NOT EXISTS batch_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL COMMENT '批量任务ID',
+    line_no INTEGER NOT NULL COMMENT '在上传文件中的行号',
+    custom_id VARCHAR(200) COMMENT '调用方指定的条目标识',
+    content TEXT NOT NULL COMMENT '发送给模型的用户消息',
+    status VARCHAR(20) DEFAULT 'pending' COMMENT '状态：pending/running/completed/failed',
+    output TEXT COMMENT '模型回复',
+    error TEXT COMMENT '错误信息',
+    attempts INTEGER DEFAULT 0 COMMENT '已执行次数',
+    duration_ms INTEGER COMMENT '最近一次执行耗时（毫秒）',
+    finished_at DATETIME COMMENT '完成时间',
+    FOREIGN KEY (job_id) REFERENCES batch_jobs(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_batch_jobs_uuid ON batch_jobs(uuid);
+CREATE INDEX IF NOT EXISTS idx_batch_jobs_owner ON batch_jobs(owner);
+CREATE INDEX IF NOT EXISTS idx_batch_items_job_id ON batch_items(job_id);
+CREATE INDEX IF NOT EXISTS idx_batch_items_status ON batch_items(status);
@@ -0,0 +1,12 @@
+-- 对话状态增量表：每轮只追加新增的上下文消息，定期合并进 conversations.agent_state 快照
+
+CREATE TABLE IF NOT EXISTS conversation_state_deltas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL COMMENT '对话ID',
+    base_offset INTEGER NOT NULL COMMENT '增量写入前上下文中的消息数',
+    messages JSON NOT NULL COMMENT '本轮新增的上下文消息',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversation_state_deltas_conversation_id ON conversation_state_deltas(conversation_id);
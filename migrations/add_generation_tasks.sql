@@ -0,0 +1,17 @@
+-- 生成任务注册表：多个工作进程共享，用于跨进程查询状态和转发取消请求
+
+CREATE TABLE IF NOT EXISTS generation_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id VARCHAR(36) NOT NULL UNIQUE COMMENT '任务ID',
+    owner VARCHAR(100) NOT NULL COMMENT '所属工作进程：主机名:进程号',
+    conversation_uuid VARCHAR(36) COMMENT '对话UUID',
+    message_uuid VARCHAR(36) COMMENT '助手消息UUID',
+    state VARCHAR(20) DEFAULT 'running' COMMENT '状态：running/completed/failed/cancelled/lost',
+    cancel_requested INTEGER DEFAULT 0 COMMENT '是否请求取消：0否/1是',
+    started_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '开始时间',
+    heartbeat_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '所属进程最近一次心跳',
+    finished_at DATETIME COMMENT '结束时间'
+);
+
+CREATE INDEX IF NOT EXISTS idx_generation_tasks_task_id ON generation_tasks(task_id);
+CREATE INDEX IF NOT EXISTS idx_generation_tasks_owner ON generation_tasks(owner);
@@ -0,0 +1,6 @@
+-- 消息版本：记录每轮开始前的上下文位置，重新生成的回复作为同一消息的其他版本保留
+
+ALTER TABLE messages ADD COLUMN context_offset INTEGER COMMENT '本轮开始前代理上下文中的消息数，重新生成时回滚到此处';
+ALTER TABLE messages ADD COLUMN parent_uuid VARCHAR(36) COMMENT '重新生成的版本所属的首个版本UUID';
+
+CREATE INDEX IF NOT EXISTS idx_messages_parent_uuid ON messages(parent_uuid);
@@ -0,0 +1,16 @@
+-- 后处理任务队列：流式回复完成后的Token计数、统计更新、缓存写入等，由后台worker执行，失败按退避重试
+
+CREATE TABLE IF NOT EXISTS post_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind VARCHAR(50) NOT NULL COMMENT '任务类型',
+    payload JSON COMMENT '任务参数',
+    status VARCHAR(20) DEFAULT 'pending' COMMENT '状态：pending/running/failed',
+    attempts INTEGER DEFAULT 0 COMMENT '已执行次数',
+    error TEXT COMMENT '最近一次失败的错误信息',
+    owner VARCHAR(100) COMMENT '执行任务的工作进程：主机名:进程号',
+    run_after DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '最早执行时间，重试时按退避推迟',
+    claimed_at DATETIME COMMENT '被工作进程领取的时间',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间'
+);
+
+CREATE INDEX IF NOT EXISTS idx_post_tasks_status_run_after ON post_tasks(status, run_after);
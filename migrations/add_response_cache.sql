@@ -0,0 +1,13 @@
+-- 回复缓存：相同的（模型、提示词、历史、用户消息）直接返回缓存的回复
+
+CREATE TABLE IF NOT EXISTS response_cache (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    cache_key VARCHAR(64) NOT NULL UNIQUE COMMENT '请求哈希：模型、提示词、历史与用户消息',
+    model_name VARCHAR(100) COMMENT '模型名称',
+    content TEXT NOT NULL COMMENT '回复内容',
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
+    expires_at DATETIME NOT NULL COMMENT '过期时间'
+);
+
+CREATE INDEX IF NOT EXISTS idx_response_cache_cache_key ON response_cache(cache_key);
+CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache(expires_at);
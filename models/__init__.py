@@ -1,5 +1,9 @@
 from .api_key import ApiKey
 from .prompt import Prompt
-from .conversation import Conversation, Message, ChatGroup
+from .conversation import Conversation, Message, ChatGroup, ConversationStateDelta
+from .generation_task import GenerationTask
+from .response_cache import ResponseCacheEntry
+from .batch_job import BatchJob, BatchItem
+from .post_task import PostTask
 
-__all__ = ["ApiKey", "Prompt", "Conversation", "Message", "ChatGroup"]
+__all__ = ["ApiKey", "Prompt", "Conversation", "Message", "ChatGroup", "ConversationStateDelta", "GenerationTask", "ResponseCacheEntry", "BatchJob", "BatchItem", "PostTask"]
@@ -0,0 +1,58 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, ForeignKey
+from sqlalchemy.sql import func
+from database import Base
+
+# 批量任务状态
+BATCH_RUNNING = "running"
+BATCH_COMPLETED = "completed"
+BATCH_CANCELLED = "cancelled"
+BATCH_FAILED = "failed"
+
+# 单条任务状态
+ITEM_PENDING = "pending"
+ITEM_RUNNING = "running"
+ITEM_COMPLETED = "completed"
+ITEM_FAILED = "failed"
+
+
+class BatchJob(Base):
+    __tablename__ = "batch_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    uuid = Column(String(36), unique=True, nullable=False, index=True, comment="批量任务唯一标识")
+    name = Column(String(200), comment="任务名称")
+    api_key_id = Column(Integer, nullable=False, comment="使用的API密钥ID")
+    prompt_id = Column(Integer, nullable=False, comment="使用的提示词ID")
+    concurrency = Column(Integer, default=4, comment="并发数")
+    config = Column(JSON, comment="额外配置")
+    status = Column(String(20), default=BATCH_RUNNING, comment="状态：running/completed/cancelled/failed")
+    error = Column(Text, comment="任务级错误信息")
+    total_count = Column(Integer, default=0, comment="条目总数")
+    completed_count = Column(Integer, default=0, comment="成功条数")
+    failed_count = Column(Integer, default=0, comment="失败条数")
+    owner = Column(String(100), index=True, comment="执行任务的工作进程：主机名:进程号")
+    heartbeat_at = Column(DateTime(timezone=True), comment="执行进程最近一次心跳")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    finished_at = Column(DateTime(timezone=True), comment="结束时间")
+
+    def __repr__(self):
+        return f"<BatchJob(uuid={self.uuid}, status={self.status}, total={self.total_count})>"
+
+
+class BatchItem(Base):
+    __tablename__ = "batch_items"
+
+    id = Column(Integer, primary_key=True, index=True)
+    job_id = Column(Integer, ForeignKey("batch_jobs.id"), nullable=False, index=True, comment="批量任务ID")
+    line_no = Column(Integer, nullable=False, comment="在上传文件中的行号")
+    custom_id = Column(String(200), comment="调用方指定的条目标识")
+    content = Column(Text, nullable=False, comment="发送给模型的用户消息")
+    status = Column(String(20), default=ITEM_PENDING, index=True, comment="状态：pending/running/completed/failed")
+    output = Column(Text, comment="模型回复")
+    error = Column(Text, comment="错误信息")
+    attempts = Column(Integer, default=0, comment="已执行次数")
+    duration_ms = Column(Integer, comment="最近一次执行耗时（毫秒）")
+    finished_at = Column(DateTime(timezone=True), comment="完成时间")
+
+    def __repr__(self):
+        return f"<BatchItem(job_id={self.job_id}, line_no={self.line_no}, status={self.status})>"
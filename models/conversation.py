@@ -3,6 +3,15 @@ from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
 
+# 消息状态：streaming为生成中，partial为生成中断后保留的部分内容，alternate为重新生成后保留的其他版本
+MESSAGE_STATUS_ACTIVE = "active"
+MESSAGE_STATUS_STREAMING = "streaming"
+MESSAGE_STATUS_PARTIAL = "partial"
+MESSAGE_STATUS_ALTERNATE = "alternate"
+MESSAGE_STATUS_DELETED = "deleted"
+# 列表、搜索等对外展示的消息状态
+MESSAGE_VISIBLE_STATUSES = (MESSAGE_STATUS_ACTIVE, MESSAGE_STATUS_STREAMING, MESSAGE_STATUS_PARTIAL)
+
 
 class Conversation(Base):
     __tablename__ = "conversations"
@@ -41,7 +50,9 @@ class Message(Base):
     message_metadata = Column(JSON, comment="消息元数据")
     token_count = Column(Integer, default=0, comment="Token数量")
     character_count = Column(Integer, default=0, comment="字符数量")
-    status = Column(String(20), default="active", comment="状态：active/deleted")
+    status = Column(String(20), default="active", comment="状态：active/streaming/partial/alternate/deleted")
+    context_offset = Column(Integer, comment="本轮开始前代理上下文中的消息数，重新生成时回滚到此处")
+    parent_uuid = Column(String(36), index=True, comment="重新生成的版本所属的首个版本UUID")
     created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), comment="更新时间")
 
@@ -72,3 +83,14 @@ class ChatGroup(Base):
         return f"<ChatGroup(id={self.id}, name={self.name})>"
 
 
+class ConversationStateDelta(Base):
+    __tablename__ = "conversation_state_deltas"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False, index=True, comment="对话ID")
+    base_offset = Column(Integer, nullable=False, comment="增量写入前上下文中的消息数")
+    messages = Column(JSON, nullable=False, comment="本轮新增的上下文消息")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+
+    def __repr__(self):
+        return f"<ConversationStateDelta(id={self.id}, conversation_id={self.conversation_id}, base_offset={self.base_offset})>"
@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.sql import func
+from database import Base
+
+
+class GenerationTask(Base):
+    __tablename__ = "generation_tasks"
+
+    id = Column(Integer, primary_key=True, index=True)
+    task_id = Column(String(36), unique=True, nullable=False, index=True, comment="任务ID")
+    owner = Column(String(100), nullable=False, index=True, comment="所属工作进程：主机名:进程号")
+    conversation_uuid = Column(String(36), comment="对话UUID")
+    message_uuid = Column(String(36), comment="助手消息UUID")
+    state = Column(String(20), default="running", comment="状态：running/completed/failed/cancelled/lost")
+    cancel_requested = Column(Integer, default=0, comment="是否请求取消：0否/1是")
+    started_at = Column(DateTime(timezone=True), server_default=func.now(), comment="开始时间")
+    heartbeat_at = Column(DateTime(timezone=True), server_default=func.now(), comment="所属进程最近一次心跳")
+    finished_at = Column(DateTime(timezone=True), comment="结束时间")
+
+    def __repr__(self):
+        return f"<GenerationTask(task_id={self.task_id}, owner={self.owner}, state={self.state})>"
@@ -0,0 +1,29 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Index
+from sqlalchemy.sql import func
+from database import Base
+
+# 后处理任务状态，处理成功的任务直接删除
+TASK_PENDING = "pending"
+TASK_RUNNING = "running"
+TASK_FAILED = "failed"
+
+
+class PostTask(Base):
+    __tablename__ = "post_tasks"
+    __table_args__ = (
+        Index("idx_post_tasks_status_run_after", "status", "run_after"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50), nullable=False, comment="任务类型")
+    payload = Column(JSON, comment="任务参数")
+    status = Column(String(20), default=TASK_PENDING, comment="状态：pending/running/failed")
+    attempts = Column(Integer, default=0, comment="已执行次数")
+    error = Column(Text, comment="最近一次失败的错误信息")
+    owner = Column(String(100), comment="执行任务的工作进程：主机名:进程号")
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), comment="最早执行时间，重试时按退避推迟")
+    claimed_at = Column(DateTime(timezone=True), comment="被工作进程领取的时间")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+
+    def __repr__(self):
+        return f"<PostTask(id={self.id}, kind={self.kind}, status={self.status})>"
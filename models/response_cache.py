@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy.sql import func
+from database import Base
+
+
+class ResponseCacheEntry(Base):
+    __tablename__ = "response_cache"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, nullable=False, index=True, comment="请求哈希：模型、提示词、历史与用户消息")
+    model_name = Column(String(100), comment="模型名称")
+    content = Column(Text, nullable=False, comment="回复内容")
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), comment="创建时间")
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True, comment="过期时间")
+
+    def __repr__(self):
+        return f"<ResponseCacheEntry(cache_key={self.cache_key}, model_name={self.model_name})>"
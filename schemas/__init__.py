@@ -54,6 +54,27 @@ from .conversation import (
     ChatStatisticsQuery
 )
 
+from .batch import (
+    BatchJobResponse,
+    BatchItemResult
+)
+
+from .serializers import (
+    FastJSONResponse,
+    RowSerializer,
+    fast_response,
+    API_KEY_ROW,
+    PROMPT_ROW,
+    CONVERSATION_ROW,
+    CONVERSATION_DETAIL_ROW,
+    CONVERSATION_SEARCH_ROW,
+    CONVERSATION_BRIEF_ROW,
+    MESSAGE_ROW,
+    MESSAGE_SEARCH_ROW,
+    MESSAGE_VERSION_ROW,
+    BATCH_JOB_ROW
+)
+
 from .common import (
     BaseResponse,
     PaginationQuery,
@@ -123,6 +144,25 @@ __all__ = [
     "GenerateTitleRequest",
     "ChatStatisticsQuery",
 
+    # Batch schemas
+    "BatchJobResponse",
+    "BatchItemResult",
+
+    # Serializers
+    "FastJSONResponse",
+    "RowSerializer",
+    "fast_response",
+    "API_KEY_ROW",
+    "PROMPT_ROW",
+    "CONVERSATION_ROW",
+    "CONVERSATION_DETAIL_ROW",
+    "CONVERSATION_SEARCH_ROW",
+    "CONVERSATION_BRIEF_ROW",
+    "MESSAGE_ROW",
+    "MESSAGE_SEARCH_ROW",
+    "MESSAGE_VERSION_ROW",
+    "BATCH_JOB_ROW",
+
     # Common schemas
     "BaseResponse",
     "PaginationQuery",
@@ -0,0 +1,36 @@
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, Any
+from datetime import datetime
+
+
+class BatchJobResponse(BaseModel):
+    uuid: str
+    name: Optional[str] = None
+    api_key_id: int
+    prompt_id: int
+    concurrency: int
+    config: Optional[Dict[str, Any]] = None
+    status: str
+    error: Optional[str] = None
+    total_count: int
+    completed_count: int
+    failed_count: int
+    created_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class BatchItemResult(BaseModel):
+    """结果文件中的一行"""
+    line_no: int = Field(..., description="在上传文件中的行号")
+    custom_id: Optional[str] = Field(None, description="调用方指定的条目标识")
+    status: str = Field(..., description="状态：pending/running/completed/failed")
+    output: Optional[str] = Field(None, description="模型回复")
+    error: Optional[str] = Field(None, description="错误信息")
+    attempts: int = Field(default=0, description="已执行次数")
+    duration_ms: Optional[int] = Field(None, description="执行耗时（毫秒）")
+
+    class Config:
+        from_attributes = True
@@ -57,6 +57,8 @@ class MessageCreate(MessageBase):
     """创建消息模型"""
     chat_id: str = Field(..., description="对话ID")
     stream: bool = Field(default=False, description="是否流式响应")
+    coalesce: bool = Field(default=True, description="是否合并流式分片，关闭后按模型原始分片逐个推送")
+    timeout: Optional[float] = Field(None, gt=0, le=600, description="非流式生成的截止时间（秒），默认120秒")
 
 
 class MessageResponse(MessageBase):
@@ -91,6 +93,7 @@ class MessageRegenerate(BaseModel):
     chat_id: str = Field(..., description="对话ID")
     message_id: str = Field(..., description="消息ID")
     config: Optional[Dict[str, Any]] = Field(None, description="生成配置")
+    coalesce: bool = Field(default=True, description="是否合并流式分片")
 
 
 class ChatGroupBase(BaseModel):
@@ -0,0 +1,105 @@
+import json
+from datetime import date, datetime
+from operator import attrgetter
+from typing import Any, Dict, Iterable, List
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # 未安装orjson时退回标准库json
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    """orjson/json无法直接处理的类型"""
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"无法序列化的类型: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """序列化为JSON字节串，日期时间输出为ISO格式，与isoformat()一致"""
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """用orjson渲染的JSON响应"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def fast_response(data: Any = None, message: str = "success", code: int = 200) -> FastJSONResponse:
+    """直接返回{code, message, data}格式的响应
+
+    返回Response对象时FastAPI不再按response_model校验和转换，路由上的response_model只用于文档。
+    """
+    return FastJSONResponse({"code": code, "message": message, "data": data})
+
+
+class RowSerializer:
+    """按固定字段把ORM对象转为dict，取值用预先构造的attrgetter一次完成
+
+    datetime原样保留，由FastJSONResponse输出为ISO格式，不需要逐行调用isoformat()。
+    """
+
+    def __init__(self, *fields: str):
+        if len(fields) < 2:
+            raise ValueError("至少需要两个字段")
+        self.fields = fields
+        self._getter = attrgetter(*fields)
+
+    def __call__(self, row: Any) -> Dict[str, Any]:
+        return dict(zip(self.fields, self._getter(row)))
+
+    def many(self, rows: Iterable[Any]) -> List[Dict[str, Any]]:
+        fields, getter = self.fields, self._getter
+        return [dict(zip(fields, getter(row))) for row in rows]
+
+    def extend(self, *fields: str) -> "RowSerializer":
+        return RowSerializer(*self.fields, *fields)
+
+
+# 与ApiKeyResponse、PromptResponse的字段一致
+API_KEY_ROW = RowSerializer(
+    "api_key", "model_name", "model_url", "description", "status", "provider", "config",
+    "max_tokens", "timeout", "id", "created_at", "updated_at"
+)
+PROMPT_ROW = RowSerializer(
+    "title", "category", "content", "description", "tags", "is_public", "variables", "config",
+    "sort", "id", "created_at", "updated_at"
+)
+
+# 对话列表、详情、搜索结果和分组下的对话
+CONVERSATION_ROW = RowSerializer(
+    "id", "uuid", "title", "description", "group_id", "message_count", "status", "created_at", "updated_at"
+)
+CONVERSATION_DETAIL_ROW = CONVERSATION_ROW.extend("config")
+CONVERSATION_SEARCH_ROW = RowSerializer(
+    "id", "uuid", "title", "description", "group_id", "message_count", "created_at", "updated_at"
+)
+CONVERSATION_BRIEF_ROW = RowSerializer("id", "uuid", "title", "message_count", "created_at", "updated_at")
+
+# 消息列表、搜索结果和回复的版本
+MESSAGE_ROW = RowSerializer(
+    "id", "uuid", "role", "content", "message_type", "message_metadata", "token_count",
+    "character_count", "status", "parent_uuid", "created_at", "updated_at"
+)
+MESSAGE_SEARCH_ROW = RowSerializer(
+    "id", "uuid", "conversation_id", "role", "content", "message_type", "status", "created_at"
+)
+MESSAGE_VERSION_ROW = RowSerializer("uuid", "content", "status", "token_count", "created_at")
+
+# 与BatchJobResponse的字段一致
+BATCH_JOB_ROW = RowSerializer(
+    "uuid", "name", "api_key_id", "prompt_id", "concurrency", "config", "status", "error",
+    "total_count", "completed_count", "failed_count", "created_at", "finished_at"
+)
@@ -0,0 +1,96 @@
+"""按ApiKey的并发名额与等待队列"""
+import asyncio
+
+import pytest
+
+from chat.admission import AdmissionController, AdmissionRejected, DEFAULT_RETRY_AFTER
+from models import ApiKey
+
+pytestmark = pytest.mark.anyio
+
+
+def make_key(max_concurrency: int = 1, max_queue: int = 2) -> ApiKey:
+    return ApiKey(id=1, config={"admission": {"max_concurrency": max_concurrency, "max_queue": max_queue}})
+
+
+async def next_position(ticket, waiter=None):
+    waiter = waiter or ticket.wait()
+    return waiter, await waiter.__anext__()
+
+
+async def test_queue_then_reject_when_full():
+    controller = AdmissionController()
+    key = make_key(max_concurrency=1, max_queue=1)
+    first = controller.admit(key)
+    queued = controller.admit(key)
+    assert first.granted and not queued.granted
+    assert queued.position == 1
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(key)
+    assert rejected.value.retry_after == DEFAULT_RETRY_AFTER
+    assert controller.stats()[1] == {"in_flight": 1, "queued": 1, "max_concurrency": 1, "max_queue": 1}
+
+
+async def test_release_grants_waiters_in_order():
+    controller = AdmissionController()
+    key = make_key()
+    first = controller.admit(key)
+    second = controller.admit(key)
+    third = controller.admit(key)
+
+    waiter = third.wait()
+    assert await waiter.__anext__() == 2
+
+    first.release()
+    assert second.granted
+    # 前面的申请获得名额后，等待中的位置前移
+    assert await asyncio.wait_for(waiter.__anext__(), 1) == 1
+
+    second.release()
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(waiter.__anext__(), 1)
+    assert third.granted
+
+
+async def test_cancelled_waiter_leaves_queue():
+    controller = AdmissionController()
+    key = make_key()
+    first = controller.admit(key)
+    second = controller.admit(key)
+    third = controller.admit(key)
+
+    async def wait_for_slot(ticket):
+        async for _ in ticket.wait():
+            pass
+
+    waiting = asyncio.create_task(wait_for_slot(second))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+
+    # 被取消的申请退出队列，不占用之后释放的名额
+    assert second.released and third.position == 1
+    first.release()
+    assert third.granted and not second.granted
+    assert controller.stats()[1]["in_flight"] == 1
+
+
+async def test_release_is_idempotent():
+    controller = AdmissionController()
+    key = make_key(max_concurrency=2)
+    ticket = controller.admit(key)
+    ticket.release()
+    ticket.release()
+    assert controller.stats()[1]["in_flight"] == 0
+
+
+async def test_raising_limit_grants_queued_requests():
+    controller = AdmissionController()
+    controller.admit(make_key(max_concurrency=1))
+    queued = controller.admit(make_key(max_concurrency=1))
+    assert not queued.granted
+
+    # 每次申请都读取配置，调高并发上限后排队中的请求立即放行
+    controller.limiter(make_key(max_concurrency=2))
+    assert queued.granted
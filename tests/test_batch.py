@@ -0,0 +1,166 @@
+"""批量任务的执行、取消后继续、过期接管与上传解析"""
+import asyncio
+import sys
+import types
+
+import pytest
+from autogen_ext.models.replay import ReplayChatCompletionClient
+from fastapi import HTTPException
+from sqlalchemy import func, select
+
+from api.batch import read_batch_items
+from chat.batch import BatchRunner
+from models import ApiKey, Prompt, BatchJob, BatchItem
+from models.batch_job import BATCH_RUNNING, BATCH_COMPLETED, ITEM_PENDING, ITEM_RUNNING, ITEM_COMPLETED
+
+pytestmark = pytest.mark.anyio
+
+OTHER_WORKER = "other-host:1"
+
+
+class SlowReplayClient(ReplayChatCompletionClient):
+    """每次调用先等待delay秒，便于在执行中途取消"""
+
+    def __init__(self, replies, delay: float = 0.0):
+        super().__init__(replies)
+        self.delay = delay
+
+    async def create(self, *args, **kwargs):
+        await asyncio.sleep(self.delay)
+        return await super().create(*args, **kwargs)
+
+
+@pytest.fixture
+def model_client():
+    return SlowReplayClient([f"回复{i}" for i in range(100)])
+
+
+@pytest.fixture
+def runner(session_factory, monkeypatch, model_client):
+    module = sys.modules["chat.batch"]
+    monkeypatch.setattr(module, "AsyncSessionLocal", session_factory)
+
+    async def client(api_key):
+        return model_client
+
+    monkeypatch.setattr(module, "key_router", types.SimpleNamespace(client=client))
+    return BatchRunner()
+
+
+async def add_job(session_factory, statuses, **fields):
+    """写入一个单并发的任务，statuses为各条目的初始状态"""
+    async with session_factory() as db:
+        api_key = ApiKey(api_key="sk-test", model_name="gpt-4o", model_url="https://api.example.com/v1")
+        prompt = Prompt(title="批量", category="other", content="你是一个测试助手。")
+        db.add_all([api_key, prompt])
+        await db.flush()
+        job = BatchJob(
+            uuid=f"job-{api_key.id}", api_key_id=api_key.id, prompt_id=prompt.id, concurrency=1,
+            status=BATCH_RUNNING, total_count=len(statuses), **fields
+        )
+        db.add(job)
+        await db.flush()
+        for line_no, status in enumerate(statuses, start=1):
+            output = "之前的结果" if status == ITEM_COMPLETED else None
+            db.add(BatchItem(job_id=job.id, line_no=line_no, content=f"问题{line_no}", status=status, output=output))
+        await db.commit()
+        return job.id
+
+
+async def load(session_factory, job_id):
+    async with session_factory() as db:
+        job = await db.get(BatchJob, job_id)
+        result = await db.execute(select(BatchItem).where(BatchItem.job_id == job_id).order_by(BatchItem.line_no))
+        return job, result.scalars().all()
+
+
+async def wait_jobs(runner):
+    await asyncio.gather(*list(runner._jobs.values()), return_exceptions=True)
+
+
+async def test_job_runs_items_in_order(runner, session_factory):
+    job_id = await add_job(session_factory, [ITEM_PENDING] * 3)
+    assert await runner.submit(job_id)
+    await wait_jobs(runner)
+
+    job, items = await load(session_factory, job_id)
+    assert job.status == BATCH_COMPLETED and job.completed_count == 3
+    assert [item.output for item in items] == ["回复0", "回复1", "回复2"]
+    assert all(item.attempts == 1 for item in items)
+
+
+async def test_cancelled_job_resumes_from_pending_items(runner, session_factory, model_client):
+    model_client.delay = 0.05
+    job_id = await add_job(session_factory, [ITEM_PENDING] * 4)
+    await runner.submit(job_id)
+    while (await load(session_factory, job_id))[0].completed_count < 1:
+        await asyncio.sleep(0.01)
+    assert runner.cancel(job_id)
+    await wait_jobs(runner)
+
+    # 执行到一半的条目放回pending，已完成的保留
+    job, items = await load(session_factory, job_id)
+    statuses = [item.status for item in items]
+    assert ITEM_RUNNING not in statuses
+    assert ITEM_COMPLETED in statuses and ITEM_PENDING in statuses
+    assert job.status == BATCH_RUNNING
+
+    model_client.delay = 0
+    assert await runner.submit(job_id)
+    await wait_jobs(runner)
+    job, items = await load(session_factory, job_id)
+    assert job.status == BATCH_COMPLETED and job.completed_count == 4
+    assert all(item.status == ITEM_COMPLETED and item.attempts == 1 for item in items)
+
+
+async def test_stale_job_is_taken_over(runner, session_factory):
+    job_id = await add_job(
+        session_factory, [ITEM_COMPLETED, ITEM_RUNNING, ITEM_PENDING],
+        owner=OTHER_WORKER, heartbeat_at=func.datetime("now", "-120 seconds"), completed_count=1
+    )
+    await runner._poll_once()
+    await wait_jobs(runner)
+
+    job, items = await load(session_factory, job_id)
+    assert job.owner == runner.worker_id and job.status == BATCH_COMPLETED
+    # 原进程已完成的条目不重新执行，执行到一半的条目重新执行
+    assert [item.output for item in items] == ["之前的结果", "回复0", "回复1"]
+    assert job.completed_count == 3
+
+
+async def test_live_job_of_other_worker_is_not_claimed(runner, session_factory):
+    job_id = await add_job(session_factory, [ITEM_PENDING], owner=OTHER_WORKER, heartbeat_at=func.now())
+    assert not await runner.submit(job_id)
+    await runner._poll_once()
+    assert runner._jobs == {}
+    job, items = await load(session_factory, job_id)
+    assert job.owner == OTHER_WORKER and items[0].status == ITEM_PENDING
+
+
+class UploadRequest:
+    """按给定的分块产出请求体"""
+
+    def __init__(self, *chunks: bytes):
+        self.chunks = chunks
+
+    async def stream(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+async def test_read_batch_items_across_chunks():
+    request = UploadRequest(b'{"content": "\xe4\xbd\xa0', b'\xe5\xa5\xbd", "custom_id": 7}\n\n"\xe7\xac\xac', b'\xe4\xba\x8c"')
+    items = await read_batch_items(request)
+    assert [(item["line_no"], item["custom_id"], item["content"]) for item in items] == [(1, "7", "你好"), (3, None, "第二")]
+
+
+@pytest.mark.parametrize("body, message", [
+    (b"", "没有任务"),
+    (b'{"content": "a"}\n{bad', "第2行不是有效的JSON"),
+    (b'{"input": ""}', "第1行缺少content"),
+    (b'"a"\n\xff\xfe', "第2行不是UTF-8编码"),
+])
+async def test_read_batch_items_rejects_invalid_upload(body, message):
+    with pytest.raises(HTTPException) as rejected:
+        await read_batch_items(UploadRequest(body))
+    assert rejected.value.status_code == 400 and message in rejected.value.detail
@@ -0,0 +1,255 @@
+"""同模型密钥池、首个分片前的故障转移与对冲请求"""
+import asyncio
+import sys
+from collections import deque
+
+import httpx
+import openai
+import pytest
+
+from chat.key_router import KeyRouter, RoutedChatCompletionClient
+from models import ApiKey
+
+pytestmark = pytest.mark.anyio
+
+ENDPOINT = "https://api.example.com/v1"
+
+
+class FakeClientPool:
+    """按密钥返回占位客户端，不创建真实的HTTP连接"""
+
+    def get(self, api_key):
+        return f"client-{api_key.id}"
+
+
+@pytest.fixture
+def router(session_factory, monkeypatch):
+    module = sys.modules["chat.key_router"]
+    monkeypatch.setattr(module, "AsyncSessionLocal", session_factory)
+    monkeypatch.setattr(module, "client_pool", FakeClientPool())
+    return KeyRouter()
+
+
+async def add_keys(session_factory, *keys):
+    async with session_factory() as db:
+        db.add_all(keys)
+        await db.commit()
+    return keys
+
+
+def key(**fields) -> ApiKey:
+    values = {"api_key": "sk-test", "model_name": "gpt-4o", "model_url": ENDPOINT, "provider": "openai"}
+    values.update(fields)
+    return ApiKey(**values)
+
+
+async def test_pool_requires_same_endpoint_and_provider(router, session_factory):
+    bound, same, _, _, _, _ = await add_keys(
+        session_factory,
+        key(),
+        key(api_key="sk-same"),
+        key(model_url="https://other.example.com/v1"),
+        key(provider="azure"),
+        key(model_name="gpt-4o-mini"),
+        key(config={"key_pool": False}),
+    )
+    route = await router.client(bound)
+    assert [api_key_id for api_key_id, _ in route.members] == [bound.id, same.id]
+
+
+async def test_pool_disabled_on_bound_key(router, session_factory):
+    bound, _ = await add_keys(session_factory, key(config={"key_pool": False}), key())
+    route = await router.client(bound)
+    assert [api_key_id for api_key_id, _ in route.members] == [bound.id]
+
+
+def status_error(status_code: int) -> openai.APIStatusError:
+    request = httpx.Request("POST", ENDPOINT)
+    return openai.APIStatusError(f"HTTP {status_code}", response=httpx.Response(status_code, request=request), body=None)
+
+
+class FakeModelClient:
+    """按脚本返回的模型客户端：首个分片前等待delay秒，可在首个分片前或之后抛出错误"""
+
+    def __init__(self, chunks=("你", "好"), delay: float = 0.0, error: Exception = None, error_after_first: Exception = None):
+        self.chunks = chunks
+        self.delay = delay
+        self.error = error
+        self.error_after_first = error_after_first
+        self.calls = 0
+        self.closed = 0
+
+    async def create(self, messages, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return "".join(self.chunks)
+
+    def create_stream(self, messages, **kwargs):
+        self.calls += 1
+        return self._stream()
+
+    async def _stream(self):
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error:
+                raise self.error
+            for index, chunk in enumerate(self.chunks):
+                yield chunk
+                if index == 0 and self.error_after_first:
+                    raise self.error_after_first
+        finally:
+            self.closed += 1
+
+
+def routed(router, *clients, hedge=None) -> RoutedChatCompletionClient:
+    members = [(index + 1, client) for index, client in enumerate(clients)]
+    return RoutedChatCompletionClient(router, members, "gpt-4o", hedge)
+
+
+async def collect(stream):
+    return [item async for item in stream]
+
+
+async def settle():
+    """等待后台关闭输掉的对冲流、释放对冲名额"""
+    for _ in range(10):
+        await asyncio.sleep(0)
+    await asyncio.gather(*list(sys.modules["chat.key_router"]._background_tasks), return_exceptions=True)
+
+
+def assert_released(router, *api_key_ids):
+    stats = router.stats()
+    for api_key_id in api_key_ids:
+        assert stats[api_key_id]["in_flight"] == 0
+        assert stats[api_key_id]["hedges_in_flight"] == 0
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(sys.modules["chat.key_router"], "RETRY_BACKOFF_SECONDS", 0)
+
+
+async def test_create_fails_over_on_rate_limit(no_backoff):
+    router = KeyRouter()
+    limited, healthy = FakeModelClient(error=status_error(429)), FakeModelClient()
+    assert await routed(router, limited, healthy).create([]) == "你好"
+    stats = router.stats()
+    assert stats[1]["failures"] == 1 and stats[1]["cooling"]
+    assert stats[2]["failures"] == 0
+    # 降级期内的密钥排在后面
+    assert router.pick([(1, limited), (2, healthy)], set())[0] == 2
+
+
+async def test_create_does_not_retry_client_errors(no_backoff):
+    router = KeyRouter()
+    invalid, healthy = FakeModelClient(error=status_error(400)), FakeModelClient()
+    with pytest.raises(openai.APIStatusError):
+        await routed(router, invalid, healthy).create([])
+    assert healthy.calls == 0
+    assert not router.stats()[1]["cooling"]
+
+
+async def test_stream_fails_over_before_first_chunk(no_backoff):
+    router = KeyRouter()
+    broken = FakeModelClient(error=openai.APIConnectionError(request=httpx.Request("POST", ENDPOINT)))
+    healthy = FakeModelClient()
+    assert await collect(routed(router, broken, healthy).create_stream([])) == ["你", "好"]
+    assert broken.closed == 1 and healthy.closed == 1
+    assert_released(router, 1, 2)
+
+
+async def test_stream_error_after_first_chunk_is_not_retried(no_backoff):
+    router = KeyRouter()
+    failing = FakeModelClient(error_after_first=status_error(500))
+    healthy = FakeModelClient()
+    received = []
+    with pytest.raises(openai.APIStatusError):
+        async for chunk in routed(router, failing, healthy).create_stream([]):
+            received.append(chunk)
+    # 已经开始输出的流不切换密钥，避免内容重复
+    assert received == ["你"] and healthy.calls == 0
+    assert_released(router, 1, 2)
+
+
+async def test_all_keys_failing_raises_last_error(no_backoff):
+    router = KeyRouter()
+    clients = [FakeModelClient(error=status_error(503)) for _ in range(2)]
+    with pytest.raises(openai.APIStatusError):
+        await collect(routed(router, *clients).create_stream([]))
+    assert sum(client.calls for client in clients) == 3
+    assert_released(router, 1, 2)
+
+
+HEDGE = {"enabled": True, "after_ms": 20}
+
+
+async def test_hedge_wins_when_primary_is_slow():
+    router = KeyRouter()
+    slow, fast = FakeModelClient(delay=1.0), FakeModelClient(chunks=("快",))
+    assert await collect(routed(router, slow, fast, hedge=HEDGE).create_stream([])) == ["快"]
+    await settle()
+
+    # 输掉的一路被取消并关闭，两路的并发计数和对冲名额都已归还
+    assert slow.closed == 1 and fast.closed == 1
+    stats = router.stats()
+    assert stats[2]["hedged"] == 1 and stats[2]["hedge_wins"] == 1
+    assert stats[1]["failures"] == 0
+    assert_released(router, 1, 2)
+
+
+async def test_hedge_released_when_primary_wins():
+    router = KeyRouter()
+    primary, hedge = FakeModelClient(delay=0.05), FakeModelClient(delay=1.0, chunks=("慢",))
+    assert await collect(routed(router, primary, hedge, hedge=HEDGE).create_stream([])) == ["你", "好"]
+    await settle()
+
+    assert hedge.calls == 1 and hedge.closed == 1
+    stats = router.stats()
+    assert stats[2]["hedged"] == 1 and stats[2]["hedge_wins"] == 0
+    assert_released(router, 1, 2)
+
+
+async def test_hedge_released_when_consumer_stops_early():
+    router = KeyRouter()
+    slow, fast = FakeModelClient(delay=1.0), FakeModelClient()
+    stream = routed(router, slow, fast, hedge=HEDGE).create_stream([])
+    assert await stream.__anext__() == "你"
+    await stream.aclose()
+    await settle()
+
+    assert fast.closed == 1
+    assert_released(router, 1, 2)
+
+
+async def test_hedge_limited_per_key():
+    router = KeyRouter()
+    config = {**HEDGE, "max_in_flight": 1}
+    slow_clients = [FakeModelClient(delay=1.0) for _ in range(2)]
+    hedge = FakeModelClient(delay=0.2)
+    route = RoutedChatCompletionClient(router, [(1, slow_clients[0]), (3, hedge)], "gpt-4o", config)
+    other = RoutedChatCompletionClient(router, [(2, slow_clients[1]), (3, hedge)], "gpt-4o", config)
+
+    first = asyncio.create_task(collect(route.create_stream([])))
+    await asyncio.sleep(0.05)
+    assert router.stats()[3]["hedges_in_flight"] == 1
+    # 对冲目标已达并发上限，第二个慢请求不再对冲，只等原来的密钥
+    second = asyncio.create_task(collect(other.create_stream([])))
+    await asyncio.sleep(0.05)
+    assert router.stats()[3]["hedged"] == 1
+
+    await asyncio.gather(first, second)
+    await settle()
+    assert router.stats()[3]["hedged"] == 1
+    assert_released(router, 1, 2, 3)
+
+
+def test_hedge_delay_uses_percentile_of_recent_ttft():
+    router = KeyRouter()
+    config = {"enabled": True, "after_ms": 1000, "percentile": 90, "min_ms": 100, "max_ms": 400}
+    assert router.hedge_delay("gpt-4o", config) == 1.0
+    router._ttft["gpt-4o"] = deque([i / 100 for i in range(1, 101)])
+    assert router.hedge_delay("gpt-4o", config) == pytest.approx(0.4)
+    router._ttft["gpt-4o"] = deque([0.01] * 50)
+    assert router.hedge_delay("gpt-4o", config) == pytest.approx(0.1)
@@ -0,0 +1,113 @@
+"""Prometheus文本格式输出与流式生成计时"""
+import types
+
+import pytest
+
+import metrics
+from metrics import MetricsRegistry, StreamTimer, observe_tokens_per_second, timed
+
+
+def test_counter_and_gauge_render():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "请求数", ("route",))
+    active = registry.gauge("active", "进行中")
+    requests.inc("/chat")
+    requests.inc("/chat", amount=2)
+    requests.inc('a"b\\c\nd')
+    active.set(1.5)
+    active.dec(amount=0.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total 请求数",
+        "# TYPE requests_total counter",
+        'requests_total{route="/chat"} 3',
+        'requests_total{route="a\\"b\\\\c\\nd"} 1',
+        "# HELP active 进行中",
+        "# TYPE active gauge",
+        "active 1.0",
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "耗时", ("phase",), buckets=(1.0, 0.1, 0.5))
+    for value in (0.05, 0.1, 0.3, 2.0):
+        latency.observe(value, "load")
+
+    lines = registry.render().splitlines()
+    assert lines[2:] == [
+        'latency_seconds_bucket{phase="load",le="0.1"} 2',
+        'latency_seconds_bucket{phase="load",le="0.5"} 3',
+        'latency_seconds_bucket{phase="load",le="1.0"} 3',
+        'latency_seconds_bucket{phase="load",le="+Inf"} 4',
+        'latency_seconds_sum{phase="load"} 2.45',
+        'latency_seconds_count{phase="load"} 4',
+    ]
+
+
+def test_label_count_is_checked():
+    registry = MetricsRegistry()
+    with pytest.raises(ValueError):
+        registry.counter("errors_total", "错误数", ("reason",)).inc()
+
+
+def test_collectors_render_and_failures_are_skipped():
+    registry = MetricsRegistry()
+
+    @registry.collector
+    def broken():
+        raise RuntimeError("统计不可用")
+
+    @registry.collector
+    def queue_stats():
+        yield ("queue_size", "gauge", "队列长度", [({"queue": "title"}, 3), ({}, 0)])
+
+    assert registry.render().splitlines() == [
+        "# HELP queue_size 队列长度",
+        "# TYPE queue_size gauge",
+        'queue_size{queue="title"} 3',
+        "queue_size 0",
+    ]
+
+
+def test_stream_timer_records_phases_and_ttft(monkeypatch):
+    clock = iter([10.0, 10.25, 20.0, 20.5, 21.0])
+    monkeypatch.setattr(metrics, "time", types.SimpleNamespace(perf_counter=lambda: next(clock)))
+    before = dict(metrics.STREAM_PHASE_SECONDS._values)
+
+    timer = StreamTimer(7, "gpt-4o")
+    with timed(timer, "db_insert"):
+        pass
+    timer.start_generation()
+    timer.chunk()
+    timer.chunk()
+    assert timer.generation_seconds() == 0.5
+
+    phase = metrics.STREAM_PHASE_SECONDS._values[("db_insert", "7", "gpt-4o")]
+    assert phase[2] - before.get(("db_insert", "7", "gpt-4o"), [[], 0.0, 0])[2] == 1
+    # 只有第一个分片记录首个Token耗时
+    assert metrics.STREAM_TTFT_SECONDS._values[("7", "gpt-4o")][1:] == [0.5, 1]
+
+    with timed(None, "ignored"):
+        pass
+    assert ("ignored", "7", "gpt-4o") not in metrics.STREAM_PHASE_SECONDS._values
+
+
+def test_failed_phase_is_not_recorded():
+    timer = StreamTimer(8, None)
+    with pytest.raises(RuntimeError):
+        with timer.phase("model_call"):
+            raise RuntimeError("调用失败")
+    timer.error("error")
+    assert ("model_call", "8", "") not in metrics.STREAM_PHASE_SECONDS._values
+    assert metrics.STREAM_ERRORS._values[("8", "", "error")] == 1
+    observe_tokens_per_second(0, 1.0, 8, None)
+    assert ("8", "") not in metrics.STREAM_TOKENS_PER_SECOND._values
+
+
+def test_default_registry_renders_runtime_stats():
+    text = metrics.registry.render()
+    assert text.endswith("\n")
+    assert "# TYPE chat_stream_phase_seconds histogram" in text
+    assert "chat_post_tasks_backlog " in text
+    assert "chat_generation_jobs_active " in text
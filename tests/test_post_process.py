@@ -0,0 +1,119 @@
+"""后处理队列的领取、重试与过期接管"""
+import asyncio
+import sys
+
+import pytest
+from sqlalchemy import func, select
+
+from chat.post_process import PostProcessPool
+from models import PostTask
+from models.post_task import TASK_PENDING, TASK_RUNNING, TASK_FAILED
+
+pytestmark = pytest.mark.anyio
+
+OTHER_WORKER = "other-host:1:abcd"
+
+
+@pytest.fixture
+def pool(session_factory, monkeypatch):
+    monkeypatch.setattr(sys.modules["chat.post_process"], "AsyncSessionLocal", session_factory)
+    pool = PostProcessPool(workers=2, max_attempts=2, poll_interval=0.05, stale_seconds=60)
+    pool.handled = []
+
+    async def record(db, payload):
+        pool.handled.append(payload["n"])
+
+    async def fail(db, payload):
+        raise RuntimeError("处理失败")
+
+    pool.register("record", record)
+    pool.register("fail", fail)
+    return pool
+
+
+async def add_task(session_factory, kind="record", n=0, **fields):
+    async with session_factory() as db:
+        task = PostTask(kind=kind, payload={"n": n}, **fields)
+        db.add(task)
+        await db.commit()
+        return task.id
+
+
+async def task_rows(session_factory):
+    async with session_factory() as db:
+        result = await db.execute(select(PostTask).order_by(PostTask.id))
+        return {task.id: task for task in result.scalars()}
+
+
+async def wait_until(predicate, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+
+async def test_enqueued_tasks_run_in_order_and_are_deleted(pool, session_factory):
+    pool.start()
+    try:
+        async with session_factory() as db:
+            for n in range(3):
+                await pool.enqueue(db, "record", {"n": n})
+            await db.commit()
+        pool.notify()
+        await wait_until(lambda: pool.processed == 3)
+    finally:
+        await pool.close()
+    assert sorted(pool.handled) == [0, 1, 2]
+    assert await task_rows(session_factory) == {}
+    assert pool.stats()["backlog"] == 0
+
+
+async def test_enqueue_rejects_unknown_kind(pool, session_factory):
+    async with session_factory() as db:
+        with pytest.raises(ValueError):
+            await pool.enqueue(db, "missing", {})
+
+
+async def test_failed_task_backs_off_then_fails(pool, session_factory):
+    task_id = await add_task(session_factory, kind="fail")
+    [(claimed_id, kind, payload, attempts)] = await pool._claim(10)
+    assert (claimed_id, attempts) == (task_id, 1)
+    await pool._execute(claimed_id, kind, payload, attempts)
+
+    task = (await task_rows(session_factory))[task_id]
+    assert task.status == TASK_PENDING and task.error == "处理失败"
+    # 退避期内不会被再次领取
+    assert await pool._claim(10) == []
+
+    # 达到最多执行次数后标记为failed，保留在表中
+    await pool._execute(claimed_id, kind, payload, pool.max_attempts)
+    task = (await task_rows(session_factory))[task_id]
+    assert task.status == TASK_FAILED
+    assert pool.stats()["retried"] == 1 and pool.stats()["failed"] == 1
+
+
+async def test_only_stale_tasks_of_other_workers_are_taken_over(pool, session_factory):
+    long_ago = func.datetime("now", "-120 seconds")
+    stale_remote = await add_task(session_factory, status=TASK_RUNNING, owner=OTHER_WORKER, claimed_at=long_ago, attempts=1)
+    await add_task(session_factory, status=TASK_RUNNING, owner=OTHER_WORKER, claimed_at=func.now(), attempts=1)
+    # 本进程领取的任务仍在worker中执行，即使超过期限也不能重复领取
+    await add_task(session_factory, status=TASK_RUNNING, owner=pool.worker_id, claimed_at=long_ago, attempts=1)
+
+    claimed = await pool._claim(10)
+    assert [(task_id, attempts) for task_id, _, _, attempts in claimed] == [(stale_remote, 2)]
+    task = (await task_rows(session_factory))[stale_remote]
+    assert task.owner == pool.worker_id
+    # 表中仍有3个未完成的任务，背压计数据此校正
+    assert pool.stats()["backlog"] == 3
+
+
+async def test_release_claimed_returns_tasks_to_pending(pool, session_factory):
+    task_id = await add_task(session_factory)
+    other_id = await add_task(session_factory, status=TASK_RUNNING, owner=OTHER_WORKER, claimed_at=func.now())
+    await pool._claim(10)
+    await pool._release_claimed()
+
+    rows = await task_rows(session_factory)
+    assert (rows[task_id].status, rows[task_id].attempts) == (TASK_PENDING, 0)
+    assert rows[other_id].status == TASK_RUNNING
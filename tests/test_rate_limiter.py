@@ -0,0 +1,114 @@
+"""按ApiKey的RPM/TPM令牌桶"""
+import asyncio
+import sys
+import types
+from email.utils import formatdate
+
+import pytest
+
+from chat.rate_limiter import KeyRateLimiter, RateLimiterRegistry, TokenBucket, parse_retry_after, MAX_PAUSE_SECONDS
+from models import ApiKey
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeClock:
+    """可控的时钟，sleep直接推进时间并记录等待的秒数"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    module = sys.modules["chat.rate_limiter"]
+    monkeypatch.setattr(module, "time", clock)
+    monkeypatch.setattr(module, "asyncio", types.SimpleNamespace(Lock=asyncio.Lock, sleep=clock.sleep))
+    return clock
+
+
+def test_bucket_refills_continuously(clock):
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.delay(1) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.delay(1) == pytest.approx(0.5)
+    # 超过容量的请求按容量计算，不会永远等待
+    clock.now += 100
+    assert bucket.delay(1000) == 0.0
+
+
+async def test_acquire_waits_for_request_budget(clock):
+    limiter = KeyRateLimiter(rpm=2)
+    assert await limiter.acquire(1) == 0.0
+    assert await limiter.acquire(1) == 0.0
+    # 每分钟2次，第三次需要等30秒补回一次
+    assert await limiter.acquire(1) == pytest.approx(30.0)
+
+
+async def test_concurrent_acquires_are_released_in_order(clock):
+    limiter = KeyRateLimiter(rpm=60)
+    limiter.requests.take(60)
+    order = []
+
+    async def call(name):
+        await limiter.acquire(1)
+        order.append((name, round(clock.now - 1000.0, 6)))
+
+    await asyncio.gather(call("a"), call("b"), call("c"))
+    assert order == [("a", 1.0), ("b", 2.0), ("c", 3.0)]
+
+
+async def test_reconcile_corrects_token_estimate(clock):
+    limiter = KeyRateLimiter(tpm=1000)
+    await limiter.acquire(600)
+    limiter.reconcile(600, 200)
+    assert limiter.tokens.level == pytest.approx(800)
+    # 实际用量超出估算时补扣，余量可以为负
+    limiter.reconcile(200, 1200)
+    assert limiter.tokens.level == pytest.approx(-200)
+    assert await limiter.acquire(100) == pytest.approx(18.0)
+
+
+async def test_retry_after_pauses_all_calls(clock):
+    limiter = KeyRateLimiter(rpm=600)
+    limiter.observe(429, {"retry-after": "7"})
+    assert await limiter.acquire(1) == pytest.approx(7.0)
+    limiter.observe(503, {"retry-after": "100000"})
+    assert limiter._delay(1) == pytest.approx(MAX_PAUSE_SECONDS)
+
+
+def test_ratelimit_headers_only_lower_the_level(clock):
+    limiter = KeyRateLimiter(rpm=100, tpm=10000)
+    limiter.observe(200, {"x-ratelimit-remaining-requests": "5", "x-ratelimit-remaining-tokens": "50000"})
+    assert limiter.requests.level == 5
+    assert limiter.tokens.level == 10000
+
+
+def test_parse_retry_after_formats(clock):
+    assert parse_retry_after({"retry-after-ms": "1500"}) == 1.5
+    assert parse_retry_after({"retry-after": "3"}) == 3.0
+    assert parse_retry_after({"retry-after": formatdate(clock.now + 20, usegmt=True)}) == pytest.approx(20, abs=1)
+    assert parse_retry_after({"retry-after": "soon"}) is None
+    assert parse_retry_after({}) is None
+
+
+def test_registry_applies_config_changes(clock):
+    registry = RateLimiterRegistry()
+    limiter = registry.limiter(ApiKey(id=1, config={"rate_limit": {"rpm": 10}}))
+    assert limiter.tokens is None and limiter.requests.capacity == 10
+    assert registry.limiter(ApiKey(id=1, config={"rate_limit": {"rpm": 10, "tpm": 500}})) is limiter
+    assert limiter.tokens.capacity == 500
@@ -0,0 +1,74 @@
+"""回复精确匹配缓存的两层读写、过期与淘汰"""
+import sys
+
+import pytest
+from autogen_core.models import UserMessage, AssistantMessage
+from sqlalchemy import func
+
+from chat.response_cache import ResponseCache, cache_ttl, replay_chunks, request_key, DEFAULT_TTL_SECONDS
+from models import Prompt, ResponseCacheEntry
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def cache(session_factory, monkeypatch):
+    monkeypatch.setattr(sys.modules["chat.response_cache"], "AsyncSessionLocal", session_factory)
+    return ResponseCache(max_entries=2)
+
+
+async def test_put_then_get_from_memory_and_database(cache):
+    await cache.put("k1", "gpt-4o", "回复一", 60)
+    assert await cache.get("k1") == "回复一"
+
+    # 内存层清空后从SQLite读取并回填内存
+    cache.clear_memory()
+    assert await cache.get("k1") == "回复一"
+    assert cache.stats() == {"entries": 1, "hits": 2, "misses": 0}
+    assert await cache.get("missing") is None
+    assert cache.stats()["misses"] == 1
+
+
+async def test_write_overwrites_existing_entry(cache):
+    await cache.put("k1", "gpt-4o", "旧回复", 60)
+    await cache.put("k1", "gpt-4o", "新回复", 60)
+    cache.clear_memory()
+    assert await cache.get("k1") == "新回复"
+
+
+async def test_expired_entries_are_ignored(cache, session_factory):
+    async with session_factory() as db:
+        db.add(ResponseCacheEntry(
+            cache_key="old", model_name="gpt-4o", content="过期", expires_at=func.datetime("now", "-10 seconds")
+        ))
+        await db.commit()
+    assert await cache.get("old") is None
+
+    cache._remember("stale", "过期", -1)
+    assert await cache.get("stale") is None
+    assert "stale" not in cache._memory
+
+
+async def test_memory_layer_evicts_least_recently_used(cache):
+    for key in ("a", "b"):
+        await cache.put(key, "gpt-4o", key, 60)
+    await cache.get("a")
+    await cache.put("c", "gpt-4o", "c", 60)
+    assert list(cache._memory) == ["a", "c"]
+
+
+def test_request_key_covers_what_is_sent_to_the_model():
+    history = [UserMessage(content="你好", source="user"), AssistantMessage(content="你好！", source="assistant")]
+    key = request_key("gpt-4o", "系统提示", history, "再见")
+    assert key == request_key("gpt-4o", "系统提示", list(history), "再见")
+    assert key != request_key("gpt-4o-mini", "系统提示", history, "再见")
+    assert key != request_key("gpt-4o", "其他提示", history, "再见")
+    assert key != request_key("gpt-4o", "系统提示", history[:1], "再见")
+    assert key != request_key("gpt-4o", "系统提示", history, "再见！")
+
+
+def test_cache_ttl_and_replay_chunks():
+    assert cache_ttl(Prompt(config={})) is None
+    assert cache_ttl(Prompt(config={"response_cache": {"enabled": True}})) == DEFAULT_TTL_SECONDS
+    assert cache_ttl(Prompt(config={"response_cache": {"enabled": True, "ttl": 0}})) == 1
+    assert list(replay_chunks("abcde", 2)) == ["ab", "cd", "e"]
@@ -0,0 +1,95 @@
+"""语义缓存的相似度命中、分区、过期与淘汰"""
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from chat.semantic_cache import SemanticCache, VectorPartition, HashingEmbedder
+from models import Prompt
+
+pytestmark = pytest.mark.anyio
+
+QUESTION = "如何重置我的账户密码？"
+
+
+def make_prompt(prompt_id: int = 1, **config) -> Prompt:
+    return Prompt(id=prompt_id, config={"semantic_cache": {"enabled": True, **config}})
+
+
+async def remember(cache: SemanticCache, prompt: Prompt, text: str, content: str, model_name: str = "gpt-4o"):
+    lookup = await cache.lookup(prompt, model_name, text)
+    cache.store(prompt, model_name, lookup, content)
+    return lookup
+
+
+async def test_near_duplicate_question_hits():
+    cache = SemanticCache()
+    prompt = make_prompt()
+    first = await remember(cache, prompt, QUESTION, "点击忘记密码")
+    assert not first.hit and first.similarity is None
+
+    lookup = await cache.lookup(prompt, "gpt-4o", "如何重置我的账户密码?")
+    assert lookup.hit and lookup.content == "点击忘记密码"
+    assert lookup.info() == {"type": "semantic", "hit": True, "similarity": pytest.approx(lookup.similarity, abs=1e-4)}
+
+
+async def test_unrelated_question_misses_with_similarity():
+    cache = SemanticCache()
+    prompt = make_prompt()
+    await remember(cache, prompt, QUESTION, "点击忘记密码")
+    lookup = await cache.lookup(prompt, "gpt-4o", "今天天气怎么样")
+    # 未命中时返回最接近条目的相似度，便于调整阈值
+    assert not lookup.hit and lookup.similarity < 0.9
+    assert cache.stats()["misses"] == 2
+
+
+async def test_partitioned_by_prompt_and_model():
+    cache = SemanticCache()
+    await remember(cache, make_prompt(1), QUESTION, "提示词1的回复")
+    assert not (await cache.lookup(make_prompt(2), "gpt-4o", QUESTION)).hit
+    assert not (await cache.lookup(make_prompt(1), "gpt-4o-mini", QUESTION)).hit
+
+    cache.clear(1)
+    assert not (await cache.lookup(make_prompt(1), "gpt-4o", QUESTION)).hit
+    assert cache.stats()["partitions"] == 0
+
+
+async def test_threshold_from_config():
+    cache = SemanticCache()
+    await remember(cache, make_prompt(threshold=1.01), QUESTION, "回复")
+    assert not (await cache.lookup(make_prompt(threshold=1.01), "gpt-4o", QUESTION)).hit
+
+
+async def test_expired_entries_are_skipped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sys.modules["chat.semantic_cache"], "time", types.SimpleNamespace(time=lambda: now[0]))
+    cache = SemanticCache()
+    prompt = make_prompt(ttl=60)
+    await remember(cache, prompt, QUESTION, "回复")
+    assert (await cache.lookup(prompt, "gpt-4o", QUESTION)).hit
+    now[0] += 61
+    lookup = await cache.lookup(prompt, "gpt-4o", QUESTION)
+    assert not lookup.hit and lookup.similarity is None
+
+
+def test_partition_grows_and_drops_oldest():
+    embedder = HashingEmbedder(dimensions=64)
+    vectors = embedder.embed([f"问题{i}" for i in range(12)])
+    partition = VectorPartition(64, max_entries=10)
+    for i, vector in enumerate(vectors):
+        partition.add(vector, f"回复{i}", 60)
+    # 满时淘汰最早写入的条目，剩余条目与内容保持对应
+    assert partition.size == 10
+    index, similarity = partition.search(vectors[11])
+    assert partition.content(index) == "回复11" and similarity == pytest.approx(1.0)
+    assert [partition.content(i) for i in range(partition.size)] == [f"回复{i}" for i in range(2, 12)]
+
+
+def test_hashing_embedder_is_normalized_and_stable():
+    embedder = HashingEmbedder()
+    first, empty = embedder.embed([QUESTION, ""])
+    assert float((first ** 2).sum()) == pytest.approx(1.0)
+    assert float(abs(empty).sum()) == 0.0
+    assert (HashingEmbedder().embed([QUESTION])[0] == first).all()
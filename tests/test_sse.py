@@ -0,0 +1,98 @@
+"""流式分片的合并窗口与内容累积"""
+import asyncio
+
+import pytest
+
+from chat.sse import ChunkCoalescer, ContentBuffer, sse_event
+
+pytestmark = pytest.mark.anyio
+
+
+async def upstream(*steps, state=None):
+    """按脚本产出分片：字符串直接产出，数字表示暂停的秒数"""
+    try:
+        for step in steps:
+            if isinstance(step, str):
+                yield step
+            else:
+                await asyncio.sleep(step)
+    finally:
+        if state is not None:
+            state["closed"] = True
+
+
+async def collect(coalescer, chunks):
+    return [chunk async for chunk in coalescer.stream(chunks)]
+
+
+async def test_chunks_within_window_are_merged():
+    coalescer = ChunkCoalescer(flush_interval_ms=1000, flush_bytes=1024)
+    assert await collect(coalescer, upstream("你", "好", "，", "世界")) == ["你好，世界"]
+
+
+async def test_flush_when_bytes_reached():
+    coalescer = ChunkCoalescer(flush_interval_ms=1000, flush_bytes=6)
+    # 按UTF-8字节计算，两个汉字即达到6字节
+    assert await collect(coalescer, upstream("你", "好", "a", "b")) == ["你好", "ab"]
+
+
+async def test_flush_on_timer_while_upstream_stalls():
+    coalescer = ChunkCoalescer(flush_interval_ms=20, flush_bytes=1024)
+    received = []
+
+    async def consume():
+        async for chunk in coalescer.stream(upstream("a", "b", 0.5, "c")):
+            received.append(chunk)
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.2)
+    # 上游还在等待时，已缓冲的内容按时推送
+    assert received == ["ab"]
+    await task
+    assert received == ["ab", "c"]
+
+
+async def test_disabled_passes_chunks_through():
+    coalescer = ChunkCoalescer(enabled=False)
+    assert await collect(coalescer, upstream("a", "b", "c")) == ["a", "b", "c"]
+
+
+async def test_upstream_error_is_raised():
+    async def failing():
+        yield "a"
+        raise RuntimeError("模型调用失败")
+
+    with pytest.raises(RuntimeError, match="模型调用失败"):
+        await collect(ChunkCoalescer(), failing())
+
+
+async def test_early_close_stops_upstream():
+    state = {}
+    stream = ChunkCoalescer(flush_interval_ms=0).stream(upstream("a", 0.5, "b", state=state))
+    assert await stream.__anext__() == "a"
+    await stream.aclose()
+    assert state.get("closed")
+
+
+def test_from_config_reads_stream_settings():
+    coalescer = ChunkCoalescer.from_config({"stream": {"flush_ms": 10, "flush_bytes": 64}})
+    assert (coalescer.flush_interval, coalescer.flush_bytes, coalescer.enabled) == (0.01, 64, True)
+    assert not ChunkCoalescer.from_config({"stream": {"coalesce": False}}).enabled
+    assert not ChunkCoalescer.from_config(None, enabled=False).enabled
+
+
+def test_content_buffer_joins_once():
+    content = ContentBuffer()
+    for part in ("ab", "c", "de"):
+        content.append(part)
+    assert len(content) == 5
+    assert content.text() == "abcde"
+    content.append("f")
+    assert content.text() == "abcdef"
+    content.clear()
+    assert content.text() == "" and len(content) == 0
+
+
+def test_sse_event_with_id():
+    assert sse_event({"type": "ping"}) == 'data: {"type": "ping"}\n\n'
+    assert sse_event({"type": "ping"}, 3) == 'id: 3\ndata: {"type": "ping"}\n\n'
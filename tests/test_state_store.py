@@ -0,0 +1,244 @@
+"""代理状态增量、快照合并与重新生成回滚
+
+按stream_message/regenerate_message的顺序执行每一轮（借出代理、生成、追加增量、归还），
+再从数据库重新加载，断言加载得到的上下文与内存中的代理完全一致。
+"""
+import asyncio
+import sys
+
+import pytest
+from autogen_agentchat.agents import AssistantAgent
+from autogen_core.models import UserMessage, AssistantMessage
+from autogen_ext.models.replay import ReplayChatCompletionClient
+from sqlalchemy import select, func
+
+from api.chat import regenerate_offset
+from chat import state_store
+from chat.agent_cache import AgentCache
+from chat.context_window import build_context
+from models import ApiKey, Prompt, Conversation, ConversationStateDelta
+from models.conversation import MESSAGE_STATUS_ACTIVE, MESSAGE_STATUS_PARTIAL
+
+pytestmark = pytest.mark.anyio
+
+SYSTEM_PROMPT = "你是一个测试助手。"
+CONVERSATION_UUID = "00000000-0000-0000-0000-000000000001"
+
+
+def make_agent(replies=()) -> AssistantAgent:
+    context = build_context(ApiKey(model_name="test", config={}), Prompt(content=SYSTEM_PROMPT))
+    return AssistantAgent(
+        name="assistant",
+        model_client=ReplayChatCompletionClient(list(replies)),
+        system_message=SYSTEM_PROMPT,
+        model_context=context
+    )
+
+
+def dump(agent: AssistantAgent):
+    return [message.model_dump() for message in agent.model_context.all_messages()]
+
+
+class Harness:
+    """一个对话：内存中的代理缓存 + 测试数据库"""
+
+    def __init__(self, session_factory, monkeypatch):
+        # 快照合并通过agent_cache模块的AsyncSessionLocal写入，指向测试数据库
+        # （chat包导出的agent_cache是缓存实例，模块要从sys.modules取）
+        monkeypatch.setattr(sys.modules["chat.agent_cache"], "AsyncSessionLocal", session_factory)
+        self.session_factory = session_factory
+        self.cache = AgentCache()
+        self.agent = make_agent(f"回复{i}" for i in range(200))
+        self.conversation_id = None
+
+    async def create_conversation(self) -> None:
+        async with self.session_factory() as db:
+            conversation = Conversation(uuid=CONVERSATION_UUID, api_key_id=1, prompt_id=1)
+            db.add(conversation)
+            await db.commit()
+            self.conversation_id = conversation.id
+
+    async def checkout(self):
+        lease = await self.cache.checkout(CONVERSATION_UUID, self.conversation_id)
+        return lease, lease.agent or self.agent
+
+    async def commit_turn(self, lease, agent: AssistantAgent, base_offset: int) -> None:
+        async with self.session_factory() as db:
+            delta_id = await state_store.append_delta(db, self.conversation_id, agent, base_offset)
+            await db.commit()
+        lease.record_delta(delta_id)
+        self.cache.checkin(lease, agent, "signature")
+
+    async def turn(self, task: str) -> int:
+        """一轮新对话，返回本轮开始前的上下文位置"""
+        lease, agent = await self.checkout()
+        base_offset = state_store.context_size(agent)
+        await agent.run(task=task)
+        await self.commit_turn(lease, agent, base_offset)
+        return base_offset
+
+    async def settle(self) -> None:
+        """等待后台的快照合并写完"""
+        await asyncio.gather(*list(self.cache._pending.values()))
+
+    async def reload(self):
+        async with self.session_factory() as db:
+            loaded = await state_store.load_state(db, self.conversation_id)
+        agent = make_agent()
+        if loaded.state:
+            await agent.load_state(loaded.state)
+        return agent, loaded
+
+    async def delta_count(self) -> int:
+        async with self.session_factory() as db:
+            return await db.scalar(
+                select(func.count(ConversationStateDelta.id))
+                .where(ConversationStateDelta.conversation_id == self.conversation_id)
+            )
+
+
+@pytest.fixture
+async def harness(session_factory, monkeypatch):
+    harness = Harness(session_factory, monkeypatch)
+    await harness.create_conversation()
+    return harness
+
+
+def test_apply_delta_truncates_then_appends():
+    state = {"llm_context": {"messages": [1, 2, 3, 4]}}
+    assert state_store.apply_delta(state, 2, [5])["llm_context"]["messages"] == [1, 2, 5]
+    assert state_store.apply_delta(None, 0, [1])["llm_context"]["messages"] == [1]
+
+
+async def test_reload_matches_live_across_compaction(harness):
+    extra_turns = 3
+    for i in range(state_store.COMPACT_EVERY + extra_turns):
+        await harness.turn(f"问题{i}")
+    await harness.settle()
+
+    # 前COMPACT_EVERY轮已合并进快照，之后的轮次仍是增量
+    assert await harness.delta_count() == extra_turns
+    reloaded, loaded = await harness.reload()
+    assert loaded.delta_count == extra_turns
+    assert len(loaded.state["llm_context"]["messages"]) == 2 * (state_store.COMPACT_EVERY + extra_turns)
+    assert dump(reloaded) == dump(harness.agent)
+
+
+async def test_checkout_waits_for_pending_snapshot(harness):
+    for i in range(3):
+        await harness.turn(f"问题{i}")
+    # persist=True的失效把未合并的增量写成快照，重新借出未命中时必须等写完才读得到完整状态
+    await harness.cache.invalidate(CONVERSATION_UUID, persist=True)
+    lease, _ = await harness.checkout()
+    assert lease.agent is None
+    assert await harness.delta_count() == 0
+    reloaded, _ = await harness.reload()
+    assert dump(reloaded) == dump(harness.agent)
+
+
+async def test_reload_after_clear_starts_empty(harness):
+    for i in range(2):
+        await harness.turn(f"问题{i}")
+    await harness.cache.invalidate(CONVERSATION_UUID)
+    async with harness.session_factory() as db:
+        await state_store.clear_state(db, harness.conversation_id)
+        await db.commit()
+
+    reloaded, loaded = await harness.reload()
+    assert loaded.delta_count == 0
+    assert dump(reloaded) == []
+
+
+async def test_stale_snapshot_after_clear_is_skipped(harness):
+    for i in range(3):
+        await harness.turn(f"问题{i}")
+    lease, agent = await harness.checkout()
+    state = await agent.save_state()
+
+    # 清空先提交，清空前发起的快照合并随后才写入
+    async with harness.session_factory() as db:
+        await state_store.clear_state(db, harness.conversation_id)
+        await db.commit()
+    async with harness.session_factory() as db:
+        await state_store.write_snapshot(db, harness.conversation_id, state, lease.last_delta_id)
+        await db.commit()
+
+    reloaded, loaded = await harness.reload()
+    assert loaded.state is None
+    assert dump(reloaded) == []
+
+
+async def test_regenerate_after_compaction_boundary(harness):
+    offsets = [await harness.turn(f"问题{i}") for i in range(state_store.COMPACT_EVERY + 2)]
+    await harness.settle()
+    before = state_store.context_size(harness.agent)
+    old_reply = harness.agent.model_context.all_messages()[-1].content
+
+    lease, agent = await harness.checkout()
+    base_offset = regenerate_offset(agent, offsets[-1], MESSAGE_STATUS_ACTIVE, old_reply)
+    assert base_offset == offsets[-1]
+    agent.model_context.truncate(base_offset)
+    await agent.run(task=f"问题{len(offsets) - 1}")
+    await harness.commit_turn(lease, agent, base_offset)
+
+    # 新回复覆盖原来的一轮，上下文长度不变
+    assert state_store.context_size(agent) == before
+    assert agent.model_context.all_messages()[-1].content != old_reply
+    reloaded, _ = await harness.reload()
+    assert dump(reloaded) == dump(agent)
+
+
+async def test_regenerate_turn_already_in_snapshot(harness):
+    # 恰好在合并边界上：最新一轮已写入快照，没有剩余增量
+    offsets = [await harness.turn(f"问题{i}") for i in range(state_store.COMPACT_EVERY)]
+    await harness.settle()
+    assert await harness.delta_count() == 0
+
+    lease, agent = await harness.checkout()
+    base_offset = regenerate_offset(
+        agent, offsets[-1], MESSAGE_STATUS_ACTIVE, agent.model_context.all_messages()[-1].content
+    )
+    agent.model_context.truncate(base_offset)
+    await agent.run(task="重新生成")
+    await harness.commit_turn(lease, agent, base_offset)
+
+    # 增量的base_offset落在快照内，加载时截断快照的尾部
+    reloaded, loaded = await harness.reload()
+    assert loaded.delta_count == 1
+    assert dump(reloaded) == dump(agent)
+
+
+async def test_failed_regenerate_restores_context(harness):
+    for i in range(3):
+        await harness.turn(f"问题{i}")
+    original = dump(harness.agent)
+    original_tokens = harness.agent.model_context.total_tokens()
+
+    lease, agent = await harness.checkout()
+    base_offset = state_store.context_size(agent) - 2
+    previous = agent.model_context.tail(base_offset)
+    agent.model_context.truncate(base_offset)
+    await agent.model_context.add_message(UserMessage(content="生成到一半", source="user"))
+
+    # 失败时恢复原来的尾部，不写增量
+    agent.model_context.replace_tail(base_offset, *previous)
+    harness.cache.checkin(lease, agent, "signature")
+
+    assert dump(agent) == original
+    assert agent.model_context.total_tokens() == original_tokens
+    reloaded, _ = await harness.reload()
+    assert dump(reloaded) == original
+
+
+async def test_regenerate_offset_without_recorded_position():
+    agent = make_agent()
+    await agent.model_context.add_message(UserMessage(content="问题", source="user"))
+    await agent.model_context.add_message(AssistantMessage(content="回答", source="assistant"))
+
+    # 早期消息没有记录位置：末尾正好是该轮时按末尾推算，否则无法确定
+    assert regenerate_offset(agent, None, MESSAGE_STATUS_ACTIVE, "回答") == 0
+    assert regenerate_offset(agent, None, MESSAGE_STATUS_ACTIVE, "别的回答") is None
+    # 中断的轮次没有写入上下文
+    assert regenerate_offset(agent, None, MESSAGE_STATUS_PARTIAL, "部分") == 2
+    # 记录的位置超出上下文
+    assert regenerate_offset(agent, 5, MESSAGE_STATUS_ACTIVE, "回答") is None
@@ -0,0 +1,113 @@
+"""SSE事件缓冲区的重放与resync"""
+import json
+
+import pytest
+
+from chat.sse import ContentBuffer
+from chat.stream_buffer import StreamEventBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+def parse(frame: str):
+    """返回(事件ID, 数据)，不带ID的帧事件ID为None"""
+    event_id = None
+    data = None
+    for line in frame.strip().split("\n"):
+        if line.startswith("id: "):
+            event_id = int(line[4:])
+        elif line.startswith("data: "):
+            data = json.loads(line[6:])
+    return event_id, data
+
+
+class Producer:
+    """模拟生成任务：内容先写入ContentBuffer，再发布chunk事件"""
+
+    def __init__(self, max_events: int):
+        self.content = ContentBuffer()
+        self.buffer = StreamEventBuffer("task", max_events)
+        self.buffer.snapshot = self.content.text
+
+    def chunk(self, text: str) -> int:
+        self.content.append(text)
+        return self.buffer.publish({"type": "chunk", "content": text})
+
+    def event(self, event_type: str) -> int:
+        return self.buffer.publish({"type": event_type})
+
+
+async def read(buffer: StreamEventBuffer, last_event_id: int = 0):
+    return [parse(frame) async for frame in buffer.subscribe(last_event_id)]
+
+
+def text(frames) -> str:
+    """按客户端的处理方式还原内容：resync替换，chunk追加"""
+    result = ""
+    for _, data in frames:
+        if data["type"] == "resync":
+            result = data["content"]
+        elif data["type"] == "chunk":
+            result += data["content"]
+    return result
+
+
+async def test_replay_after_last_event_id():
+    producer = Producer(16)
+    producer.event("assistant_start")
+    ids = [producer.chunk(c) for c in "abc"]
+    producer.buffer.close()
+
+    frames = await read(producer.buffer, ids[0])
+    assert [event_id for event_id, _ in frames] == ids[1:]
+    assert text(frames) == "bc"
+
+
+async def test_resync_id_is_last_covered_chunk():
+    producer = Producer(4)
+    producer.event("assistant_start")
+    for c in "abcdefgh":
+        producer.chunk(c)
+    complete_id = producer.event("complete")
+    producer.buffer.close()
+
+    frames = await read(producer.buffer, 0)
+    resync_id, resync = frames[0]
+    assert resync == {"type": "resync", "content": "abcdefgh"}
+    # resync的ID是它覆盖的最后一个chunk，之后只有complete
+    assert resync_id == complete_id - 1
+    assert frames[1:] == [(complete_id, {"type": "complete"})]
+    assert text(frames) == "abcdefgh"
+
+
+async def test_reconnect_with_resync_id_does_not_duplicate():
+    producer = Producer(4)
+    for c in "abcdef":
+        producer.chunk(c)
+
+    subscription = producer.buffer.subscribe(0)
+    resync_id, resync = parse(await subscription.__anext__())
+    await subscription.aclose()
+
+    # 客户端断开后带着resync的ID重连，期间又生成了新的内容
+    producer.chunk("g")
+    producer.buffer.close()
+    frames = await read(producer.buffer, resync_id)
+    assert resync["content"] + text(frames) == "abcdefg"
+
+
+async def test_covered_events_resent_without_id():
+    producer = Producer(4)
+    for c in "abc":
+        producer.chunk(c)
+    queued_id = producer.event("queued")
+    producer.chunk("d")
+    producer.chunk("e")
+    producer.buffer.close()
+
+    frames = await read(producer.buffer, 0)
+    # 快照之前的非chunk事件不带ID补发，客户端的Last-Event-ID不会回退
+    assert frames[0] == (None, {"type": "queued"})
+    assert frames[1][1]["type"] == "resync"
+    assert frames[1][0] > queued_id
+    assert text(frames) == "abcde"
@@ -0,0 +1,117 @@
+"""结构化输出的校验、重试与上下文回滚"""
+import asyncio
+
+import pytest
+from autogen_agentchat.agents import AssistantAgent
+from autogen_ext.models.replay import ReplayChatCompletionClient
+
+from chat.context_window import build_context
+from chat.structured import StructuredOutput, StructuredOutputError, output_model
+from models import ApiKey, Prompt
+
+pytestmark = pytest.mark.anyio
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {"type": "string", "minLength": 1},
+        "score": {"type": "integer", "minimum": 0, "maximum": 10},
+    },
+    "required": ["answer", "score"],
+    "additionalProperties": False,
+}
+VALID = '{"answer": "好", "score": 7}'
+
+
+class SlowReplayClient(ReplayChatCompletionClient):
+    """前几次调用先等待delay秒，用于触发单次超时"""
+
+    def __init__(self, replies, slow_calls: int, delay: float):
+        super().__init__(replies)
+        self.slow_calls = slow_calls
+        self.delay = delay
+
+    async def create_stream(self, *args, **kwargs):
+        if self.slow_calls > 0:
+            self.slow_calls -= 1
+            await asyncio.sleep(self.delay)
+        async for item in super().create_stream(*args, **kwargs):
+            yield item
+
+
+def make_agent(model_client) -> AssistantAgent:
+    return AssistantAgent(
+        name="assistant",
+        model_client=model_client,
+        model_client_stream=True,
+        system_message="只返回JSON。",
+        model_context=build_context(ApiKey(model_name="test", config={}), Prompt(content="只返回JSON。")),
+        output_content_type=output_model({"schema": SCHEMA, "name": "review"})
+    )
+
+
+def engine(**options) -> StructuredOutput:
+    options = {"backoff_base": 0.001, "backoff_max": 0.001, **options}
+    return StructuredOutput(model=output_model({"schema": SCHEMA, "name": "review"}), **options)
+
+
+async def run(engine: StructuredOutput, agent: AssistantAgent):
+    return [event async for event in engine.run(agent, "评价一下")]
+
+
+async def test_invalid_output_is_retried_and_rolled_back():
+    agent = make_agent(ReplayChatCompletionClient(['{"answer": "", "score": 11}', VALID]))
+    events = await run(engine(), agent)
+
+    attempts = [event for event in events if event["type"] == "attempt"]
+    assert [attempt["ok"] for attempt in attempts] == [False, True]
+    assert attempts[0]["error"].startswith("验证失败")
+    assert attempts[0]["backoff"] is not None
+
+    result = events[-1]
+    assert result["type"] == "result"
+    assert result["data"] == {"answer": "好", "score": 7}
+    assert len(result["attempts"]) == 2
+    # 失败的尝试已从上下文中移除，只留下用户消息和合法的回复
+    assert [message.content for message in agent.model_context.all_messages()][-1] == VALID
+    assert agent.model_context.message_count() == 2
+
+
+async def test_all_attempts_failing_raises_with_history():
+    agent = make_agent(ReplayChatCompletionClient(["不是JSON"] * 3))
+    with pytest.raises(StructuredOutputError) as failed:
+        await run(engine(max_attempts=3), agent)
+    attempts = failed.value.attempts
+    assert len(attempts) == 3 and not any(attempt.ok for attempt in attempts)
+    # 最后一次失败后不再等待
+    assert attempts[-1].backoff is None
+    assert agent.model_context.message_count() == 0
+
+
+async def test_attempt_timeout_is_retried():
+    agent = make_agent(SlowReplayClient([VALID, VALID], slow_calls=1, delay=1.0))
+    events = await run(engine(attempt_timeout=0.05), agent)
+    attempts = [event for event in events if event["type"] == "attempt"]
+    assert attempts[0]["timeout"] and attempts[0]["error"] == "请求超时"
+    assert attempts[1]["ok"] and events[-1]["type"] == "result"
+
+
+async def test_deadline_stops_retries():
+    agent = make_agent(SlowReplayClient([VALID] * 3, slow_calls=3, delay=1.0))
+    options = {"attempt_timeout": 0.05, "deadline": 0.08, "backoff_base": 1.0, "backoff_max": 1.0}
+    with pytest.raises(StructuredOutputError) as failed:
+        await run(engine(**options), agent)
+    # 退避会超过总截止时间，不再发起下一次尝试
+    assert len(failed.value.attempts) <= 2
+    assert failed.value.attempts[-1].backoff is None
+
+
+def test_schema_conversion_and_cache():
+    model = output_model({"schema": SCHEMA, "name": "review"})
+    assert model is output_model({"schema": SCHEMA, "name": "review"})
+    assert model(answer="好", score=3).score == 3
+    with pytest.raises(ValueError):
+        output_model({"schema": {"type": "string"}})
+    with pytest.raises(ValueError):
+        output_model({"model": "missing"})
+    assert output_model({}) is None
@@ -0,0 +1,92 @@
+"""跨进程任务注册表的取消标记"""
+import sys
+
+import pytest
+from sqlalchemy import select
+
+from chat.generation import JOB_RUNNING
+from chat.task_registry import TaskRegistry
+from models import GenerationTask
+
+pytestmark = pytest.mark.anyio
+
+OTHER_WORKER = "other-host:1"
+
+
+class FakeManager:
+    """记录被取消的本地任务"""
+
+    def __init__(self, *task_ids):
+        self.jobs = set(task_ids)
+        self.cancelled = []
+
+    def active_jobs(self):
+        return list(self.jobs)
+
+    def cancel(self, task_id: str) -> bool:
+        self.cancelled.append(task_id)
+        return task_id in self.jobs
+
+
+@pytest.fixture
+def registry(session_factory, monkeypatch):
+    monkeypatch.setattr(sys.modules["chat.task_registry"], "AsyncSessionLocal", session_factory)
+    return TaskRegistry(FakeManager("local-running"))
+
+
+async def add_tasks(session_factory, registry, *rows):
+    async with session_factory() as db:
+        for task_id, owner, state in rows:
+            db.add(GenerationTask(task_id=task_id, owner=owner or registry.worker_id, state=state))
+        await db.commit()
+
+
+async def cancel_flags(session_factory):
+    async with session_factory() as db:
+        result = await db.execute(select(GenerationTask.task_id, GenerationTask.cancel_requested))
+        return dict(result.all())
+
+
+async def test_request_cancel_only_marks_other_workers(registry, session_factory):
+    await add_tasks(
+        session_factory, registry,
+        ("local-finished", None, JOB_RUNNING),
+        ("remote-running", OTHER_WORKER, JOB_RUNNING),
+        ("remote-done", OTHER_WORKER, "completed"),
+    )
+    # 本进程的任务已不在generation_jobs中，说明刚结束，不写标记
+    assert await registry.request_cancel("local-finished") is False
+    assert await registry.request_cancel("remote-done") is False
+    assert await registry.request_cancel("missing") is False
+    assert await registry.request_cancel("remote-running") is True
+
+    flags = await cancel_flags(session_factory)
+    assert flags == {"local-finished": 0, "remote-running": 1, "remote-done": 0}
+
+
+async def test_request_cancel_all_skips_own_tasks(registry, session_factory):
+    await add_tasks(
+        session_factory, registry,
+        ("local-running", None, JOB_RUNNING),
+        ("remote-a", OTHER_WORKER, JOB_RUNNING),
+        ("remote-b", "third-host:2", JOB_RUNNING),
+    )
+    assert await registry.request_cancel_all() == 2
+    assert (await cancel_flags(session_factory))["local-running"] == 0
+
+
+async def test_poll_cancels_flagged_local_jobs(registry, session_factory):
+    await add_tasks(
+        session_factory, registry,
+        ("local-running", None, JOB_RUNNING),
+        ("remote-running", OTHER_WORKER, JOB_RUNNING),
+    )
+    async with session_factory() as db:
+        for task in (await db.execute(select(GenerationTask))).scalars():
+            task.cancel_requested = 1
+        await db.commit()
+
+    # 只取消本进程拥有的任务，其他进程的标记留给所属进程
+    registry._last_sweep = float("inf")
+    await registry._poll_once()
+    assert registry.manager.cancelled == ["local-running"]
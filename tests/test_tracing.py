@@ -0,0 +1,48 @@
+"""span的采样、写出与文件轮转"""
+import json
+
+import pytest
+
+from tracing import JsonlExporter, Tracer, current_trace_id
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_sampled_spans_written_to_configured_file(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(sample_rate=1.0, exporter=JsonlExporter(str(path)))
+    root = tracer.start_trace("GET /chat")
+    token = tracer.attach(root)
+    with tracer.span("db.query", statement="select 1"):
+        assert current_trace_id() == root.trace_id
+    tracer.detach(token)
+    root.end()
+    await tracer.flush()
+
+    spans = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [span["name"] for span in spans] == ["db.query", "GET /chat"]
+    assert spans[0]["parent_id"] == root.span_id
+    assert tracer.stats()["file"] == str(path)
+
+
+async def test_unsampled_trace_writes_nothing(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(sample_rate=0.0, exporter=JsonlExporter(str(path)))
+    root = tracer.start_trace("GET /chat")
+    token = tracer.attach(root)
+    assert tracer.start_span("db.query") is None
+    tracer.detach(token)
+    root.end()
+    await tracer.flush()
+    assert not path.exists()
+
+
+def test_exporter_rotates_and_keeps_backups(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    exporter = JsonlExporter(str(path), max_bytes=10, backups=2)
+    for i in range(4):
+        exporter.write([f"line{i}"])
+    assert path.read_text() == "line3\n"
+    assert (tmp_path / "spans.jsonl.1").read_text() == "line2\n"
+    assert (tmp_path / "spans.jsonl.2").read_text() == "line1\n"
+    assert not (tmp_path / "spans.jsonl.3").exists()
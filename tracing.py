@@ -0,0 +1,292 @@
+import asyncio
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+# 按请求采样的比例，未采样的请求只生成trace_id用于关联，不记录span
+TRACE_SAMPLE_RATE = 0.1
+# span写入的JSONL文件，超过TRACE_MAX_BYTES时轮转，保留TRACE_BACKUPS个旧文件
+# 默认放在项目目录下的traces/，与启动时的工作目录无关；可用环境变量TRACE_FILE指定
+TRACE_FILE = os.environ.get("TRACE_FILE") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "traces", "spans.jsonl"
+)
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 5
+# 内存中待写入的span上限，写入跟不上时丢弃新的span
+TRACE_BUFFER_SIZE = 10000
+TRACE_FLUSH_INTERVAL = 1.0
+# 记录的SQL语句和错误信息的最大长度
+TRACE_STATEMENT_CHARS = 500
+TRACE_ERROR_CHARS = 500
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def parse_traceparent(value: Optional[str]):
+    """解析W3C traceparent请求头，返回(trace_id, parent_id, sampled)，格式不对时返回None"""
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return parts[1], parts[2], sampled
+
+
+class Span:
+    """一段计时，sampled为False时只携带trace_id，结束时不写出"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "sampled",
+                 "start_time", "_started", "duration", "error", "_tracer")
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 sampled: bool, attributes: Optional[Dict[str, Any]] = None):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """结束span，重复调用只有第一次生效"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"[:TRACE_ERROR_CHARS]
+        if self.sampled:
+            self._tracer.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(self.start_time, timezone.utc).isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class JsonlExporter:
+    """span按行写入JSONL文件，超过max_bytes时轮转：spans.jsonl -> spans.jsonl.1 -> ... -> spans.jsonl.N"""
+
+    def __init__(self, path: str = TRACE_FILE, max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def _rotate(self) -> None:
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, lines: List[str]) -> None:
+        """同步写入，由Tracer在线程中调用"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "ab") as f:
+            f.write(data)
+
+
+class Tracer:
+    """进程内的请求追踪
+
+    每个HTTP请求由TracingMiddleware开启根span并按sample_rate决定是否采样，请求头traceparent
+    带有采样标志时沿用其trace_id并强制采样。当前span保存在contextvars中，数据库语句、模型调用
+    和生成的各阶段在采样的请求内创建子span；未采样时start_span返回None，几乎没有开销。
+    结束的span先放入内存缓冲，由后台任务定期在线程中写入JSONL文件。
+    """
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, exporter: Optional[JsonlExporter] = None,
+                 buffer_size: int = TRACE_BUFFER_SIZE, flush_interval: float = TRACE_FLUSH_INTERVAL):
+        self.sample_rate = sample_rate
+        self.exporter = exporter or JsonlExporter()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict[str, Any]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def configure(self, sample_rate: Optional[float] = None) -> None:
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError("采样率必须在0到1之间")
+            self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes: Any) -> Span:
+        """开启根span，未挂到当前上下文，需要时用attach"""
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            sampled = sampled or random.random() < self.sample_rate
+        else:
+            trace_id, parent_id = _new_id(128), None
+            sampled = random.random() < self.sample_rate
+        return Span(self, name, trace_id, parent_id, sampled, attributes)
+
+    def start_span(self, name: str, **attributes: Any) -> Optional[Span]:
+        """在当前span下开启子span，不改变当前span，当前请求未采样时返回None
+
+        适合跨越yield的调用（如模型流），由调用方负责end。
+        """
+        parent = _current.get()
+        if parent is None or not parent.sampled:
+            return None
+        return Span(self, name, parent.trace_id, parent.span_id, True, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any):
+        """开启子span并设为当前span，异常时记录错误"""
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.end(e)
+            raise
+        finally:
+            self.detach(token)
+            span.end()
+
+    def attach(self, span: Span):
+        return _current.set(span)
+
+    def detach(self, token) -> None:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # 异步生成器在其他任务中被关闭，上下文已不同
+            pass
+
+    def current(self) -> Optional[Span]:
+        return _current.get()
+
+    def export(self, span: Span) -> None:
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append(span.to_dict())
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self._buffer:
+            return
+        spans, self._buffer = self._buffer, []
+        try:
+            lines = [json.dumps(span, ensure_ascii=False, default=str) for span in spans]
+            await asyncio.to_thread(self.exporter.write, lines)
+            self.exported += len(spans)
+        except Exception as e:
+            self.dropped += len(spans)
+            print(f"写入追踪数据失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "file": self.exporter.path,
+            "buffered": len(self._buffer),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current.get()
+    return span.trace_id if span is not None else None
+
+
+class TracingMiddleware:
+    """每个HTTP请求一个根span，trace_id通过响应头X-Trace-Id返回
+
+    纯ASGI中间件，流式响应发送完毕后根span才结束。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope.get("headers") or ():
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+        span = tracer.start_trace(
+            f"{scope['method']} {scope['path']}", traceparent, method=scope["method"], path=scope["path"]
+        )
+        token = tracer.attach(span)
+        trace_header = (b"x-trace-id", span.trace_id.encode())
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                span.set(status_code=message["status"])
+                message = {**message, "headers": [*message.get("headers", ()), trace_header]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            span.end(e)
+            raise
+        finally:
+            tracer.detach(token)
+            span.end()
+
+
+tracer = Tracer()
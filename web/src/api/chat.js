@@ -172,10 +172,23 @@ export function cancelStreamMessage(taskId) {
  * @returns {Promise<{eventSource: EventSource, taskId: string}>} 返回EventSource对象和任务ID
  */
 export function sendStreamMessage(data, onMessage, onError, onComplete) {
+  return postStream(`/chat/messages/stream`, data, onMessage, onError, onComplete);
+}
+
+/**
+ * 发送POST请求并按SSE读取响应
+ * @param {string} url - 接口路径
+ * @param {Object} data - 请求数据
+ * @param {function} onMessage - 消息回调函数
+ * @param {function} onError - 错误回调函数
+ * @param {function} onComplete - 完成回调函数
+ * @returns {Promise<{taskId: string, cancel: function}>} 返回任务ID和取消函数
+ */
+function postStream(url, data, onMessage, onError, onComplete) {
   return new Promise(async (resolve, reject) => {
     try {
       // 首先发送POST请求启动流式响应
-      const response = await fetch(`http://127.0.0.1:8000/chat/messages/stream`, {
+      const response = await fetch(`http://127.0.0.1:8000${url}`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -252,18 +265,29 @@ export function sendStreamMessage(data, onMessage, onError, onComplete) {
 }
 
 /**
- * 重新生成消息
+ * 重新生成最近一轮的回复（使用SSE）
  * @param {Object} data - 重新生成参数
- * @param {string} data.chatId - 对话ID
- * @param {string} data.messageId - 要重新生成的消息ID
+ * @param {string} data.chat_id - 对话ID
+ * @param {string} data.message_id - 要重新生成的消息ID
  * @param {Object} data.config - 生成配置（可选）
- * @returns {Promise} 返回重新生成的消息
+ * @param {function} onMessage - 消息回调函数
+ * @param {function} onError - 错误回调函数
+ * @param {function} onComplete - 完成回调函数
+ * @returns {Promise<{taskId: string, cancel: function}>} 返回任务ID和取消函数
+ */
+export function regenerateMessage(data, onMessage, onError, onComplete) {
+  return postStream(`/chat/messages/regenerate`, data, onMessage, onError, onComplete);
+}
+
+/**
+ * 获取回复的全部版本
+ * @param {string} messageId - 消息ID
+ * @returns {Promise} 返回版本列表
  */
-export function regenerateMessage(data) {
+export function getMessageVersions(messageId) {
   return request({
-    url: "/chat/messages/regenerate",
-    method: "post",
-    data: data,
+    url: `/chat/messages/${messageId}/versions`,
+    method: "get",
   });
 }
 